@@ -1,12 +1,16 @@
 import logging
+import os
+import resource
 import time
 import json
-from flask import Flask, render_template, Response, stream_with_context, send_file
+from flask import Flask, render_template, Response, stream_with_context, request, abort
 from flask_sqlalchemy import SQLAlchemy
 
+from cache import cache
 from constants import YANG_TERM
-from datajobs import ScheduledJob, StreamJob
-from settings import PORT, DB_USER, DB_PASSWORD, RDS_POSTGRES_ENDPOINT, DB_NAME
+from datajobs import DataJob, ScheduledJob, StreamJob
+from queries import query_stats
+from settings import PORT, DB_USER, DB_PASSWORD, RDS_POSTGRES_ENDPOINT, DB_NAME, SSE_BASE_URL
 
 
 # pylint: disable=logging-fstring-interpolation
@@ -26,9 +30,28 @@ View Functions
 """
 
 
+def cached_response(entry, mimetype):
+    """
+    Send an encoded CacheEntry with its content hash as a strong ETag, cacheable by
+    browsers and CDNs until its refresh bucket ends, a stale entry only with
+    revalidation. A matching If-None-Match gets a 304.
+    X-Data-Age is how many seconds ago the data was generated.
+    """
+    if entry is None:
+        # Nothing precomputed yet
+        abort(503)
+    response = app.response_class(response=entry.value, status=200, mimetype=mimetype)
+    response.headers['X-Data-Age'] = str(max(int(time.time() - entry.generated_at), 0))
+    response.set_etag(entry.etag)
+    response.last_modified = entry.generated_at
+    response.cache_control.public = True
+    response.cache_control.max_age = max(int(entry.expires_at - time.time()), 0)
+    return response.make_conditional(request)
+
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', sse_base_url=SSE_BASE_URL)
 
 
 @app.route('/about')
@@ -47,7 +70,10 @@ def yangcount():
 @app.route('/latest_tweets')
 def latest_tweets():
     return Response(
-        stream_with_context(StreamJob.latest_tweet_stream(n=5)),
+        stream_with_context(StreamJob.latest_tweet_stream(
+            n=request.args.get('n', 5, type=int),
+            # Sent by EventSource on reconnect, resumes after the last tweet received
+            last_event_id=request.headers.get('Last-Event-ID', type=int))),
         mimetype='text/event-stream'
     )
 
@@ -55,13 +81,7 @@ def latest_tweets():
 @app.route('/top_retweets')
 def top_retweets():
     """Top retweeted tweet ids, refresh every 30min based on the query granularity"""
-    top_retweet_ids = ScheduledJob.get_top_retweets()
-    response = app.response_class(
-            response=json.dumps(top_retweet_ids),
-            status=200,
-            mimetype='application/json'
-        )
-    return response
+    return cached_response(ScheduledJob.get_top_retweets(), 'application/json')
 
 
 """Charts"""
@@ -73,7 +93,8 @@ def tweets_min_chart():
     Get the counts of tweets for the last 6hr at 5min granularity
     A total 72 data points - the last 5 min = 71 data points
     """
-    return ScheduledJob.tweets_chart_request(chart_type='72hr_at_1hr')
+    return cached_response(
+        ScheduledJob.tweets_chart_request(chart_type='72hr_at_1hr'), 'application/json')
 
 
 # pylint: disable=no-member
@@ -83,7 +104,8 @@ def tweets_daily_chart():
     Get the counts of tweets for the last 14 days at 1 day granularity
     A total 14 data points including today
     """
-    return ScheduledJob.tweets_chart_request(chart_type='14d_at_1d')
+    return cached_response(
+        ScheduledJob.tweets_chart_request(chart_type='14d_at_1d'), 'application/json')
 
 
 @app.route('/tweets_loc_chart')
@@ -92,7 +114,8 @@ def tweets_loc_chart():
     Get the counts of tweets for the last 14 days at 1 day granularity
     A total 14 data points including today
     """
-    return ScheduledJob.tweets_chart_request(chart_type='72h_for_loc')
+    return cached_response(
+        ScheduledJob.tweets_chart_request(chart_type='72h_for_loc'), 'application/json')
 
 
 """Sentiment"""
@@ -104,13 +127,38 @@ def wordcloud():
     Get the word cloud for tweets in the last 6 hours
     """
     # Query tweets in the last 6 hours, refresh at 1 hour
-    # Cache the generated image
-    img = ScheduledJob.get_wordcloud()
+    # The generated image is cached as PNG bytes, sent as is
+    return cached_response(ScheduledJob.get_wordcloud(), 'image/png')
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Cache, SSE broadcast and db counters of the worker process serving this request"""
+    stats = {
+        **cache.stats(),
+        'streams': StreamJob.stats(),
+        'pid': os.getpid(),
+        'rss_kb': _rss_kb(),
+        'db_queries': DataJob.query_count(),
+        'queries': query_stats(),
+    }
+    return app.response_class(
+        response=json.dumps(stats),
+        status=200,
+        mimetype='application/json'
+    )
+
 
-    if img:
-        img.seek(0)
-        logging.info(f"Word cloud image sent.")
-        return send_file(img, mimetype='image/png')
+def _rss_kb():
+    """Current resident set size in KB, falls back to peak RSS off Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
 
 if __name__ == "__main__":
@@ -0,0 +1,275 @@
+"""
+Columnar archive of closed days of crypto_tweets
+
+Each US eastern day is exported to its own segment directory, rows ordered
+by inserted_at and cut into blocks of block_size rows:
+
+    <archive_dir>/<YYYYMMDD>/
+        index.json          columns, row count and per block: first row,
+                            inserted_at range and text byte ranges
+        <numeric col>.npy   one array per numeric column, read memory-mapped
+        <text col>.zlib     per block zlib compressed JSON list of values
+
+Integer columns hold NULL_INT for NULL and the boolean flags -1, created_at
+is epoch milliseconds. read_archive() yields a time range as one batch per
+block: numeric columns are views of the memory-mapped arrays and only the
+blocks in range are decompressed, so a day is never loaded as a whole.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import zlib
+from datetime import timezone as dt_timezone
+
+import numpy as np
+from sqlalchemy import and_, func, select
+
+from models import Tweet
+from queries import convert_date_to_tsinterval
+
+
+INDEX_FILE = 'index.json'
+NULL_INT = np.iinfo(np.int64).min
+NUMERIC_COLUMNS = {
+    'id': 'int64',
+    'inserted_at': 'int64',
+    'created_at': 'int64',
+    'user_followers': 'int64',
+    'is_retweet': 'int8',
+    'is_reply': 'int8',
+}
+TEXT_COLUMNS = [col.name for col in Tweet.__table__.columns if col.name not in NUMERIC_COLUMNS]
+
+
+# pylint: disable=logging-fstring-interpolation
+def _to_numeric(column, value):
+    if value is None:
+        return -1 if NUMERIC_COLUMNS[column] == 'int8' else NULL_INT
+    if column == 'created_at':
+        if value.tzinfo is None:
+            # SQLite hands back naive datetimes, they were written as UTC
+            value = value.replace(tzinfo=dt_timezone.utc)
+        return int(value.timestamp() * 1000)
+    return int(value)
+
+
+def segment_path(archive_dir, created_date):
+    return os.path.join(archive_dir, created_date)
+
+
+def archived_dates(archive_dir):
+    """Eastern dates ('YYYYMMDD') with a complete segment, oldest first"""
+    if not os.path.isdir(archive_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(archive_dir)
+        if os.path.isfile(os.path.join(archive_dir, name, INDEX_FILE)))
+
+
+def archive_day(engine, created_date, archive_dir, block_size=10000):
+    """
+    Export the tweets of one eastern day to a segment. If the segment exists,
+    tweets that came in for the day after its export, e.g. replayed spilled
+    tweets, are added to it, whether the day's partition was kept or dropped
+    and created again for them. The segment is written to a temporary
+    directory and renamed into place, so a segment with an index is always
+    complete.
+
+    Arguments:
+        engine {Engine} -- Database engine to read crypto_tweets from
+        created_date {str} -- Eastern date, e.g. 20191022
+        archive_dir {str} -- Directory holding the segments
+
+    Keyword Arguments:
+        block_size {int} -- Rows per block, the unit of decompression and of read batches
+
+    Returns:
+        int -- Rows in the segment, None if it was up to date
+    """
+    final_path = segment_path(archive_dir, created_date)
+    old_path = final_path + '.old'
+    if os.path.isdir(old_path) and not os.path.isdir(final_path):
+        # Interrupted while replacing the segment
+        os.rename(old_path, final_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    index = _read_index(final_path)
+
+    start_ms, end_ms = convert_date_to_tsinterval(created_date)
+    table = Tweet.__table__
+    in_day = and_(table.c.inserted_at >= start_ms, table.c.inserted_at < end_ms)
+    tmp_path = final_path + '.tmp'
+    with engine.connect() as conn:
+        if conn.dialect.name == 'postgresql':
+            # The count and the rows are read from one snapshot
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+        with conn.begin():
+            new_rows = in_day
+            if index is not None and index['rows']:
+                # Ids only increase, the ones past the segment's came in after its export
+                ids = np.load(os.path.join(final_path, 'id.npy'), mmap_mode='r')
+                new_rows = and_(in_day, table.c.id > int(ids.max()))
+            rows_total = conn.execute(select([func.count()]).where(new_rows)).scalar()
+            archived = []
+            if index is not None:
+                if not rows_total:
+                    return None
+                archived = _segment_rows(final_path, start_ms, end_ms)
+                rows_total += index['rows']
+            stmt = (select([table.c[col] for col in list(NUMERIC_COLUMNS) + TEXT_COLUMNS])
+                    .where(new_rows)
+                    .order_by(table.c.inserted_at))
+            # Server side cursor on Postgres, a day is fetched one block at a time
+            result = conn.execution_options(stream_results=True).execute(stmt)
+            rows = heapq.merge(archived, (_db_row(row) for row in result),
+                               key=lambda row: row['inserted_at'])
+            _write_segment(tmp_path, created_date, rows, rows_total, block_size)
+
+    if index is not None:
+        os.rename(final_path, old_path)
+    os.rename(tmp_path, final_path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    logging.info(f"Archived {rows_total} tweets of {created_date} to {final_path}")
+    return rows_total
+
+
+def _read_index(path):
+    """Index of a complete segment, None if there is none"""
+    index_path = os.path.join(path, INDEX_FILE)
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def _db_row(row):
+    """A crypto_tweets row as a dict, numeric columns as stored in a segment"""
+    values = {col: _to_numeric(col, row[col]) for col in NUMERIC_COLUMNS}
+    values.update((col, row[col]) for col in TEXT_COLUMNS)
+    return values
+
+
+def _segment_rows(path, start_ms, end_ms):
+    """Rows of a segment as dicts, read one block at a time"""
+    for batch in _read_segment(path, start_ms, end_ms, None):
+        for i in range(len(batch['id'])):
+            yield {col: int(values[i]) if col in NUMERIC_COLUMNS else values[i]
+                   for col, values in batch.items()}
+
+
+def _write_segment(path, created_date, rows, rows_total, block_size):
+    """
+    Write rows_total rows, sorted by inserted_at, to a segment at path. Numeric
+    columns go straight to preallocated memory-mapped arrays, so only one block
+    of rows is ever held in memory.
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    numeric = {
+        col: np.lib.format.open_memmap(
+            os.path.join(path, f"{col}.npy"), mode='w+', dtype=dtype, shape=(rows_total,))
+        for col, dtype in NUMERIC_COLUMNS.items()
+    }
+    text_files = {col: open(os.path.join(path, f"{col}.zlib"), 'wb') for col in TEXT_COLUMNS}
+    blocks = []
+    row_start = 0
+    try:
+        while True:
+            block_rows = list(itertools.islice(rows, block_size))
+            if not block_rows:
+                break
+            row_end = row_start + len(block_rows)
+            if row_end > rows_total:
+                raise RuntimeError(f"More tweets than the {rows_total} counted for {created_date}")
+            block = {
+                'row_start': row_start,
+                'rows': len(block_rows),
+                'min_inserted_at': block_rows[0]['inserted_at'],
+                'max_inserted_at': block_rows[-1]['inserted_at'],
+                'text': {},
+            }
+            for col in NUMERIC_COLUMNS:
+                numeric[col][row_start:row_end] = [row[col] for row in block_rows]
+            for col in TEXT_COLUMNS:
+                data = zlib.compress(json.dumps([row[col] for row in block_rows]).encode())
+                block['text'][col] = [text_files[col].tell(), len(data)]
+                text_files[col].write(data)
+            blocks.append(block)
+            row_start = row_end
+    finally:
+        for f in text_files.values():
+            f.close()
+        for values in numeric.values():
+            values.flush()
+    if row_start != rows_total:
+        raise RuntimeError(f"Only {row_start} of the {rows_total} tweets counted for {created_date}")
+
+    with open(os.path.join(path, INDEX_FILE), 'w') as f:
+        json.dump({
+            'created_date': created_date,
+            'rows': rows_total,
+            'block_size': block_size,
+            'numeric_columns': NUMERIC_COLUMNS,
+            'text_columns': TEXT_COLUMNS,
+            'blocks': blocks,
+        }, f)
+
+
+def read_archive(archive_dir, start_ms, end_ms, columns=None):
+    """
+    Yield the archived tweets with start_ms <= inserted_at < end_ms, oldest first,
+    as batches of at most one block: dicts of column name to a numpy array
+    (numeric columns) or a list (text columns).
+
+    Arguments:
+        archive_dir {str} -- Directory holding the segments
+        start_ms {int} -- Range start, epoch milliseconds
+        end_ms {int} -- Range end, epoch milliseconds
+
+    Keyword Arguments:
+        columns {list} -- Columns to read, all by default
+    """
+    for created_date in archived_dates(archive_dir):
+        day_start_ms, day_end_ms = convert_date_to_tsinterval(created_date)
+        if day_end_ms <= start_ms or day_start_ms >= end_ms:
+            continue
+        yield from _read_segment(
+            segment_path(archive_dir, created_date), start_ms, end_ms, columns)
+
+
+def _read_segment(path, start_ms, end_ms, columns):
+    index = _read_index(path)
+    columns = columns or list(index['numeric_columns']) + index['text_columns']
+    arrays = {
+        col: np.load(os.path.join(path, f"{col}.npy"), mmap_mode='r')
+        for col in columns if col in index['numeric_columns']
+    }
+    inserted_at = arrays.get('inserted_at')
+    if inserted_at is None:
+        inserted_at = np.load(os.path.join(path, 'inserted_at.npy'), mmap_mode='r')
+    # Rows are sorted by inserted_at, only the pages around the bounds are touched
+    lo = int(np.searchsorted(inserted_at, start_ms, side='left'))
+    hi = int(np.searchsorted(inserted_at, end_ms, side='left'))
+    text_columns = [col for col in columns if col in index['text_columns']]
+    text_files = {col: open(os.path.join(path, f"{col}.zlib"), 'rb') for col in text_columns}
+    try:
+        for block in index['blocks']:
+            block_start = block['row_start']
+            block_end = block_start + block['rows']
+            if block_end <= lo:
+                continue
+            if block_start >= hi:
+                break
+            row_lo, row_hi = max(lo, block_start), min(hi, block_end)
+            batch = {col: arrays[col][row_lo:row_hi] for col in arrays}
+            for col in text_columns:
+                offset, length = block['text'][col]
+                text_files[col].seek(offset)
+                values = json.loads(zlib.decompress(text_files[col].read(length)))
+                batch[col] = values[row_lo - block_start:row_hi - block_start]
+            yield batch
+    finally:
+        for f in text_files.values():
+            f.close()
@@ -0,0 +1,112 @@
+"""
+Benchmark of the latest tweets read: the ORM path (SELECT * hydrated into
+Tweet objects) against Database.fetch_latest_tweets (one column as tuples).
+
+Run from the repo root, against a throwaway SQLite db by default:
+
+    python benchmarks/latest_tweets.py --tweets 50000 --iterations 2000
+    python benchmarks/latest_tweets.py --db-url postgresql+psycopg2://localhost/bench
+"""
+import argparse
+import json
+import sys
+import time
+
+sys.path.append(".")
+
+from constants import YANG_TERM
+from models import Tweet, Database
+
+
+PLACE = json.dumps({
+    'id': '01a9a39529b27f36', 'place_type': 'city', 'name': 'Manhattan',
+    'full_name': 'Manhattan, NY', 'country_code': 'US', 'country': 'United States',
+    'bounding_box': {'type': 'Polygon', 'coordinates': [[
+        [-74.026675, 40.683935], [-74.026675, 40.877483],
+        [-73.910408, 40.877483], [-73.910408, 40.683935]]]},
+})
+
+
+def populate(database, n_tweets):
+    """Insert n_tweets synthetic tweets with the wide columns filled in"""
+    table = Tweet.__table__
+    now_ms = int(time.time() * 1000)
+    batch = []
+    with database.engine.begin() as conn:
+        conn.execute(table.delete())
+        for i in range(n_tweets):
+            batch.append({
+                'inserted_at': now_ms - (n_tweets - i) * 10,
+                'track_term': YANG_TERM if i % 3 else 'cardano',
+                'tweet_id': str(1180000000000000000 + i),
+                'tweet_text': f"Andrew Yang tweet number {i} #YangGang",
+                'tweet_lang': 'en',
+                'user_name': f"user {i % 5000}",
+                'user_screen_name': f"user{i % 5000}",
+                'user_location': 'New York',
+                'user_followers': i % 10000,
+                'place': PLACE,
+                'coordinates': json.dumps({'type': 'Point', 'coordinates': [-73.99, 40.73]}),
+            })
+            if len(batch) == 5000:
+                conn.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(table.insert(), batch)
+
+
+def orm_latest_tweets(session, n):
+    """The previous StreamJob.latest_tweet_stream read, every column into Tweet objects"""
+    tweets = (session.query(Tweet)
+              .filter(Tweet.track_term == YANG_TERM)
+              .order_by(Tweet.id.desc())
+              .limit(n)
+              .all())
+    session.commit()
+    return [obj.tweet_text for obj in tweets]
+
+
+def projection_latest_tweets(database, n):
+    return [tweet_text for tweet_text, in database.fetch_latest_tweets(YANG_TERM, n=n)]
+
+
+def time_calls(fn, iterations):
+    durations = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - t0)
+    durations.sort()
+    return {
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 3),
+        'p50_ms': round(durations[len(durations) // 2] * 1000, 3),
+        'p99_ms': round(durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000, 3),
+    }
+
+
+def run_benchmark(db_url, n_tweets, iterations, n):
+    database = Database(db_url=db_url)
+    session = database.create_db_session()
+    populate(database, n_tweets)
+
+    # Both paths must return the same tweets
+    assert orm_latest_tweets(session, n) == projection_latest_tweets(database, n)
+    results = {
+        'orm': time_calls(lambda: orm_latest_tweets(session, n), iterations),
+        'projection': time_calls(lambda: projection_latest_tweets(database, n), iterations),
+    }
+    results['speedup_p50'] = round(results['orm']['p50_ms'] / results['projection']['p50_ms'], 2)
+    session.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the latest tweets read paths.")
+    parser.add_argument('--db-url', default='sqlite:///bench_latest_tweets.sqlite',
+                        help="Throwaway SQLite or Postgres url, its tweets are replaced")
+    parser.add_argument('--tweets', type=int, default=50000, help="Tweets to insert")
+    parser.add_argument('--iterations', type=int, default=2000, help="Calls per read path")
+    parser.add_argument('-n', type=int, default=5, help="Latest tweets per call")
+    args = parser.parse_args()
+
+    print(json.dumps(run_benchmark(args.db_url, args.tweets, args.iterations, args.n), indent=2))
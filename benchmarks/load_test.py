@@ -0,0 +1,389 @@
+"""
+Load test of the SSE streams and the chart endpoints.
+
+Serves application.app against a local db and Redis, opens N EventSource-like
+clients on /yangcount and /latest_tweets, and hammers the chart, top retweets
+and wordcloud endpoints at the same time. A feeder publishes synthetic tweets
+and counts the way the ingester does: the latest tweets ring, the daily count
+row and the change events. The report covers connections held, event delivery
+latency percentiles, RSS per worker and db queries per second.
+
+Run from the repo root. With a local Redis, the app runs under gunicorn like
+the Procfile:
+
+    python benchmarks/load_test.py --redis-url redis://localhost:6379/15 --clients 2000
+    python benchmarks/load_test.py --db-url postgresql+psycopg2://localhost/loadtest --workers 3
+
+With --fake-redis (needs fakeredis[lua], the cache releases its compute locks
+with a Lua script), the app runs in this process on a threaded dev server, so
+keep --clients small:
+
+    python benchmarks/load_test.py --fake-redis --clients 100 --duration 30
+
+The count charts use Postgres functions, against SQLite they are not requested
+and are reported as skipped. The db is repopulated on every run, so runs with
+the same arguments are comparable.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.append(".")
+
+from constants import YANG_TERM
+
+
+STREAMS = ['/yangcount', '/latest_tweets']
+ENDPOINTS = ['/tweets_min_chart', '/tweets_daily_chart', '/tweets_loc_chart',
+             '/top_retweets', '/wordcloud']
+# Their queries use Postgres functions, they are skipped against SQLite
+POSTGRES_ENDPOINTS = ['/tweets_min_chart', '/tweets_daily_chart']
+TOKENS = ['yang', 'freedom', 'dividend', 'ubi', 'debate', 'humanity', 'first', 'math', 'gang']
+STATES = ['NY', 'CA', 'TX', 'WA', 'FL', 'IA', 'NH', None, None, None]
+TEXT_PREFIX = 'loadtest '
+
+
+def populate(database, n_tweets, seed=42):
+    """Replace the tables the endpoints read with n_tweets synthetic tweets and their counts"""
+    from models import Tweet, TweetDailyCount, TweetMinuteCount, TweetHourCount
+    from queries import get_eastern_date_from_epoch
+
+    rng = random.Random(seed)
+    database.create_db_session().close()
+    now_ms = int(time.time() * 1000)
+    # Spread over the last 72 hours, the longest window a chart reads
+    span_ms = 72 * 60 * 60 * 1000
+    tweets, minutes, hours, days = [], {}, {}, {}
+    for i in range(n_tweets):
+        inserted_at = now_ms - span_ms + i * span_ms // n_tweets
+        is_retweet = rng.random() < 0.3
+        tweets.append({
+            'inserted_at': inserted_at,
+            'track_term': YANG_TERM,
+            'tweet_id': str(1190000000000000000 + i),
+            'tweet_text': f"Andrew Yang tweet number {i} #YangGang",
+            'retweeted_status_id_str': str(rng.randint(1, 50)) if is_retweet else None,
+            'user_state': rng.choice(STATES),
+            'tweet_tokens': None if is_retweet else ' '.join(rng.sample(TOKENS, 4)),
+            'is_retweet': is_retweet,
+            'is_reply': False,
+        })
+        for counts, bucket in ((minutes, inserted_at // 60000 * 60000),
+                               (hours, inserted_at // 3600000 * 3600000),
+                               (days, get_eastern_date_from_epoch(inserted_at))):
+            counts[bucket] = counts.get(bucket, 0) + 1
+
+    with database.engine.begin() as conn:
+        for model in (Tweet, TweetDailyCount, TweetMinuteCount, TweetHourCount):
+            conn.execute(model.__table__.delete())
+        conn.execute(Tweet.__table__.insert(), tweets)
+        for model, counts in ((TweetMinuteCount, minutes), (TweetHourCount, hours)):
+            conn.execute(model.__table__.insert(), [
+                {'track_term': YANG_TERM, 'bucket_start': bucket, 'tweet_count': count}
+                for bucket, count in counts.items()])
+        conn.execute(TweetDailyCount.__table__.insert(), [
+            {'created_date': day, 'track_term': YANG_TERM, 'tweet_count': count}
+            for day, count in days.items()])
+    return days.get(get_eastern_date_from_epoch(now_ms), 0)
+
+
+class Feeder:
+    """
+    Publishes one synthetic tweet at a time like the ingester's ChangeNotifier,
+    its text carries the publish time so clients can measure delivery latency
+    """
+    def __init__(self, database, bus, ring, rate, count, track_term=YANG_TERM):
+        self.database = database
+        self.bus = bus
+        self.ring = ring
+        self.rate = rate
+        self.count = count
+        self.track_term = track_term
+        # Daily count -> time it was published
+        self.published_at = {}
+
+    def run(self, stop):
+        from models import TweetDailyCount
+        from queries import get_eastern_date_today
+
+        table = TweetDailyCount.__table__
+        started = time.perf_counter()
+        n = 0
+        while not stop.is_set():
+            now = time.time()
+            self.count += 1
+            text = f"{TEXT_PREFIX}{now:.6f}"
+            last_id = self.ring.append(self.track_term, [text])
+            # Kept up to date too for streams that poll the db
+            with self.database.engine.begin() as conn:
+                conn.execute(table.update().where(
+                    (table.c.created_date == get_eastern_date_today())
+                    & (table.c.track_term == self.track_term)).values(tweet_count=self.count))
+            self.published_at[self.count] = now
+            self.bus.publish({'type': 'count', 'track_term': self.track_term, 'count': self.count})
+            self.bus.publish({'type': 'tweets', 'track_term': self.track_term,
+                              'last_id': last_id, 'texts': [text]})
+            n += 1
+            # Pace against the start time so sleep overshoot does not accumulate
+            time.sleep(max(started + n / self.rate - time.perf_counter(), 0))
+
+
+class Results:
+    def __init__(self, endpoints=ENDPOINTS):
+        self.held = 0
+        self.peak_held = 0
+        self.failed = 0
+        self.events = {path: 0 for path in STREAMS}
+        self.latencies_ms = {path: [] for path in STREAMS}
+        self.requests = {path: [] for path in endpoints}
+        self.statuses = {path: {} for path in endpoints}
+
+    def report(self, duration):
+        report = {
+            'connections_held': self.held,
+            'connections_peak': self.peak_held,
+            'connections_failed': self.failed,
+        }
+        for path in STREAMS:
+            report[path] = {
+                'events': self.events[path],
+                'latency_p50_ms': percentile(self.latencies_ms[path], 50),
+                'latency_p99_ms': percentile(self.latencies_ms[path], 99),
+                'latency_max_ms': percentile(self.latencies_ms[path], 100),
+            }
+        for path in ENDPOINTS:
+            if path not in self.requests:
+                report[path] = {'skipped': 'needs Postgres'}
+                continue
+            report[path] = {
+                'requests_per_sec': round(len(self.requests[path]) / duration, 1),
+                'p50_ms': percentile(self.requests[path], 50),
+                'p99_ms': percentile(self.requests[path], 99),
+                'statuses': self.statuses[path],
+            }
+        return report
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 1)
+
+
+async def sse_client(session, base_url, path, feeder, results, stop):
+    """Hold one stream open until stop, recording the delivery latency of new events"""
+    import aiohttp
+
+    connected_at = time.time()
+    try:
+        async with session.get(base_url + path, timeout=aiohttp.ClientTimeout(total=None)) as resp:
+            if resp.status != 200:
+                results.failed += 1
+                return
+            results.held += 1
+            results.peak_held = max(results.peak_held, results.held)
+            try:
+                data = []
+                while not stop.is_set():
+                    try:
+                        line = await asyncio.wait_for(resp.content.readline(), 1)
+                    except asyncio.TimeoutError:
+                        continue
+                    if not line:
+                        break
+                    line = line.decode().rstrip('\r\n')
+                    if line.startswith('data:'):
+                        data.append(line[5:])
+                    elif not line and data:
+                        _record_event(path, '\n'.join(data), connected_at, feeder, results)
+                        data = []
+            finally:
+                results.held -= 1
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+        results.failed += 1
+
+
+def _record_event(path, data, connected_at, feeder, results):
+    now = time.time()
+    results.events[path] += 1
+    published_at = None
+    if path == '/yangcount':
+        published_at = feeder.published_at.get(int(data))
+    else:
+        text = json.loads(data)
+        if text.startswith(TEXT_PREFIX):
+            published_at = float(text[len(TEXT_PREFIX):])
+    # Events from before the client connected are backlog, not delivery
+    if published_at is not None and published_at >= connected_at:
+        results.latencies_ms[path].append((now - published_at) * 1000)
+
+
+async def hammer(session, base_url, results, stop, rng):
+    """Request the cached endpoints back to back until stop"""
+    import aiohttp
+
+    while not stop.is_set():
+        path = rng.choice(list(results.requests))
+        t0 = time.perf_counter()
+        try:
+            async with session.get(base_url + path) as resp:
+                await resp.read()
+                status = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            status = type(e).__name__
+        results.requests[path].append((time.perf_counter() - t0) * 1000)
+        results.statuses[path][str(status)] = results.statuses[path].get(str(status), 0) + 1
+
+
+async def worker_stats(base_url, attempts):
+    """Latest /cache_stats of every worker reached in attempts fresh connections, by pid"""
+    import aiohttp
+
+    stats = {}
+    for _ in range(attempts):
+        connector = aiohttp.TCPConnector(force_close=True)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async with session.get(base_url + '/cache_stats') as resp:
+                worker = await resp.json()
+        stats[worker['pid']] = worker
+    return stats
+
+
+async def run_clients(base_url, args, feeder, stop, endpoints):
+    import aiohttp
+
+    results = Results(endpoints)
+    rng = random.Random(args.seed)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = []
+        for i in range(args.clients):
+            tasks.append(asyncio.ensure_future(
+                sse_client(session, base_url, STREAMS[i % 2], feeder, results, stop)))
+            # Ramp up instead of a thundering herd of connects
+            if i % 100 == 99:
+                await asyncio.sleep(0.1)
+        tasks += [asyncio.ensure_future(hammer(session, base_url, results, stop, rng))
+                  for _ in range(args.concurrency)]
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.duration:
+            await asyncio.sleep(0.5)
+        held = results.held
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    report = results.report(time.perf_counter() - started)
+    report['connections_held'] = held
+    return report
+
+
+def start_server(args, port):
+    """Serve application.app, under gunicorn or in this process with --fake-redis"""
+    if args.fake_redis:
+        from werkzeug.serving import make_server
+        from application import app
+
+        server = make_server('127.0.0.1', port, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server.shutdown
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--worker-class', args.worker_class,
+         '-w', str(args.workers), '-t', '99999', '-b', f"127.0.0.1:{port}", 'application:app'],
+        env=os.environ.copy())
+    return proc.terminate
+
+
+def wait_until_up(base_url, timeout=60):
+    import urllib.request
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/about', timeout=1)
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"The app did not come up at {base_url}")
+
+
+def run_load_test(args):
+    # Before anything reads settings, so the app uses the local db and Redis
+    os.environ['DATABASE_URL'] = args.db_url
+    os.environ['REDIS_URL'] = args.redis_url
+    if args.fake_redis:
+        import fakeredis
+        import redisclient
+        redisclient.r = fakeredis.FakeStrictRedis()
+        try:
+            redisclient.r.eval("return 1", 0)
+        except Exception as e:
+            # Without it no compute lock is ever released, every miss waits them out
+            raise SystemExit(f"--fake-redis needs Lua scripting, pip install 'fakeredis[lua]': {e}")
+
+    from models import Database
+    from notify import get_change_bus
+    from tweet_ring import get_tweet_ring
+
+    database = Database(db_url=args.db_url)
+    count = populate(database, args.tweets, seed=args.seed)
+    base_url = f"http://127.0.0.1:{args.port}"
+    stop_server = start_server(args, args.port)
+    try:
+        wait_until_up(base_url)
+        loop = asyncio.get_event_loop()
+        attempts = args.workers * 10
+        before = loop.run_until_complete(worker_stats(base_url, attempts))
+
+        feeder = Feeder(database, get_change_bus(), get_tweet_ring(), args.tweet_rate, count)
+        stop = threading.Event()
+        threading.Thread(target=feeder.run, args=(stop,), daemon=True).start()
+        t0 = time.perf_counter()
+        endpoints = ENDPOINTS if database.engine.dialect.name == 'postgresql' else [
+            path for path in ENDPOINTS if path not in POSTGRES_ENDPOINTS]
+        report = loop.run_until_complete(run_clients(base_url, args, feeder, stop, endpoints))
+        elapsed = time.perf_counter() - t0
+
+        after = loop.run_until_complete(worker_stats(base_url, attempts))
+    finally:
+        stop_server()
+
+    queries = sum(stats['db_queries'] - before.get(pid, {}).get('db_queries', 0)
+                  for pid, stats in after.items())
+    report.update({
+        'seconds': round(elapsed, 1),
+        'db_queries_per_sec': round(queries / elapsed, 2),
+        'workers': {pid: {'rss_kb': stats['rss_kb'], 'db_queries': stats['db_queries']}
+                    for pid, stats in after.items()},
+        'workers_reached': f"{len(after)} of {1 if args.fake_redis else args.workers}",
+    })
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the SSE streams and chart endpoints.")
+    parser.add_argument('--db-url', default='sqlite:///bench_load.sqlite',
+                        help="Throwaway SQLite or Postgres url, its tweets and counts are replaced")
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15',
+                        help="Local Redis the app, the feeder and the cache share")
+    parser.add_argument('--fake-redis', action='store_true',
+                        help="Use fakeredis and serve the app in this process")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--worker-class', default='gevent', help="gunicorn worker class")
+    parser.add_argument('--port', type=int, default=7811)
+    parser.add_argument('--clients', type=int, default=500,
+                        help="SSE clients, split between /yangcount and /latest_tweets")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="Concurrent requests to the chart and wordcloud endpoints")
+    parser.add_argument('--tweet-rate', type=float, default=20, help="Tweets published per second")
+    parser.add_argument('--tweets', type=int, default=20000, help="Tweets in the db")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds of load")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(json.dumps(run_load_test(args), indent=2))
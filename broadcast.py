@@ -0,0 +1,155 @@
+"""
+Fan-out of server-sent event streams
+
+One Broadcaster per stream and process computes the stream's message once per
+tick and puts it on every subscriber's bounded queue, so the database load of
+a stream is one query per tick however many clients are connected. A client
+whose queue is full is dropped rather than slowing the others down, the
+browser's EventSource reconnects on its own.
+
+Messages can also be pushed, e.g. from change events: the producer then sends
+the latest pushed message at most once per min_interval, however many were
+pushed in between, and only calls produce when nothing was pushed for a whole
+interval, which also keeps idle connections alive.
+
+The producer thread only runs while there are subscribers. Under gunicorn's
+gevent worker the thread and queues are monkey-patched into greenlets.
+"""
+import logging
+import queue
+import threading
+import time
+
+from settings import SSE_TICK_SECONDS, SSE_CLIENT_QUEUE_SIZE
+
+
+# pylint: disable=logging-fstring-interpolation
+class Broadcaster:
+    def __init__(self, name, produce, interval=SSE_TICK_SECONDS, queue_size=SSE_CLIENT_QUEUE_SIZE,
+                 min_interval=0):
+        """
+        Arguments:
+            name {str} -- Name of the stream, for logs and stats
+            produce {callable} -- Returns the next message, or None to skip a tick. A message
+                is whatever the clients' streams expect, usually the SSE text
+
+        Keyword Arguments:
+            interval {float} -- Seconds between two messages if none is pushed
+            queue_size {int} -- Messages buffered per client before it is dropped
+            min_interval {float} -- Min seconds between two messages, pushes in between coalesce
+        """
+        self.name = name
+        self.produce = produce
+        self.interval = interval
+        self.queue_size = queue_size
+        self.min_interval = min_interval
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_message = None
+        # Latest pushed message not sent yet, wakes up the producer
+        self.pending = None
+        self.wake = threading.Event()
+        # Counters
+        self.ticks = 0
+        self.pushed = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def subscribe(self):
+        """New client queue, primed with the last message so a client does not wait a tick"""
+        q = queue.Queue(maxsize=self.queue_size)
+        if self.last_message is not None:
+            q.put_nowait(self.last_message)
+        with self.lock:
+            self.subscribers.add(q)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name=f"broadcast-{self.name}", daemon=True)
+                self.thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def stream(self):
+        """Generator of a client's messages, ends if the client was dropped"""
+        q = self.subscribe()
+        try:
+            while True:
+                message = q.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(q)
+
+    def push(self, message):
+        """Send message with the next tick instead of producing one, replacing an unsent push"""
+        self.pending = message
+        self.pushed += 1
+        self.wake.set()
+
+    def notify(self):
+        """Produce a message with the next tick instead of waiting for the interval"""
+        self.pushed += 1
+        self.wake.set()
+
+    def publish(self, message):
+        """Put message on every client queue, dropping the clients that are full"""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                self._drop(q)
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'ticks': self.ticks,
+            'pushed': self.pushed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+
+    def _drop(self, q):
+        self.unsubscribe(q)
+        # Replace what it did not read with the end of stream marker
+        with q.mutex:
+            q.queue.clear()
+        q.put_nowait(None)
+        self.dropped += 1
+        logging.warning(f"Broadcast {self.name}: dropped a slow client")
+
+    def _run(self):
+        # A new producer sends a message right away, then waits for pushes or the interval
+        wait = False
+        while True:
+            if wait:
+                self.wake.wait(self.interval)
+            wait = True
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+            self.wake.clear()
+            message, self.pending = self.pending, None
+            if message is None:
+                message = self._produce()
+            if message is not None:
+                self.last_message = message
+                self.publish(message)
+            self.ticks += 1
+            if self.min_interval:
+                time.sleep(self.min_interval)
+
+    def _produce(self):
+        try:
+            return self.produce()
+        except Exception as e:
+            logging.error(f"Broadcast {self.name}: producing a message failed: {e}")
+            self.errors += 1
+            return None
@@ -0,0 +1,409 @@
+"""
+Namespaced Redis cache for computed endpoint payloads
+
+Keys are derived from (endpoint, params, time bucket) under a namespace and
+a version: yangsentiment:v1:chart:chart_type=72hr_at_1hr:5276160. The bucket
+is the current time divided by the endpoint's refresh interval, so a new
+bucket starts a new entry, and each entry expires one refresh interval
+after its bucket ends. Each entry is a hash {v: payload, ts: generation time}.
+
+Every key written is also recorded in a sorted set scored by its expiry.
+When the namespace holds more than max_entries, the entries closest to
+expiry are deleted. Nothing outside the namespace is ever touched.
+
+A miss is computed once across all workers: the first one to take the
+short-lived <key>:lock (SET NX) computes, the others are served the previous
+bucket's entry, or wait for the new one if there is none. If the lock is
+released without an entry, its compute failed, and the next waiter to take
+the lock computes instead.
+
+In precompute mode, the refresher alone computes: publish() writes each
+result to a stable key, <endpoint>:<params>:latest, with its generation time,
+and web workers only ever read that key with latest(), however old it is.
+
+Payloads are stored already encoded (JSON text, PNG bytes) together with a
+content hash, field h, which endpoints send as a strong ETag.
+
+In front of Redis, each process keeps a small LRU of payloads. An entry is
+served without any round-trip for l1_seconds, then revalidated by fetching
+only the entry's generation time, its version stamp: the payload is fetched
+again only if the version changed.
+"""
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+from redis.exceptions import RedisError
+
+from redisclient import r
+from settings import (
+    CACHE_NAMESPACE, CACHE_VERSION, CACHE_MAX_ENTRIES, CACHE_LOCK_SECONDS,
+    CACHE_L1_ENTRIES, CACHE_L1_SECONDS
+)
+
+
+# Delete the lock only if it is still ours, it may have expired and been taken over
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+# An encoded payload with its content hash, when it was generated and until when it
+# may be cached downstream: the end of its bucket, or right away if it is stale
+CacheEntry = namedtuple('CacheEntry', ['value', 'etag', 'generated_at', 'expires_at'])
+
+
+def content_hash(value):
+    """Hex digest of payload bytes, stable across workers and buckets"""
+    return hashlib.sha1(value).hexdigest()
+
+
+class LocalCache:
+    """In-process LRU of (payload, version, etag) with a per entry time to revalidation"""
+    def __init__(self, max_entries=CACHE_L1_ENTRIES, ttl_seconds=CACHE_L1_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (payload, version, etag, fresh) or None, fresh is False once due for revalidation"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        value, version, etag, expires_at = entry
+        return value, version, etag, time.monotonic() < expires_at
+
+    def put(self, key, value, version, etag):
+        with self.lock:
+            self.entries[key] = (value, version, etag, time.monotonic() + self.ttl_seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            'l1_hits': self.hits,
+            'l1_misses': self.misses,
+            'l1_revalidated': self.revalidated,
+            'l1_evictions': self.evictions,
+            'l1_entries': len(self.entries),
+        }
+
+
+# pylint: disable=logging-fstring-interpolation
+class Cache:
+    def __init__(self, client, namespace=CACHE_NAMESPACE, version=CACHE_VERSION,
+                 max_entries=CACHE_MAX_ENTRIES, lock_seconds=CACHE_LOCK_SECONDS,
+                 poll_seconds=0.05, local=None):
+        """
+        Arguments:
+            client {redis.Redis} -- Redis client
+
+        Keyword Arguments:
+            namespace {str} -- Prefix of every key written
+            version {int} -- Part of every key, bump it to drop every entry
+            max_entries {int} -- Max entries in the namespace before eviction
+            lock_seconds {float} -- Expiry of a compute lock, and how long waiters wait
+            poll_seconds {float} -- How often waiters check for the computed entry
+            local {LocalCache} -- In-process cache in front of Redis, None for a new one
+        """
+        self.client = client
+        self.prefix = f"{namespace}:v{version}"
+        self.index_key = f"{self.prefix}:_index"
+        self.max_entries = max_entries
+        self.lock_seconds = lock_seconds
+        self.poll_seconds = poll_seconds
+        self.local = local or LocalCache()
+        # Counters, per process
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        # Misses left to another worker's computation, and how they were served
+        self.coalesced = 0
+        self.stale_served = 0
+        self.lock_timeouts = 0
+        self.lock_takeovers = 0
+
+    def key(self, endpoint, params=None, bucket=None):
+        """Cache key of an endpoint result, params is a dict of what the result depends on"""
+        parts = [self.prefix, endpoint]
+        if params:
+            parts.append('&'.join(f"{k}={params[k]}" for k in sorted(params)))
+        if bucket is not None:
+            parts.append(str(bucket))
+        return ':'.join(parts)
+
+    def get(self, key):
+        """Return (payload bytes, generation time, content hash) or None on a miss"""
+        try:
+            value, ts, etag = self.client.hmget(key, 'v', 'ts', 'h')
+        except RedisError as e:
+            logging.error(f"Cache GET failed for {key}: {e}")
+            self.errors += 1
+            return None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value, float(ts), etag.decode()
+
+    def set(self, key, value, ttl, generated_at=None):
+        """
+        Store a payload for ttl seconds, evicting the namespace's oldest entries if full.
+        Returns the stored (payload bytes, content hash).
+        """
+        if isinstance(value, str):
+            value = value.encode()
+        etag = content_hash(value)
+        now = time.time()
+        expires_at = now + ttl
+        generated_at = generated_at or now
+        self.local.put(key, value, generated_at, etag)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hset(key, mapping={'v': value, 'ts': generated_at, 'h': etag})
+            pipe.expire(key, int(ttl))
+            pipe.zadd(self.index_key, {key: expires_at})
+            # Entries that expired by TTL are gone already, only forget them
+            pipe.zremrangebyscore(self.index_key, '-inf', now)
+            pipe.zcard(self.index_key)
+            size = pipe.execute()[-1]
+            if size > self.max_entries:
+                self._evict(size - self.max_entries)
+        except RedisError as e:
+            logging.error(f"Cache SET failed for {key}: {e}")
+            self.errors += 1
+        return value, etag
+
+    def get_or_compute(self, endpoint, compute, refresh_seconds, params=None,
+                       dumps=None, loads=None):
+        """
+        Return the cached result of endpoint for the current refresh bucket, or
+        compute, cache and return it.
+
+        Arguments:
+            endpoint {str} -- Name of the cached result
+            compute {callable} -- Computes the result on a miss
+            refresh_seconds {int} -- Refresh interval, the bucket size and TTL
+
+        Keyword Arguments:
+            params {dict} -- What the result depends on besides time
+            dumps {callable} -- Result to str or bytes, identity by default
+            loads {callable} -- Bytes to result, identity by default
+        """
+        value = self.get_entry(endpoint, compute, refresh_seconds, params, dumps).value
+        return loads(value) if loads else value
+
+    def get_entry(self, endpoint, compute, refresh_seconds, params=None, dumps=None):
+        """
+        Like get_or_compute, but return the encoded CacheEntry, to be sent as is
+        with its content hash as the ETag.
+        """
+        now = time.time()
+        bucket = int(now // refresh_seconds)
+        expires_at = (bucket + 1) * refresh_seconds
+        key = self.key(endpoint, params, bucket)
+        cached = self._lookup(key)
+        if cached is not None:
+            value, version, etag = cached
+            return CacheEntry(value, etag, version, expires_at)
+        logging.info(f"Cache MISS: {key}")
+        # Entries live through the next bucket too, to be served while it is computed
+        ttl = (bucket + 2) * refresh_seconds - now
+        value, etag, generated_at = self._compute_once(
+            key, self.key(endpoint, params, bucket - 1), compute, ttl, dumps)
+        if generated_at < bucket * refresh_seconds:
+            # The previous bucket's entry, served while this one is computed: it must
+            # not be cached downstream until this bucket ends, only revalidated
+            expires_at = now
+        return CacheEntry(value, etag, generated_at, expires_at)
+
+    def latest(self, endpoint, refresh_seconds, params=None):
+        """
+        Last published CacheEntry of endpoint however old it is, None if it was never
+        published. Never computes, expires_at is when the refresher is due to replace it.
+        """
+        key = self.key(endpoint, params, 'latest')
+        cached = self._lookup(key)
+        if cached is None:
+            logging.warning(f"Cache has no published entry: {key}")
+            return None
+        value, version, etag = cached
+        return CacheEntry(value, etag, version, (version // refresh_seconds + 1) * refresh_seconds)
+
+    def publish(self, endpoint, compute, refresh_seconds, params=None, dumps=None, force=False):
+        """
+        Compute endpoint and write it to its stable key, unless the published entry
+        was generated in the current refresh bucket already. Returns the CacheEntry.
+        """
+        key = self.key(endpoint, params, 'latest')
+        now = time.time()
+        bucket = int(now // refresh_seconds)
+        if not force:
+            current = self._peek(key)
+            if current is not None and int(current[2] // refresh_seconds) == bucket:
+                value, etag, generated_at = current
+                return CacheEntry(value, etag, generated_at, (bucket + 1) * refresh_seconds)
+        result = compute()
+        value = dumps(result) if dumps else result
+        if isinstance(value, str):
+            value = value.encode()
+        etag = content_hash(value)
+        # No TTL and no eviction, the last good value is served until it is replaced
+        try:
+            self.client.hset(key, mapping={'v': value, 'ts': now, 'h': etag})
+        except RedisError as e:
+            logging.error(f"Cache PUBLISH failed for {key}: {e}")
+            self.errors += 1
+        logging.info(f"Cache PUBLISHED: {key}")
+        return CacheEntry(value, etag, now, (bucket + 1) * refresh_seconds)
+
+    def stats(self):
+        return {
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+            'cache_evictions': self.evictions,
+            'cache_errors': self.errors,
+            'cache_coalesced': self.coalesced,
+            'cache_stale_served': self.stale_served,
+            'cache_lock_timeouts': self.lock_timeouts,
+            'cache_lock_takeovers': self.lock_takeovers,
+            **self.local.stats(),
+        }
+
+    def _lookup(self, key):
+        """(payload, version, etag) from the local cache or Redis, None on a miss"""
+        local = self.local.get(key)
+        if local is not None:
+            value, version, etag, fresh = local
+            if fresh or self._revalidate(key, value, version, etag):
+                self.local.hits += 1
+                return value, version, etag
+        cached = self.get(key)
+        if cached is not None:
+            logging.info(f"Cache HIT: {key}")
+            value, version, etag = cached
+            self.local.put(key, value, version, etag)
+        return cached
+
+    def _revalidate(self, key, value, version, etag):
+        """Keep serving a local payload if Redis still has the same version of it"""
+        try:
+            current = self.client.hget(key, 'ts')
+        except RedisError as e:
+            logging.error(f"Cache GET failed for {key}: {e}")
+            self.errors += 1
+            return False
+        if current is None or float(current) != version:
+            return False
+        self.local.put(key, value, version, etag)
+        self.local.revalidated += 1
+        return True
+
+    def _compute_once(self, key, previous_key, compute, ttl, dumps):
+        """
+        Compute a missed entry under its lock, or let the lock holder compute it.
+        Returns (payload bytes, content hash, generation time).
+        """
+        lock_key = f"{key}:lock"
+        token = uuid.uuid4().hex
+        if self._acquire(lock_key, token):
+            try:
+                return self._compute_and_set(key, compute, ttl, dumps)
+            finally:
+                self._release(lock_key, token)
+
+        self.coalesced += 1
+        entry = self._peek(previous_key)
+        if entry is not None:
+            logging.info(f"Cache STALE while computing: {key}")
+            self.stale_served += 1
+            return entry
+        deadline = time.monotonic() + self.lock_seconds
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_seconds)
+            entry = self._peek(key)
+            if entry is not None:
+                return entry
+            # The lock was released without an entry, the holder's compute failed:
+            # one waiter takes over, the others keep waiting for it
+            if self._acquire(lock_key, token):
+                self.lock_takeovers += 1
+                try:
+                    # Written just before the release
+                    entry = self._peek(key)
+                    if entry is not None:
+                        return entry
+                    return self._compute_and_set(key, compute, ttl, dumps)
+                finally:
+                    self._release(lock_key, token)
+        # The lock holder died or is too slow, compute without the lock
+        logging.warning(f"Cache lock wait timed out: {key}")
+        self.lock_timeouts += 1
+        return self._compute_and_set(key, compute, ttl, dumps)
+
+    def _compute_and_set(self, key, compute, ttl, dumps):
+        result = compute()
+        generated_at = time.time()
+        value, etag = self.set(key, dumps(result) if dumps else result, ttl, generated_at)
+        return value, etag, generated_at
+
+    def _peek(self, key):
+        """(payload, content hash, generation time) of key without counting a hit or a miss"""
+        try:
+            value, ts, etag = self.client.hmget(key, 'v', 'ts', 'h')
+        except RedisError as e:
+            logging.error(f"Cache GET failed for {key}: {e}")
+            self.errors += 1
+            return None
+        if value is None:
+            return None
+        return value, etag.decode(), float(ts)
+
+    def _acquire(self, lock_key, token):
+        """Take a compute lock, True if Redis fails too, computing then goes unlocked"""
+        try:
+            return bool(self.client.set(
+                lock_key, token, nx=True, px=int(self.lock_seconds * 1000)))
+        except RedisError as e:
+            logging.error(f"Cache lock failed for {lock_key}: {e}")
+            self.errors += 1
+            return True
+
+    def _release(self, lock_key, token):
+        try:
+            self.client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except RedisError as e:
+            # It expires on its own
+            logging.error(f"Cache lock release failed for {lock_key}: {e}")
+
+    def _evict(self, n):
+        keys = self.client.zrange(self.index_key, 0, n - 1)
+        if not keys:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        pipe.delete(*keys)
+        pipe.zrem(self.index_key, *keys)
+        pipe.execute()
+        self.evictions += len(keys)
+        logging.info(f"Cache evicted {len(keys)} entries from {self.prefix}")
+
+
+cache = Cache(r)
@@ -23,7 +23,7 @@ class BaseConfig:
         if filename.endswith('.json'):
             reader = json.load
         elif filename.endswith('.yml') or filename.endswith('.yaml'):
-            reader = yaml.load
+            reader = yaml.safe_load
 
         with open(filename) as openfile:
             return cls.from_dict(reader(openfile))
@@ -1,61 +1,117 @@
 import logging
-import time
+import threading
 import json
-import pickle
 from datetime import datetime
 from io import BytesIO
 from pytz import timezone
-from sqlalchemy.sql import text
+from sqlalchemy import event
 
+from broadcast import Broadcaster
 from constants import YANG_TERM
 from learning.regression import linear_regression
-from location_utils import map_raw_to_states
-from redisclient import r as cache
-from models import Tweet, Price, Database
-from nlp.wordcloud_gen import generate_wordcloud
+from cache import cache
+from models import Price, Database
+from notify import get_change_bus
+from tweet_ring import get_tweet_ring
+from nlp.wordcloud_gen import generate_wordcloud_from_tokens
 from queries import (
-    query_last_n, query_tweet_count, get_eastern_date_today,
+    query_tweet_count, get_eastern_date_today,
     query_count_nhr_at_xmin, query_count_14d_at_1d, query_retweet_count,
-    query_count_group_by_location, query_all_tweets
+    query_count_group_by_state, query_all_tweets, query_stats
+)
+from settings import (
+    PORT, DB_USER, DB_PASSWORD, RDS_POSTGRES_ENDPOINT, DB_NAME, DATABASE_URL, CACHE_PRECOMPUTE,
+    SSE_PUSH, SSE_PUSH_POLL_SECONDS, SSE_COALESCE_SECONDS
 )
-from settings import PORT, DB_USER, DB_PASSWORD, RDS_POSTGRES_ENDPOINT, DB_NAME
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 
 class DataJob:
-    db = Database(env='prod')
+    db = Database(env='prod', db_url=DATABASE_URL)
     Session = scoped_session(sessionmaker(bind=db.engine))
     Session.subtransactions = True
+    # Statements this process sent to the db through SQLAlchemy, served at /cache_stats
+    queries = 0
+
+    @classmethod
+    def query_count(cls):
+        """Statements sent to the db, prepared queries run on the DBAPI cursor included"""
+        return cls.queries + sum(stats['calls'] for stats in query_stats().values())
+
+
+@event.listens_for(DataJob.db.engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    DataJob.queries += 1
+
+
+# Seconds a cached result is served for, matching the granularity of its query
+REFRESH_SECONDS = {
+    'top_retweets': 30 * 60,
+    '72hr_at_1hr': 5 * 60,
+    '14d_at_1d': 60 * 60,
+    '72h_for_loc': 60 * 60,
+    'wordcloud': 60 * 60,
+}
 
 
 class ScheduledJob(DataJob):
 
+    @classmethod
+    def _cached(cls, endpoint, compute, params=None, dumps=None, refresh=False, key=None):
+        """
+        CacheEntry of endpoint. In precompute mode, web requests only read the last
+        published value and the refresher, refresh=True, is the only one computing.
+        """
+        refresh_seconds = REFRESH_SECONDS[key or endpoint]
+        if refresh:
+            return cache.publish(endpoint, compute, refresh_seconds, params, dumps)
+        if CACHE_PRECOMPUTE:
+            return cache.latest(endpoint, refresh_seconds, params)
+        return cache.get_entry(endpoint, compute, refresh_seconds, params, dumps)
+
+    @classmethod
+    def precompute(cls):
+        """Publish every precomputed result whose refresh interval has passed"""
+        jobs = [
+            lambda: cls.tweets_chart_request(chart_type='14d_at_1d', refresh=True),
+            lambda: cls.tweets_chart_request(chart_type='72hr_at_1hr', refresh=True),
+            lambda: cls.tweets_chart_request(chart_type='72h_for_loc', refresh=True),
+            lambda: cls.get_top_retweets(refresh=True),
+            lambda: cls.get_wordcloud(refresh=True),
+        ]
+        for job in jobs:
+            try:
+                job()
+            except Exception as e:
+                # The last good value keeps being served
+                logging.error(f"Precompute failed: {e}")
+            finally:
+                cls.Session.close()
+
     # pylint: disable=logging-fstring-interpolation
     @classmethod
-    def get_top_retweets(cls):
-        """Top retweeted tweet ids, refresh every 30min based on the query granularity"""
+    def get_top_retweets(cls, top_n=20, refresh=False):
+        """
+        Top retweeted tweet ids as a CacheEntry of JSON text, refresh every 30min
+        based on the query granularity
+        """
         colname = "retweeted_status_id_str"
-        # Return top 10 retweeted tweet ids
-        query = query_retweet_count(colname, top_n=20)
-        top_retweet_ids = []
-
-        if not cache.get(query):
-            logging.info(f"Cache MISS: {query}")
-            top_retweet_ids_raw = cls.Session.query(colname).from_statement(text(query)).all()
-            top_retweet_ids = [tup[0] for tup in top_retweet_ids_raw]
+
+        def compute():
+            query = query_retweet_count(colname, top_n=top_n)
+            top_retweet_ids_raw = query.execute(cls.Session.connection())
             cls.Session.commit()
-            cache.set(query, json.dumps(top_retweet_ids))
-        else:
-            logging.info(f"Cache HIT: {query}")
-            top_retweet_ids = json.loads(cache.get(query))
+            return [tup[0] for tup in top_retweet_ids_raw]
 
-        return top_retweet_ids
+        return cls._cached(
+            'top_retweets', compute, params={'top_n': top_n}, dumps=json.dumps, refresh=refresh)
 
 
     """Charts"""
 
     @classmethod
-    def tweets_chart_request(cls, chart_type, track_term=YANG_TERM):
+    def tweets_chart_request(cls, chart_type, track_term=YANG_TERM, refresh=False):
+        """Chart data as a CacheEntry of JSON text, None if it could not be computed"""
         count_colname = 'count'
         interval_colname = 'interval'
         query = None
@@ -70,120 +126,216 @@ class ScheduledJob(DataJob):
             # logging.info(f"[72hr_at_1hr SQL]: {query}\n\n")
         elif chart_type == '72h_for_loc':
             interval_colname = 'location'
-            query = query_count_group_by_location(
+            # user_state is resolved at ingest time, no per-request location mapping
+            query = query_count_group_by_state(
                 track_term, colname=interval_colname)
             # logging.info(f"[72h_for_loc SQL]: {query}\n\n")
         else:
             raise Exception(f"chart_type is not supported: {chart_type} ")
 
-        # Query db, postprocess, cache.set(query, postprocessed)
-        resp_dict = {}
-        try:
-            if not cache.get(query):
-                logging.info(f"Cache MISS: {query}")
-                counts_raw = cls.Session.query(
-                    interval_colname, count_colname).from_statement(text(query)).all()
-                cls.Session.commit()
-                resp_dict = _postprocess_chart_data(counts_raw, chart_type)
-                cache.set(query, json.dumps(resp_dict))
-            else:
-                logging.info(f"Cache HIT: {query}")
-                resp_dict = json.loads(cache.get(query))
+        def compute():
+            # Rows are (interval, count)
+            counts_raw = query.execute(cls.Session.connection())
+            cls.Session.commit()
             # Deploy the following line to staging if there's a date discrepancy at remote
             # logging.info(f"[{chart_type} Query RESULT]: {counts_raw}\n\n")
+            return _postprocess_chart_data(counts_raw, chart_type)
 
-            return resp_dict
+        try:
+            return cls._cached(
+                'chart', compute, params={'chart_type': chart_type, 'track_term': track_term},
+                dumps=json.dumps, refresh=refresh, key=chart_type)
         except Exception as e:
             logging.error(
                 f"An unexpected exception occurred during {chart_type} chart request: {e}\n")
         finally:
-            # Each run is 5min, clear cache every 100 runs -> ~8hrs to avoid strange
-            # stale result for groupby date charts
-            if len(cache.keys()) >= 100:
-                cache.flushall()
             cls.Session.close()
 
     """Sentiment"""
 
     @classmethod
-    def get_wordcloud(cls):
+    def get_wordcloud(cls, refresh=False):
         """
-        Get the word cloud for tweets in the last 6 hours
+        Get the word cloud for tweets in the last 6 hours, as a CacheEntry of PNG bytes
         """
         # Query tweets in the last 6 hours, refresh at 1 hour
         # Cache the generated image
-        query = query_all_tweets()
-
-        if not cache.get(query):
-            logging.info(f"Cache MISS: {query}")
-            tweets = cls.Session.query('tweet_text').from_statement(text(query)).all()
+        def compute():
+            query = query_all_tweets(colname='tweet_tokens')
+            # Tokens are computed at ingest time, only counting is left to do here
+            tweet_tokens = query.execute(cls.Session.connection())
             cls.Session.commit()
             logging.info(f"Wordcloud query completed.")
-            wc = generate_wordcloud(tweets)
+            wc = generate_wordcloud_from_tokens(tweet_tokens)
             logging.info(f"Wordcloud generation completed.")
             img = BytesIO()
             wc.to_image().save(img, 'PNG')
-            imgp = pickle.dumps(img)
-            cache.set(query, imgp)
-        else:
-            logging.info(f"Cache HIT: {query}")
-            img = pickle.loads(cache.get(query))
+            return img.getvalue()
 
-        return img
+        return cls._cached('wordcloud', compute, refresh=refresh)
 
 
 class StreamJob(DataJob):
+    """
+    SSE streams. Each message is computed once per tick and process by a Broadcaster
+    and fanned out to every connected client. With SSE_PUSH, messages are built from
+    the ingester's change events instead, the database is only polled as a fallback.
+    """
+    broadcasters = {}
+    broadcasters_lock = threading.Lock()
+    subscribed = False
+    # track_term -> id of the last latest tweets ring entry broadcast
+    latest_ids = {}
+
     @classmethod
     def count_stream(cls, track_term):
-        while True:
-            try:
-                query = query_tweet_count(
-                    track_term=track_term, created_date=get_eastern_date_today())
-                # Note: if this returns empty result, log the query on server to check
-                # if time in the query is wrong. Server time and local time are different
-                # so it can create unexpected bugs
-                count = cls.Session.query(
-                    'tweet_count').from_statement(text(query)).first()
-                if count:
-                    yield f"data:{str(count[0])}\n\n"
-                else:
-                    logging.error(
-                        f"Tweet count stream returned empty result unexpectedly.")
-                cls.Session.commit()
-                time.sleep(5)
-            except Exception as e:
-                logging.error(
-                    f"An unexpected exception occurred during streaming: {e}\n")
-            finally:
-                cls.Session.close()
+        return cls._broadcaster(
+            f"count:{track_term}", lambda: cls._count_message(track_term)).stream()
 
     @classmethod
-    def latest_tweet_stream(cls, n):
-        while True:
-            try:
-                query = query_last_n(Tweet.__tablename__, n, track_term=YANG_TERM)
-
-                latest_tweet_objects = cls.Session.query(Tweet).from_statement(
-                    text(query))
-                if latest_tweet_objects:
-                    latest_tweets_objs_list = latest_tweet_objects.all()
-                    latest_tweets_list = [
-                        obj.tweet_text for obj in latest_tweets_objs_list]
-                    yield f"data:{json.dumps(latest_tweets_list)}\n\n"
+    def latest_tweet_stream(cls, n, last_event_id=None, track_term=YANG_TERM):
+        """
+        Latest tweets as one SSE event each, tagged with its id in the latest tweets
+        ring. A client first gets the latest n, or what it missed after last_event_id,
+        read from the ring, then only new tweets as they are broadcast.
+        """
+        ring = get_tweet_ring()
+        n = max(min(n, ring.size), 1)
+        broadcaster = cls._broadcaster(
+            f"latest_tweets:{track_term}", lambda: cls._latest_tweets_delta(track_term))
+        # Subscribed before reading the ring, so nothing is missed in between
+        q = broadcaster.subscribe()
+        try:
+            newest = ring.latest(track_term, 1)
+            # An id past the newest one is from before the ring was reset
+            if last_event_id is not None and newest and newest[0][0] >= last_event_id:
+                backlog = ring.since(track_term, last_event_id)
+                # The client has everything up to there, even if the backlog is empty
+                last_id = last_event_id
+            else:
+                backlog = ring.latest(track_term, n)
+                last_id = 0
+            if backlog:
+                last_id = backlog[-1][0]
+                yield _sse_tweet_events(backlog)
+            elif not newest:
+                # Nothing in the ring yet, e.g. right after a deploy
+                message = cls._latest_tweets_message(n, track_term)
+                if message:
+                    yield message
+            while True:
+                entries = q.get()
+                if entries is None:
+                    return
+                if isinstance(entries, str):
+                    yield entries
+                    continue
+                entries = [entry for entry in entries if entry[0] > last_id]
+                if entries:
+                    last_id = entries[-1][0]
+                    yield _sse_tweet_events(entries)
+        finally:
+            broadcaster.unsubscribe(q)
+
+    @classmethod
+    def stats(cls):
+        return {name: b.stats() for name, b in cls.broadcasters.items()}
+
+    @classmethod
+    def _broadcaster(cls, name, produce):
+        with cls.broadcasters_lock:
+            if name not in cls.broadcasters:
+                if SSE_PUSH:
+                    cls.broadcasters[name] = Broadcaster(
+                        name, produce, interval=SSE_PUSH_POLL_SECONDS,
+                        min_interval=SSE_COALESCE_SECONDS)
+                    if not cls.subscribed:
+                        get_change_bus().subscribe(cls._on_change_event)
+                        cls.subscribed = True
                 else:
-                    logging.error(
-                        f"Lastest tweets stream returned empty result unexpectedly.")
-                cls.Session.commit()
-                time.sleep(5)
-            except Exception as e:
-                logging.error(
-                    f"An exception occurred during query to RDS Postgres: {e}\n")
-            finally:
-                cls.Session.close()
+                    cls.broadcasters[name] = Broadcaster(name, produce)
+            return cls.broadcasters[name]
+
+    @classmethod
+    def _on_change_event(cls, event):
+        track_term = event.get('track_term')
+        if event['type'] == 'count':
+            broadcaster = cls.broadcasters.get(f"count:{track_term}")
+            if broadcaster is not None:
+                broadcaster.push(f"data:{event['count']}\n\n")
+        elif event['type'] == 'tweets':
+            broadcaster = cls.broadcasters.get(f"latest_tweets:{track_term}")
+            if broadcaster is not None:
+                # The new entries are read from the ring, once per coalesced burst
+                broadcaster.notify()
+
+    @classmethod
+    def _count_message(cls, track_term):
+        try:
+            query = query_tweet_count(
+                track_term=track_term, created_date=get_eastern_date_today())
+            # Note: if this returns empty result, log the query on server to check
+            # if time in the query is wrong. Server time and local time are different
+            # so it can create unexpected bugs
+            rows = query.execute(cls.Session.connection())
+            cls.Session.commit()
+            count = rows[0] if rows else None
+            if count:
+                return f"data:{str(count[0])}\n\n"
+            logging.error(
+                f"Tweet count stream returned empty result unexpectedly.")
+        except Exception as e:
+            logging.error(
+                f"An unexpected exception occurred during streaming: {e}\n")
+        finally:
+            cls.Session.close()
+        return None
+
+    @classmethod
+    def _latest_tweets_delta(cls, track_term):
+        """Ring entries added since the last broadcast, or a heartbeat if there are none"""
+        ring = get_tweet_ring()
+        last_id = cls.latest_ids.get(track_term)
+        entries = ring.since(track_term, last_id) if last_id is not None else []
+        if entries:
+            cls.latest_ids[track_term] = entries[-1][0]
+            return entries
+        newest = ring.latest(track_term, 1)
+        # First tick, or the ring was reset: start from its newest entry
+        if last_id is None or (newest and newest[0][0] < last_id):
+            cls.latest_ids[track_term] = newest[0][0] if newest else 0
+        return SSE_HEARTBEAT
+
+    @classmethod
+    def _latest_tweets_message(cls, n, track_term=YANG_TERM):
+        """Latest n tweets from the database as SSE events without ids"""
+        try:
+            # Only tweet_text is sent, fetch just that column as tuples
+            latest_tweets = cls.db.fetch_latest_tweets(
+                track_term, columns=('tweet_text',), n=n)
+            if latest_tweets:
+                # Newest first from the db, sent oldest first like the ring
+                return ''.join(
+                    f"data:{json.dumps(tweet_text)}\n\n" for tweet_text, in reversed(latest_tweets))
+            logging.error(
+                f"Lastest tweets stream returned empty result unexpectedly.")
+        except Exception as e:
+            logging.error(
+                f"An exception occurred during query to RDS Postgres: {e}\n")
+        return None
 
 
 """Helpers"""
 
+# SSE comment, keeps idle connections open without firing onmessage
+SSE_HEARTBEAT = ":\n\n"
+
+
+def _sse_tweet_events(entries):
+    """One SSE event per (id, text), the text JSON encoded to keep it on one data line"""
+    return ''.join(f"id:{tweet_id}\ndata:{json.dumps(text)}\n\n" for tweet_id, text in entries)
+
+
 
 def _convert_counts_interval_data(counts_raw_list):
     timestamps = []
@@ -204,18 +356,13 @@ def _convert_counts_interval_data(counts_raw_list):
     return timestamps, counts_data
 
 
-def _get_counts_by_states(counts_raw):
-    state_hist, state_map = map_raw_to_states(counts_raw)
-    state, count = zip(*state_hist)
-    return state, count
-
-
 def _postprocess_chart_data(counts_raw, chart_type):
     resp_dict = {}
     if chart_type == '72h_for_loc':
         # Note that less than 10% users have location, and in the 10%, the majority are either
         # outside of US or use inaccurate info such as 'earth' or 'usa'.
-        states, counts = _get_counts_by_states(counts_raw)
+        # Rows are already (state, count), top states first
+        states, counts = zip(*counts_raw) if counts_raw else ((), ())
         resp_dict = {
             'xticks': states,
             'counts': counts
@@ -0,0 +1,69 @@
+"""
+Print the Postgres plan of every chart and stream query, as prepared and
+executed by the app, to check that they are index scans on
+(track_term, inserted_at) rather than sequential scans, and their mean
+planning time: the first executions of a prepared query are planned for
+their values, later ones may reuse a generic plan.
+
+    python explain_queries.py              # plans only
+    python explain_queries.py --analyze    # also run the queries, with timings
+    python explain_queries.py --repeat 50  # mean planning time over 50 plans each
+"""
+import argparse
+import re
+
+from constants import YANG_TERM
+from datajobs import DataJob
+from queries import (
+    query_last_n, query_all_tweets, query_retweet_count, query_count_nhr_at_xmin,
+    query_count_14d_at_1d, query_count_group_by_state
+)
+
+
+PLANNING_TIME = re.compile(r'Planning [Tt]ime: ([0-9.]+) ms')
+
+
+def get_queries(track_term=YANG_TERM):
+    return {
+        'latest_tweets': query_last_n(5, track_term=track_term),
+        'wordcloud': query_all_tweets(track_term, colname='tweet_tokens'),
+        'top_retweets': query_retweet_count(track_term=track_term, top_n=20),
+        '72hr_at_1hr': query_count_nhr_at_xmin(
+            n_hours=72, x_mins=60, track_term=track_term,
+            count_colname='count', interval_colname='interval'),
+        '14d_at_1d': query_count_14d_at_1d(
+            track_term, count_colname='count', interval_colname='interval'),
+        '72h_for_loc': query_count_group_by_state(track_term, colname='location'),
+    }
+
+
+def planning_ms(lines):
+    for line, in lines:
+        match = PLANNING_TIME.search(line)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def mean_planning_ms(conn, query, repeat):
+    """Mean planning time of the prepared query over repeat plans"""
+    samples = [planning_ms(query.explain(conn)) for _ in range(repeat)]
+    samples = [ms for ms in samples if ms is not None]
+    return round(sum(samples) / len(samples), 3) if samples else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN the chart and stream queries.")
+    parser.add_argument('--analyze', action='store_true', help="Run EXPLAIN ANALYZE")
+    parser.add_argument('--repeat', type=int, default=10,
+                        help="Plans per query to average the planning time over")
+    args = parser.parse_args()
+
+    options = 'ANALYZE, BUFFERS' if args.analyze else 'SUMMARY'
+    with DataJob.db.engine.connect() as conn:
+        for name, query in get_queries().items():
+            print(f"[{name}] {query}")
+            for line, in query.explain(conn, options):
+                print(f"    {line}")
+            print(f"    Mean planning time: {mean_planning_ms(conn, query, args.repeat)}ms")
+            print()
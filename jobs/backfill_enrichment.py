@@ -0,0 +1,80 @@
+"""
+Backfill the ingest-time derived columns (user_state, tweet_tokens and the
+retweet and reply flags) of tweets written before migration c81f0e6b2d45.
+Run it once right after that migration, the location chart and the wordcloud
+read only these columns. Rows are enriched and updated in batches by id, each
+batch in its own transaction, so the ingester is never blocked for long.
+
+    python backfill_enrichment.py                  # last 72 hours of the prod db
+    python backfill_enrichment.py --hours 168 --db-url postgresql+psycopg2://localhost/replay
+"""
+import argparse
+import time
+
+from sqlalchemy import and_, bindparam, select
+
+from enrichment import Enricher
+from models import Database, Tweet
+from tweet_fields import ENRICHED_COLUMNS
+from settings import TWEET_ENRICH_PROCESSES
+
+
+def backfill_enrichment(engine, hours=72, batch_size=1000, processes=TWEET_ENRICH_PROCESSES):
+    """
+    Enrich the tweets of the last hours that have neither user_state nor
+    tweet_tokens, return the number of rows updated
+
+    Arguments:
+        engine {sqlalchemy.engine.Engine} -- Engine for the tweets db
+
+    Keyword Arguments:
+        hours {float} -- How far back to backfill, charts read at most 72 hours
+        batch_size {int} -- Rows enriched and updated per transaction
+        processes {int} -- Enrichment worker processes, 0 to enrich in this process
+    """
+    table = Tweet.__table__
+    since_ms = int((time.time() - hours * 3600) * 1000)
+    stmt = (select([table.c.id, table.c.inserted_at, table.c.tweet_text, table.c.user_location,
+                    table.c.retweeted_status_id_str, table.c.in_reply_to_status_id_str])
+            .where(and_(table.c.inserted_at >= since_ms,
+                        table.c.id > bindparam('last_id'),
+                        table.c.user_state.is_(None),
+                        table.c.tweet_tokens.is_(None)))
+            .order_by(table.c.id)
+            .limit(batch_size))
+    # inserted_at is part of the key, it also prunes to the row's partition
+    update = (table.update()
+              .where(and_(table.c.id == bindparam('row_id'),
+                          table.c.inserted_at == bindparam('row_inserted_at')))
+              .values({col: bindparam(col) for col in ENRICHED_COLUMNS}))
+    enricher = Enricher(processes=processes)
+    last_id, updated = 0, 0
+    try:
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(stmt, last_id=last_id).fetchall()
+                if not rows:
+                    break
+                derived = enricher.derive([tuple(row[2:]) for row in rows])
+                conn.execute(update, [
+                    dict(zip(ENRICHED_COLUMNS, values), row_id=row[0], row_inserted_at=row[1])
+                    for row, values in zip(rows, derived)
+                ])
+            last_id = rows[-1][0]
+            updated += len(rows)
+            print(f"Backfilled {updated} tweets, up to id {last_id}")
+    finally:
+        enricher.shutdown()
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill the derived columns of old tweets.")
+    parser.add_argument('--db-url', default=None, help="Database url, the prod db by default")
+    parser.add_argument('--hours', type=float, default=72, help="How far back to backfill")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="Rows enriched and updated per transaction")
+    args = parser.parse_args()
+
+    db = Database(env='prod', db_url=args.db_url)
+    backfill_enrichment(db.engine, hours=args.hours, batch_size=args.batch_size)
@@ -0,0 +1,47 @@
+from collections import defaultdict
+
+from tweet_fields import TRACK_TERM, TWEET_TEXT
+
+
+class ChangeNotifier:
+    """
+    TweetBatchWriter after-write hook publishing what a committed batch changed,
+    per track term: the new daily count and the newest tweet texts. A batch is
+    one event per term whatever its size, so bursts are coalesced at the source.
+    Every text is appended to the latest tweets ring first, the tweets event
+    carries the id of the last one.
+    """
+    def __init__(self, bus, daily_counts, ring, max_texts=5):
+        """
+        Arguments:
+            bus {LocalChangeBus or RedisChangeBus} -- Where events are published
+            daily_counts {DailyCountAggregator} -- Holds the totals of the last upsert
+            ring {LocalTweetRing or RedisTweetRing} -- Latest tweets per track term
+
+        Keyword Arguments:
+            max_texts {int} -- Newest tweet texts sent per term and batch
+        """
+        self.bus = bus
+        self.daily_counts = daily_counts
+        self.ring = ring
+        self.max_texts = max_texts
+
+    def __call__(self, rows):
+        texts = defaultdict(list)
+        for row in rows:
+            texts[row[TRACK_TERM]].append(row[TWEET_TEXT])
+        for track_term, term_texts in texts.items():
+            try:
+                last_id = self.ring.append(track_term, term_texts)
+            except Exception as e:
+                # Only the ring misses these tweets, the events are still published
+                print(f"Appending to the latest tweets ring failed: {e}")
+                last_id = None
+            count = self.daily_counts.totals.get((self.daily_counts.created_date, track_term))
+            if count is not None:
+                self.bus.publish({'type': 'count', 'track_term': track_term, 'count': count})
+            self.bus.publish({
+                'type': 'tweets', 'track_term': track_term, 'last_id': last_id,
+                # Oldest first, like the rows
+                'texts': term_texts[-self.max_texts:]
+            })
@@ -0,0 +1,149 @@
+import logging
+import time
+from collections import Counter
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import TweetDailyCount, TweetMinuteCount, TweetHourCount
+from queries import get_eastern_date_from_epoch, convert_date_to_tsinterval
+from tweet_fields import INSERTED_AT, TRACK_TERM
+from settings import TWEET_MINUTE_COUNT_RETENTION_DAYS
+
+
+class CountAggregator:
+    """
+    Keep tweet count deltas in memory per (bucket, track_term) and write them
+    to a count table with one atomic upsert per flush, so the ingest loop never
+    reads a count row back. Subclasses map inserted_at to a bucket value.
+    """
+    bucket_column = None
+
+    def __init__(self, table):
+        self.table = table
+        self.deltas = Counter()
+        # Latest known totals, as returned by the last upsert
+        self.totals = {}
+
+    def get_bucket(self, inserted_at):
+        raise NotImplementedError
+
+    def add(self, inserted_at, track_term, n=1):
+        self.deltas[(self.get_bucket(inserted_at), track_term)] += n
+
+    def on_flush(self, conn, rows):
+        """TweetBatchWriter flush hook, counts the written rows in the same transaction"""
+        for row in rows:
+            self.add(row[INSERTED_AT], row[TRACK_TERM])
+        self.flush(conn)
+
+    def flush(self, conn):
+        """Upsert all pending deltas: tweet_count = tweet_count + delta"""
+        if not self.deltas:
+            return {}
+        deltas, self.deltas = self.deltas, Counter()
+        bucket_col = self.table.c[self.bucket_column]
+        values = [
+            {self.bucket_column: bucket, 'track_term': track_term, 'tweet_count': delta}
+            for (bucket, track_term), delta in deltas.items()
+        ]
+        if conn.dialect.name == 'postgresql':
+            stmt = pg_insert(self.table).values(values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[bucket_col, self.table.c.track_term],
+                set_={'tweet_count': self.table.c.tweet_count + stmt.excluded.tweet_count}
+            ).returning(bucket_col, self.table.c.track_term, self.table.c.tweet_count)
+            for bucket, track_term, tweet_count in conn.execute(stmt):
+                self.totals[(bucket, track_term)] = tweet_count
+        else:
+            # No ON CONFLICT in this dialect, update then insert on a miss
+            for value in values:
+                self._update_or_insert(conn, value)
+        return deltas
+
+    def _update_or_insert(self, conn, value):
+        table = self.table
+        bucket = value[self.bucket_column]
+        where = ((table.c[self.bucket_column] == bucket)
+                 & (table.c.track_term == value['track_term']))
+        result = conn.execute(
+            table.update().where(where).values(
+                tweet_count=table.c.tweet_count + value['tweet_count']))
+        if result.rowcount == 0:
+            conn.execute(table.insert().values(**value))
+        tweet_count = conn.execute(
+            table.select().with_only_columns([table.c.tweet_count]).where(where)).scalar()
+        self.totals[(bucket, value['track_term'])] = tweet_count
+
+
+class DailyCountAggregator(CountAggregator):
+    """Counts per (US eastern date, track_term) in tweet_daily_count"""
+    bucket_column = 'created_date'
+
+    def __init__(self):
+        super().__init__(TweetDailyCount.__table__)
+        # Epoch ms interval [start, end) of the cached eastern date, so the date
+        # is only recomputed when a tweet falls outside of it (day rollover)
+        self.day_start_ms = None
+        self.day_end_ms = None
+        self.created_date = None
+
+    def get_bucket(self, inserted_at):
+        if self.created_date is None or not self.day_start_ms <= inserted_at < self.day_end_ms:
+            self.created_date = get_eastern_date_from_epoch(inserted_at)
+            self.day_start_ms, self.day_end_ms = convert_date_to_tsinterval(
+                date_str=self.created_date)
+        return self.created_date
+
+    def flush(self, conn):
+        deltas = super().flush(conn)
+        for (created_date, track_term), tweet_count in self.totals.items():
+            if (created_date, track_term) in deltas:
+                print(f"Count for {track_term} on {created_date}: {tweet_count}")
+        return deltas
+
+
+class RollupCountAggregator(CountAggregator):
+    """
+    Counts per (fixed size epoch bucket, track_term), e.g. tweet_minute_count,
+    so charts read one row per bucket instead of grouping raw tweets
+    """
+    bucket_column = 'bucket_start'
+
+    def __init__(self, table, bucket_ms):
+        super().__init__(table)
+        self.bucket_ms = bucket_ms
+
+    def get_bucket(self, inserted_at):
+        return inserted_at // self.bucket_ms * self.bucket_ms
+
+    def flush(self, conn):
+        deltas = super().flush(conn)
+        # Only the current buckets keep changing, do not hold every total seen
+        if deltas:
+            latest = max(bucket for bucket, _ in deltas)
+            self.totals = {key: count for key, count in self.totals.items()
+                           if key[0] >= latest - self.bucket_ms}
+        return deltas
+
+
+def minute_count_aggregator():
+    return RollupCountAggregator(TweetMinuteCount.__table__, bucket_ms=60 * 1000)
+
+
+def hour_count_aggregator():
+    return RollupCountAggregator(TweetHourCount.__table__, bucket_ms=60 * 60 * 1000)
+
+
+# pylint: disable=logging-fstring-interpolation
+def prune_minute_counts(engine, retention_days=TWEET_MINUTE_COUNT_RETENTION_DAYS, now_ms=None):
+    """
+    Delete tweet_minute_count rows older than retention_days, the hourly and
+    daily counts are kept forever. Returns the number of rows deleted.
+    """
+    now_ms = now_ms or int(time.time() * 1000)
+    table = TweetMinuteCount.__table__
+    cutoff = now_ms - retention_days * 24 * 60 * 60 * 1000
+    with engine.begin() as conn:
+        deleted = conn.execute(table.delete().where(table.c.bucket_start < cutoff)).rowcount
+    logging.info(f"Pruned {deleted} tweet_minute_count rows older than {retention_days} days")
+    return deleted
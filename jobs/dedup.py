@@ -0,0 +1,51 @@
+import time
+
+
+class RecentIdFilter:
+    """
+    Memory-bounded filter of recently seen tweet ids. Ids are kept in two
+    generations of sets: new ids go into the current one, and the current one
+    becomes the previous one when it is full or older than window_seconds,
+    dropping the old previous one. An id is remembered for at least one full
+    generation, which covers the overlap replayed by a stream reconnect.
+    """
+    def __init__(self, capacity=100000, window_seconds=1800):
+        """
+        Keyword Arguments:
+            capacity {int} -- Max ids per generation, memory is bounded by 2x this
+            window_seconds {float} -- Max age of a generation before it rotates
+        """
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.current = set()
+        self.previous = set()
+        self.generation_started_at = time.monotonic()
+        # Counters
+        self.passed = 0
+        self.dropped = 0
+
+    def is_duplicate(self, tweet_id):
+        """Return True if tweet_id was seen recently, otherwise remember it"""
+        if tweet_id is None:
+            self.passed += 1
+            return False
+        if tweet_id in self.current or tweet_id in self.previous:
+            self.dropped += 1
+            return True
+        if (len(self.current) >= self.capacity
+                or time.monotonic() - self.generation_started_at >= self.window_seconds):
+            self._rotate()
+        self.current.add(tweet_id)
+        self.passed += 1
+        return False
+
+    def stats(self):
+        return {
+            'dedup_passed': self.passed,
+            'dedup_dropped': self.dropped,
+            'dedup_ids_held': len(self.current) + len(self.previous),
+        }
+
+    def _rotate(self):
+        self.previous, self.current = self.current, set()
+        self.generation_started_at = time.monotonic()
@@ -0,0 +1,67 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from location_utils import get_state_abbr
+from nlp.wordcloud_gen import tokenize_tweet
+from tweet_fields import TWEET_TEXT, USER_LOCATION, IN_REPLY_TO_STATUS_ID, RETWEETED_STATUS_ID
+
+
+def _enrich_one(text, location, retweeted_status_id, in_reply_to_status_id):
+    """Derived columns of one tweet, in ENRICHED_COLUMNS order"""
+    try:
+        user_state = get_state_abbr(location)
+        tokens = ' '.join(tokenize_tweet(text)) if retweeted_status_id is None else None
+    except Exception as e:
+        # Never lose a tweet over its derived columns
+        print(f"An exception occurred during enrichment: {e}\n")
+        user_state, tokens = None, None
+    return (user_state, tokens, retweeted_status_id is not None,
+            in_reply_to_status_id is not None)
+
+
+def _enrich_chunk(inputs):
+    return [_enrich_one(*item) for item in inputs]
+
+
+class Enricher:
+    """
+    Compute derived columns at ingest time so the read paths do not have to:
+    the US state of user_location, the normalized wordcloud tokens (original
+    tweets only, retweets are left out of the wordcloud) and the retweet and
+    reply flags. Location lookup and tokenization are CPU bound, so chunks of
+    each batch run in a process pool.
+    """
+    def __init__(self, processes=2, chunk_size=100):
+        """
+        Keyword Arguments:
+            processes {int} -- Worker processes, 0 to enrich in the calling thread
+            chunk_size {int} -- Rows per task sent to a worker
+        """
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.pool = ProcessPoolExecutor(max_workers=processes) if processes else None
+
+    def __call__(self, rows):
+        """Return rows with the ENRICHED_COLUMNS values appended"""
+        if not rows:
+            return rows
+        derived = self.derive([
+            (row[TWEET_TEXT], row[USER_LOCATION], row[RETWEETED_STATUS_ID],
+             row[IN_REPLY_TO_STATUS_ID])
+            for row in rows
+        ])
+        return [tuple(row) + values for row, values in zip(rows, derived)]
+
+    def derive(self, inputs):
+        """
+        ENRICHED_COLUMNS values of each (text, location, retweeted_status_id,
+        in_reply_to_status_id)
+        """
+        if self.pool is None:
+            return _enrich_chunk(inputs)
+        chunks = [inputs[i:i + self.chunk_size] for i in range(0, len(inputs), self.chunk_size)]
+        return [values for chunk in self.pool.map(_enrich_chunk, chunks) for values in chunk]
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
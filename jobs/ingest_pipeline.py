@@ -0,0 +1,241 @@
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+
+# Errors meaning the db is unreachable, rows are spilled to disk and retried
+DB_DOWN_ERRORS = (OperationalError, InterfaceError)
+_STOP = object()
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z'
+
+
+def _encode_value(value):
+    """json default for row values json can't encode, i.e. created_at datetimes"""
+    if isinstance(value, datetime):
+        return {'$dt': value.strftime(_DATETIME_FORMAT)}
+    raise TypeError(f"Cannot spill value of type {type(value)}")
+
+
+def _decode_value(obj):
+    if '$dt' in obj:
+        return datetime.strptime(obj['$dt'], _DATETIME_FORMAT)
+    return obj
+
+
+class SpillFile:
+    """
+    Append-only JSON lines file holding rows that could not be written while
+    the db was unreachable. Rows are replayed in the order they were spilled.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        if os.path.exists(path):
+            # Rows left over from a previous run are replayed first
+            with open(path) as f:
+                self.rows = sum(1 for _ in f)
+
+    @property
+    def size_bytes(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def append(self, rows):
+        with open(self.path, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(row, default=_encode_value))
+                f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.rows += len(rows)
+
+    def replay(self, write, batch_size):
+        """
+        Write spilled rows back in order, batch_size rows at a time with
+        write(rows). If a batch fails, the rows not yet written are kept in the
+        file and the error is raised.
+        """
+        if not self.rows:
+            return 0
+        replayed = 0
+        with open(self.path) as f:
+            while True:
+                offset = f.tell()
+                lines = [line for line in (f.readline() for _ in range(batch_size)) if line]
+                if not lines:
+                    break
+                try:
+                    write([json.loads(line, object_hook=_decode_value) for line in lines])
+                except Exception:
+                    self._keep_from(f, offset)
+                    raise
+                replayed += len(lines)
+                self.rows -= len(lines)
+        os.remove(self.path)
+        self.rows = 0
+        return replayed
+
+    def _keep_from(self, f, offset):
+        """Rewrite the file with only the lines starting at offset"""
+        f.seek(offset)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as tmp:
+            for line in f:
+                tmp.write(line)
+        os.replace(tmp_path, self.path)
+
+
+class IngestPipeline:
+    """
+    Decouple the stream reader from the db writer. The reader puts rows on a
+    bounded queue, a writer thread drains it into the TweetBatchWriter, running
+    each batch through the optional enricher right before it is written. When
+    the queue is full the reader blocks (backpressure). When the db is
+    unreachable, flushed batches go to the spill file instead, and are
+    replayed in order before any new rows once the db is back.
+    """
+    def __init__(self, writer, spill_path, enricher=None, maxsize=50000, retry_seconds=10,
+                 stats_seconds=60):
+        """
+        Arguments:
+            writer {TweetBatchWriter} -- Writer used by the writer thread only
+            spill_path {str} -- Path of the append-only spill file
+
+        Keyword Arguments:
+            enricher {callable} -- Maps a batch of rows to rows with derived columns
+            maxsize {int} -- Max number of rows waiting in the queue
+            retry_seconds {float} -- Seconds between replays of the spill file
+            stats_seconds {float} -- Seconds between stats printouts
+        """
+        self.writer = writer
+        self.enricher = enricher
+        self.spill = SpillFile(spill_path)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.retry_seconds = retry_seconds
+        self.stats_seconds = stats_seconds
+        self.thread = threading.Thread(target=self._run_writer, name='tweet-writer', daemon=True)
+        self.last_retry_at = 0
+        self.last_stats_at = time.monotonic()
+        # Callables returning extra stats dicts, e.g. from the reader side
+        self.stats_sources = []
+        # Counters
+        self.reader_stalls = 0
+        self.rows_spilled = 0
+        self.rows_replayed = 0
+        self.rows_dropped = 0
+        self.last_enrich_seconds = 0.0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, row):
+        """Called by the reader, blocks while the queue is full"""
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.reader_stalls += 1
+            self.queue.put(row)
+
+    def stop(self):
+        """Flush everything still queued or buffered, then stop the writer thread"""
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.enricher is not None and hasattr(self.enricher, 'shutdown'):
+            self.enricher.shutdown()
+
+    def stats(self):
+        stats = {
+            'queue_depth': self.queue.qsize(),
+            'queue_maxsize': self.queue.maxsize,
+            'reader_stalls': self.reader_stalls,
+            'spill_rows': self.spill.rows,
+            'spill_bytes': self.spill.size_bytes,
+            'rows_spilled': self.rows_spilled,
+            'rows_replayed': self.rows_replayed,
+            'rows_dropped': self.rows_dropped,
+            'rows_written': self.writer.rows_written,
+            'rows_conflicted': self.writer.rows_conflicted,
+            'last_enrich_seconds': round(self.last_enrich_seconds, 3),
+        }
+        for source in self.stats_sources:
+            stats.update(source())
+        return stats
+
+    def _run_writer(self):
+        while True:
+            timeout = self.writer.seconds_until_due()
+            try:
+                row = self.queue.get(timeout=timeout if timeout is not None else 1.0)
+            except queue.Empty:
+                row = None
+            if row is _STOP:
+                break
+            if row is not None:
+                self.writer.append(row)
+            if self.writer.is_flush_due():
+                self._flush()
+            elif self.spill.rows:
+                self._maybe_replay()
+            self._maybe_print_stats()
+        self._flush()
+        self._maybe_replay(force=True)
+
+    def _flush(self):
+        rows = self.writer.take()
+        if not rows:
+            return
+        if self.enricher is not None:
+            t0 = time.perf_counter()
+            rows = self.enricher(rows)
+            self.last_enrich_seconds = time.perf_counter() - t0
+        # Keep the insert order: while rows are spilled, new rows go behind them
+        if self.spill.rows and not self._maybe_replay():
+            self._spill(rows)
+            return
+        try:
+            self._write(rows)
+        except DB_DOWN_ERRORS as e:
+            print(f"DB unreachable, spilling {len(rows)} tweets to {self.spill.path}: {e}\n")
+            self.last_retry_at = time.monotonic()
+            self._spill(rows)
+
+    def _write(self, rows):
+        """Write rows, raise if the db is unreachable, drop them on any other error"""
+        try:
+            self.writer.write(rows)
+        except DB_DOWN_ERRORS:
+            raise
+        except Exception as e:
+            self.rows_dropped += len(rows)
+            print(f"An unexpected exception occurred during flush, "
+                  f"dropped {len(rows)} tweets: {e}\n")
+
+    def _spill(self, rows):
+        self.spill.append(rows)
+        self.rows_spilled += len(rows)
+
+    def _maybe_replay(self, force=False):
+        """Replay the spill file at most every retry_seconds, True if it is now empty"""
+        if not self.spill.rows:
+            return True
+        if not force and time.monotonic() - self.last_retry_at < self.retry_seconds:
+            return False
+        self.last_retry_at = time.monotonic()
+        try:
+            replayed = self.spill.replay(self._write, self.writer.batch_size)
+            self.rows_replayed += replayed
+            print(f"Replayed {replayed} spilled tweets.")
+            return True
+        except DB_DOWN_ERRORS as e:
+            print(f"DB still unreachable, {self.spill.rows} tweets in spill file: {e}\n")
+            return False
+
+    def _maybe_print_stats(self):
+        if time.monotonic() - self.last_stats_at >= self.stats_seconds:
+            self.last_stats_at = time.monotonic()
+            print(f"Ingest pipeline stats: {self.stats()}")
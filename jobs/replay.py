@@ -0,0 +1,172 @@
+"""
+Offline replay harness for the tweet ingest path, no Twitter credentials needed.
+
+Feed recorded tweet JSON lines (one statuses/filter tweet object per line) or
+synthetic tweets through TweetStream.stream_tweet_to_db, and report sustained
+throughput, per-tweet latency from receive to commit, and memory growth.
+
+    python replay.py --db-url sqlite:///replay.sqlite --synthetic 100000
+    python replay.py --db-url postgresql+psycopg2://localhost/replay --file tweets.jsonl --rate 500
+"""
+import argparse
+import json
+import random
+import resource
+import time
+
+from models import Database
+from notify import LocalChangeBus
+from stream_to_db import TweetStream
+from tweet_fields import INSERTED_AT
+from tweet_ring import LocalTweetRing
+
+
+SYNTHETIC_TEXTS = [
+    'Andrew Yang on the debate stage tonight #YangGang',
+    'The freedom dividend would change everything for my family',
+    'Universal basic income is not a crazy idea anymore',
+    'yang2020 all the way',
+    'just bought more $ADA, cardano to the moon',
+    'nothing to see here, unrelated tweet',
+]
+SYNTHETIC_LOCATIONS = [None, 'New York', 'Los Angeles, CA', 'Texas', 'earth', 'Seattle']
+
+
+class ReplaySource:
+    """
+    Iterable of raw tweet JSON lines read from a file, or generated, at a
+    controlled rate (tweets per second) or as fast as possible (rate=None).
+    Lines are decoded by the stream, the same as live Twitter lines.
+    """
+    def __init__(self, path=None, synthetic=None, rate=None, seed=42):
+        """
+        Keyword Arguments:
+            path {str} -- JSON lines file of recorded tweets
+            synthetic {int} -- Number of synthetic tweets to generate when no path
+            rate {float} -- Tweets per second, None or 0 for as fast as possible
+            seed {int} -- Random seed for synthetic tweets
+        """
+        if not path and not synthetic:
+            raise ValueError("ReplaySource needs either a path or a synthetic count.")
+        self.path = path
+        self.synthetic = synthetic
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.emitted = 0
+
+    def __iter__(self):
+        tweets = self._read_file() if self.path else self._generate()
+        started = time.perf_counter()
+        for tweet in tweets:
+            if self.rate:
+                # Pace against the start time so sleep overshoot does not accumulate
+                delay = started + self.emitted / self.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.emitted += 1
+            yield tweet
+
+    def _read_file(self):
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+    def _generate(self):
+        base_id = 1180000000000000000
+        for i in range(self.synthetic):
+            retweet = self.random.random() < 0.4
+            tweet = {
+                'created_at': time.strftime('%a %b %d %H:%M:%S +0000 %Y', time.gmtime()),
+                'id_str': str(base_id + i),
+                'text': self.random.choice(SYNTHETIC_TEXTS),
+                'lang': 'en',
+                'user': {
+                    'name': f"user {i % 5000}",
+                    'screen_name': f"user{i % 5000}",
+                    'location': self.random.choice(SYNTHETIC_LOCATIONS),
+                    'followers_count': self.random.randint(0, 10000),
+                },
+                'retweeted_status': {'id_str': str(base_id - i % 50)} if retweet else {},
+                'in_reply_to_status_id_str': None,
+                'in_reply_to_user_id_str': None,
+                'quoted_status_id_str': None,
+                'place': None,
+                'coordinates': None,
+            }
+            yield json.dumps(tweet).encode()
+
+
+class LatencyRecorder:
+    """TweetBatchWriter after-write hook, records receive-to-commit latency per tweet"""
+    def __init__(self):
+        self.latencies_ms = []
+
+    def on_written(self, rows):
+        now_ms = int(round(time.time() * 1000))
+        self.latencies_ms.extend(now_ms - row[INSERTED_AT] for row in rows)
+
+    def percentile(self, pct):
+        if not self.latencies_ms:
+            return None
+        ordered = sorted(self.latencies_ms)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _rss_kb():
+    """Current resident set size in KB, falls back to peak RSS off Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_replay(db_url, path=None, synthetic=None, rate=None):
+    database = Database(db_url=db_url)
+    source = ReplaySource(path=path, synthetic=synthetic, rate=rate)
+    # Never the Redis of REDIS_URL, synthetic tweets would reach the live dashboards
+    stream = TweetStream(database, stream_source=source,
+                         bus=LocalChangeBus(), ring=LocalTweetRing())
+    recorder = LatencyRecorder()
+    stream.writer.after_write_hooks.append(recorder.on_written)
+
+    rss_start = _rss_kb()
+    t0 = time.perf_counter()
+    stream.stream_tweet_to_db(forever=False)
+    elapsed = time.perf_counter() - t0
+    rss_end = _rss_kb()
+
+    written = stream.writer.rows_written
+    return {
+        'tweets_read': source.emitted,
+        'tweets_written': written,
+        'seconds': round(elapsed, 3),
+        'tweets_per_sec': round(written / elapsed, 1) if elapsed else None,
+        'latency_p50_ms': recorder.percentile(50),
+        'latency_p99_ms': recorder.percentile(99),
+        'flushes': stream.writer.flush_count,
+        'rss_start_kb': rss_start,
+        'rss_end_kb': rss_end,
+        'rss_growth_kb': rss_end - rss_start,
+        'pipeline': stream.pipeline.stats(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay tweets through the ingest path.")
+    parser.add_argument('--db-url', default='sqlite:///replay.sqlite',
+                        help="Local SQLite or Postgres url to write to")
+    parser.add_argument('--file', help="JSON lines file of recorded tweets")
+    parser.add_argument('--synthetic', type=int, default=None,
+                        help="Number of synthetic tweets to generate instead of a file")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="Tweets per second, omit for as fast as possible")
+    args = parser.parse_args()
+
+    results = run_replay(args.db_url, path=args.file, synthetic=args.synthetic, rate=args.rate)
+    print(json.dumps(results, indent=2))
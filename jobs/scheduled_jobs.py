@@ -1,10 +1,19 @@
 import sys
 sys.path.append(".")
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from apscheduler.schedulers.blocking import BlockingScheduler
+from pytz import timezone
 
-from datajobs import ScheduledJob
+from archive import archive_day
+from count_rollups import prune_minute_counts
+from datajobs import DataJob, ScheduledJob
+from partitions import ensure_partitions, drop_expired_partitions
+from prices import compact_prices, prune_prices
+from settings import (
+    TWEET_PARTITION_DAYS_AHEAD, TWEET_RETENTION_DAYS, TWEET_PARTITION_DETACH_ONLY,
+    TWEET_ARCHIVE_DIR, CACHE_PRECOMPUTE
+)
 
 
 sched = BlockingScheduler()
@@ -12,6 +21,11 @@ sched = BlockingScheduler()
 @sched.scheduled_job('interval', minutes=5)
 def cache_in_advance():
     print(f"Scheduled job: executing...")
+    if CACHE_PRECOMPUTE:
+        # Web workers only read what is published here
+        ScheduledJob.precompute()
+        print(f"Scheduled Job: precompute executed at {datetime.now()}")
+        return
     ScheduledJob.tweets_chart_request(chart_type='14d_at_1d')
     ScheduledJob.tweets_chart_request(chart_type='72hr_at_1hr')
     ScheduledJob.tweets_chart_request(chart_type='72h_for_loc')
@@ -20,5 +34,47 @@ def cache_in_advance():
     print(f"Scheduled Job: advance caching executed at {datetime.now()}")
 
 
+@sched.scheduled_job('cron', hour=4)
+def maintain_tweet_partitions():
+    """
+    Archive yesterday's tweets, create crypto_tweets partitions ahead of time
+    and remove the ones past retention, a day that fails to archive is kept
+    """
+    print(f"Partition maintenance: executing...")
+    engine = DataJob.db.engine
+
+    def archive(created_date):
+        archive_day(engine, created_date, TWEET_ARCHIVE_DIR)
+
+    yesterday = datetime.now(timezone('US/Eastern')).date() - timedelta(days=1)
+    try:
+        archive(yesterday.strftime('%Y%m%d'))
+    except Exception as e:
+        # Retried by before_drop before the partition is removed
+        print(f"Archiving {yesterday} failed: {e}")
+    ensure_partitions(engine, days_ahead=TWEET_PARTITION_DAYS_AHEAD)
+    drop_expired_partitions(
+        engine, retention_days=TWEET_RETENTION_DAYS,
+        detach_only=TWEET_PARTITION_DETACH_ONLY, before_drop=archive)
+    print(f"Partition maintenance: executed at {datetime.now()}")
+
+
+@sched.scheduled_job('interval', minutes=15)
+def compact_price_bars():
+    """Downsample crypto_prices into OHLC bars, drop raw samples past retention"""
+    print(f"Price compaction: executing...")
+    compact_prices(DataJob.db.engine)
+    prune_prices(DataJob.db.engine)
+    print(f"Price compaction: executed at {datetime.now()}")
+
+
+@sched.scheduled_job('interval', hours=1)
+def prune_count_rollups():
+    """Drop per-minute tweet counts past retention, charts only read recent ones"""
+    print(f"Count rollup pruning: executing...")
+    prune_minute_counts(DataJob.db.engine)
+    print(f"Count rollup pruning: executed at {datetime.now()}")
+
+
 print(f"Scheduled job: started...")
 sched.start()
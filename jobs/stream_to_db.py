@@ -1,184 +1,197 @@
-import json
 import time
+from decimal import Decimal
 from http.client import IncompleteRead
 from multiprocessing import Process
 from urllib3.exceptions import ProtocolError
-from sqlalchemy import BigInteger
-from sqlalchemy.sql.expression import cast
 from TwitterAPI import TwitterAPI
 
+from change_events import ChangeNotifier
 from cryptocompare_client import CryptocompareClient
-from models import Tweet, Price, Database, TweetDailyCount
-from queries import get_eastern_date_from_epoch, convert_date_to_tsinterval
+from count_rollups import DailyCountAggregator, minute_count_aggregator, hour_count_aggregator
+from dedup import RecentIdFilter
+from ingest_pipeline import IngestPipeline
+from models import Price, Database
+from notify import get_change_bus
+from partitions import ensure_partitions
+from term_matcher import TermMatcher, NO_TERM
+from enrichment import Enricher
+from tweet_fields import FieldExtractor, INGEST_COLUMNS, loads
+from tweet_ring import get_tweet_ring
+from tweet_writer import TweetBatchWriter
 from settings import (
-    API_KEY, API_SECRET_KEY, ACCESS_TOKEN, ACCESS_TOKEN_SECRET
+    API_KEY, API_SECRET_KEY, ACCESS_TOKEN, ACCESS_TOKEN_SECRET,
+    TWEET_BATCH_SIZE, TWEET_FLUSH_SECONDS, TWEET_QUEUE_SIZE, TWEET_SPILL_FILE,
+    TWEET_DEDUP_WINDOW_SECONDS, TWEET_ENRICH_PROCESSES,
+    STREAM_CONFIG_FILE
 )
 
 
-BTC_TERM = 'bitcoin'
-ADA_TERM = 'cardano'
-YANG_TERM = 'andrewyang'
-NO_TERM = 'noterm'
+# Twitter's reconnect policy for HTTP errors: wait 5s and double on each one in a row up
+# to 320s, rate limited responses (420/429) start at 60s and go up to 15 minutes
+HTTP_BACKOFF_SECONDS = (5, 320)
+RATE_LIMITED_BACKOFF_SECONDS = (60, 900)
+RATE_LIMITED_STATUSES = (420, 429)
+
+
+class StreamHTTPError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f"Stream request failed with {status_code}: {text}")
+        self.status_code = status_code
 
 
 class TweetStream:
-    def __init__(self, database):
+    def __init__(self, database, stream_source=None, bus=None, ring=None):
+        """
+        Arguments:
+            database {Database} -- Database to write tweets to
+
+        Keyword Arguments:
+            stream_source {iterable} -- Iterable of tweet dicts to ingest instead of
+                the Twitter stream, e.g. a replay.ReplaySource
+            bus {LocalChangeBus or RedisChangeBus} -- Where change events are
+                published, the process' change bus by default
+            ring {LocalTweetRing or RedisTweetRing} -- Latest tweets ring, the
+                process' ring by default
+        """
         # Create this database instance first with correct env
         # Create all tables if not exist
         self.session = database.create_db_session()
+        # The scheduler keeps partitions ahead too, but never start without today's
+        ensure_partitions(database.engine, days_ahead=1)
+        # Tweets are buffered and written in bulk instead of one commit per tweet
+        self.writer = TweetBatchWriter(
+            database.engine, columns=INGEST_COLUMNS,
+            batch_size=TWEET_BATCH_SIZE, max_latency=TWEET_FLUSH_SECONDS)
+        # Daily, per-minute and per-hour counts are aggregated in memory and
+        # upserted with each flush, charts read these instead of raw tweets
+        self.daily_counts = DailyCountAggregator()
+        self.minute_counts = minute_count_aggregator()
+        self.hour_counts = hour_count_aggregator()
+        for counts in (self.daily_counts, self.minute_counts, self.hour_counts):
+            self.writer.flush_hooks.append(counts.on_flush)
+        # Committed counts and tweets are pushed to the SSE streams of the web tier,
+        # and the tweets kept in a ring buffer the latest tweets stream reads from
+        self.writer.after_write_hooks.append(
+            ChangeNotifier(bus or get_change_bus(), self.daily_counts, ring or get_tweet_ring()))
+        # The stream reader only enqueues rows, a writer thread does the db writes
+        # Derived columns (state, tokens, flags) are computed in a process pool
+        self.pipeline = IngestPipeline(
+            self.writer, spill_path=TWEET_SPILL_FILE, maxsize=TWEET_QUEUE_SIZE,
+            enricher=Enricher(processes=TWEET_ENRICH_PROCESSES))
+        self.recent_ids = RecentIdFilter(window_seconds=TWEET_DEDUP_WINDOW_SECONDS)
+        self.pipeline.stats_sources.append(self.recent_ids.stats)
         """Streaming"""
-        self.track_terms = [ADA_TERM, YANG_TERM]
-        self.stream_api = TwitterAPI(
-            API_KEY, API_SECRET_KEY, ACCESS_TOKEN, ACCESS_TOKEN_SECRET
-        )
-
-    def get_track_term(self, tweet_text, track_terms):
-        if not track_terms:
-            return NO_TERM
-        expanded_ada_terms = ['#ada', '$ada']
-        expanded_btc_terms = ['#btc', '$btc']
-        expanded_yang_terms = [
-            '#yanggang', 'yang gang', 'andrew yang', 'freedom dividend',
-            'universal basic income', 'yang2020'
-        ]
-        expanded_terms = track_terms + expanded_btc_terms + expanded_ada_terms + expanded_yang_terms
-        for term in expanded_terms:
-            if term in tweet_text.lower():
-                if term in expanded_yang_terms or term == YANG_TERM:
-                    return YANG_TERM
-                if term in expanded_ada_terms or term == ADA_TERM:
-                    return ADA_TERM
-                if term in expanded_btc_terms or term == BTC_TERM:
-                    return BTC_TERM
-        return NO_TERM
+        # Track terms and their aliases come from the 'stream' section of the config
+        self.term_matcher = TermMatcher.from_file(STREAM_CONFIG_FILE)
+        self.track_terms = self.term_matcher.track
+        self.extract_fields = FieldExtractor()
+        self.stream_source = stream_source
+        # Seconds waited before the last reconnect after an HTTP error, 0 once connected
+        self.http_backoff = 0
+        if stream_source is None:
+            self.stream_api = TwitterAPI(
+                API_KEY, API_SECRET_KEY, ACCESS_TOKEN, ACCESS_TOKEN_SECRET
+            )
+
+    def get_track_term(self, tweet_text):
+        return self.term_matcher.get_track_term(tweet_text)
 
     def get_tweet_stream(self):
-        return self.stream_api.request(
+        """Iterable of raw tweet JSON lines, decoded in stream_tweet_to_db"""
+        if self.stream_source is not None:
+            return self.stream_source
+        resp = self.stream_api.request(
             'statuses/filter', {'track': self.track_terms})
+        if resp.status_code != 200:
+            raise StreamHTTPError(resp.status_code, resp.text)
+        self.http_backoff = 0
+        # Skip TwitterAPI's per-item json decode, empty lines are keep-alives
+        return (line for line in resp.response.iter_lines() if line)
 
-    def stream_tweet_to_db(self):
+    def stream_tweet_to_db(self, forever=True):
         """
         Stream live tweets from Twitter to SQLite, also update corresponding
-        statistics, e.g. increment daily count for different coins in cache
+        statistics, e.g. increment daily count for different coins in cache.
+        With forever=False, stop once the stream is exhausted, or raise on the
+        first error, instead of reconnecting, for finite sources such as a
+        replay file.
         """
+        self.pipeline.start()
+        reconnect_in = 0
         while True:
             try:
-                tweet_dicts = self.get_tweet_stream()
-                for tweet_item in tweet_dicts:
-                    current_ts = int(round(time.time() * 1000))
-                    created_at = tweet_item.get('created_at')
-                    tweet_id = tweet_item.get('id_str')
-                    tweet_text = tweet_item.get('text')
-                    tweet_lang = tweet_item.get('lang')  # lang: 'en'
-                    track_term = self.get_track_term(
-                        tweet_text, self.track_terms
-                    )
+                if reconnect_in:
+                    # In the try, so an interrupt while waiting still flushes the queue
+                    time.sleep(reconnect_in)
+                    reconnect_in = 0
+                tweet_lines = self.get_tweet_stream()
+                for tweet_item in tweet_lines:
+                    # Raw stream lines are decoded here, replay sources may yield dicts
+                    if isinstance(tweet_item, (bytes, str)):
+                        tweet_item = loads(tweet_item)
+                    inserted_at = int(round(time.time() * 1000))
+                    track_term = self.get_track_term(tweet_item.get('text'))
                     # noterm: bitcoin: cardano ~ 500 : 100 : 1, skip noterms
                     # do not stream them to db
                     if track_term == NO_TERM:
                         continue
-                    # user.name: "user john"
-                    user_name = tweet_item.get('user', {}).get('name')
-                    # user.screen_name
-                    user_screen_name = tweet_item.get('user', {})\
-                        .get('screen_name')
-                    # user.location: "New York"
-                    user_location = tweet_item.get('user', {})\
-                        .get('location')
-                    # user.followers_count: 234
-                    user_followers = tweet_item.get('user', {})\
-                        .get('followers_count')
-                    inserted_at = current_ts
-
-                    place_dict = tweet_item.get('place')
-                    place = json.dumps(place_dict) if place_dict else None
-                    # NOTE: geo is deprecated, use coordinates [long, lat]
-                    coordinates_dict = tweet_item.get('coordinates')
-                    coordinates = json.dumps(coordinates_dict) if coordinates_dict else None
-
-                    # If tweet is a reply, this is the original tweet id replied to
-                    in_reply_to_status_id_str = tweet_item.get('in_reply_to_status_id_str')
-                    # If tweet is a reply, this is the original tweet author's user id
-                    in_reply_to_user_id_str = tweet_item.get('in_reply_to_user_id_str')
-                    # If tweet is a quote, this is the original tweet id
-                    quoted_status_id_str = tweet_item.get('quoted_status_id_str')
-                    # If tweet is a retweet, this is the original tweet id
-                    retweeted_status_id_str = tweet_item.get('retweeted_status', {}).get('id_str')
-
-                    # NOTE: This needs to be updated every time there is a db migration
-                    tweet = Tweet(
-                        created_at=created_at,
-                        tweet_id=tweet_id,
-                        tweet_text=tweet_text,
-                        tweet_lang=tweet_lang,
-                        track_term=track_term,
-                        user_name=user_name,
-                        user_screen_name=user_screen_name,
-                        user_location=user_location,
-                        user_followers=user_followers,
-                        place=place,
-                        coordinates=coordinates,
-                        in_reply_to_status_id_str=in_reply_to_status_id_str,
-                        in_reply_to_user_id_str=in_reply_to_user_id_str,
-                        retweeted_status_id_str=retweeted_status_id_str,
-                        quoted_status_id_str=quoted_status_id_str,
-                        inserted_at=inserted_at
-                    )
-
-                    self.session.add(tweet)
-                    self.session.commit()
-
-                    # Increment the right (created_date, track_term): count in tweet_daily_count
-                    self._increment_daily_count(inserted_at, track_term)
+                    # Reconnects replay recent tweets, drop ids seen in the last window
+                    if self.recent_ids.is_duplicate(tweet_item.get('id_str')):
+                        continue
+                    # Plain tuple in TWEET_COLUMNS order, written with Core, no ORM objects
+                    tweet_row = (inserted_at, track_term) + self.extract_fields(tweet_item)
+
+                    # Handed to the writer thread, blocks only when the queue is full
+                    self.pipeline.put(tweet_row)
 
+                if not forever:
+                    print(f"Stream exhausted, flushing queued tweets...")
+                    self.pipeline.stop()
+                    self.session.close()
+                    break
+
+            except StreamHTTPError as e:
+                if not forever:
+                    self._stop_and_raise(e)
+                reconnect_in = self._next_http_backoff(e.status_code)
+                print(f"{e}\nReconnecting in {reconnect_in}s...\n")
+                continue
             except (IncompleteRead, ProtocolError, AttributeError) as e:
+                if not forever:
+                    self._stop_and_raise(e)
                 # Oh well, reconnect and keep trucking
                 print(f"An exception occurred during streaming: {e}\n")
                 continue
             except Exception as e:
+                if not forever:
+                    self._stop_and_raise(e)
                 print(
                     f"An unexpected exception occurred during streaming: {e}\n")
                 continue
             except KeyboardInterrupt as e:
-                print(f"Stopping the stream... closing the session...")
+                print(f"Stopping the stream... flushing queued tweets...")
+                self.pipeline.stop()
+                print(f"Closing the session...")
                 self.session.close()
                 print(f"Good bye!")
                 break
 
-    def _increment_daily_count(self, inserted_at, track_term):
+    def _stop_and_raise(self, error):
         """
-        Get date by inserted_at
-        Check if row exists in TweetDailyCount by (date, track_term)
-            If row exists, row.tweet_count += 1
-            Else insert new row with count() query to tweet table
-        Q: Is there ever going to be bad count data? How to deal with it?
-        A: Since only this stream can modify the counts, should be fine
+        Flush what was read and stop on an error, instead of reconnecting, so a
+        finite source such as a replay is never started over from its beginning
         """
-        # Get us eastern date from inserted_at epoch
-        created_date = get_eastern_date_from_epoch(inserted_at)
-        count_row = self.session.query(TweetDailyCount).filter_by(
-            created_date=created_date, track_term=track_term).first()
-        if count_row:
-            count_row.tweet_count += 1
-            self.session.commit()
-            if count_row.tweet_count % 10 == 0:
-                print(f"Count for {track_term} on {created_date}, "
-                      f"ts {int(time.time())}: {count_row.tweet_count}\n")
-        else:
-            start_ms, end_ms = convert_date_to_tsinterval(
-                date_str=created_date)
-            queried_count = self.session\
-                .query(Tweet)\
-                .filter(Tweet.track_term == track_term)\
-                .filter(cast(Tweet.inserted_at, BigInteger) >= start_ms)\
-                .filter(cast(Tweet.inserted_at, BigInteger) < end_ms).count()
-            new_row = TweetDailyCount(
-                created_date=created_date,
-                track_term=track_term,
-                tweet_count=queried_count
-            )
-            self.session.add(new_row)
-            self.session.commit()
+        print(f"Stream failed, flushing queued tweets...")
+        self.pipeline.stop()
+        self.session.close()
+        raise error
+
+    def _next_http_backoff(self, status_code):
+        """Seconds to wait before reconnecting after an HTTP error, doubled on each one in a row"""
+        initial, maximum = (RATE_LIMITED_BACKOFF_SECONDS if status_code in RATE_LIMITED_STATUSES
+                            else HTTP_BACKOFF_SECONDS)
+        self.http_backoff = min(max(self.http_backoff * 2, initial), maximum)
+        return self.http_backoff
 
 
 # This stream process needs to be triggered independently from the tweet stream
@@ -203,18 +216,17 @@ class CryptoPriceApi:
                 prices = self.get_current_prices()
                 current_ts = int(round(time.time() * 1000))
                 for coin, price in prices.items():
-                    inserted_at = current_ts
-                    coin_type = coin  # BTC or ADA
-                    price_usd = price
-                    price = Price(
-                        inserted_at=inserted_at,
-                        coin_type=coin_type,
-                        price_usd=price_usd
-                    )
-
-                    self.session.add(price)
-                    self.session.commit()
-                    self.session.close()
+                    if price is None:
+                        continue
+                    self.session.add(Price(
+                        inserted_at=current_ts,
+                        coin_type=coin,  # BTC or ADA
+                        # Via str, so 0.05811 is stored as quoted, not as its float expansion
+                        price_usd=Decimal(str(price))
+                    ))
+                # One commit for all coins of this minute
+                self.session.commit()
+                self.session.close()
                 time.sleep(60)
             except (IncompleteRead, ProtocolError, AttributeError) as e:
                 # Oh well, reconnect and keep trucking
@@ -0,0 +1,78 @@
+import re
+
+from config import BaseConfig
+
+
+NO_TERM = 'noterm'
+
+
+class TermMatcher(BaseConfig):
+    """
+    Compile all track terms and their aliases into one regex alternation, so
+    a tweet is classified in a single pass over its text no matter how many
+    terms are tracked. When a tweet matches more than one term, the term of
+    the first matched alias in priority order wins: the terms sent to the
+    Twitter filter endpoint, as is, then every alias in config order. Text
+    and aliases are compared lowercased, like a substring search would.
+    """
+    def __init__(self, terms, track=None):
+        """
+        Arguments:
+            terms {list} -- A list of (term, aliases) tuples, aliases in priority order
+
+        Keyword Arguments:
+            track {list} -- Terms sent to the Twitter filter endpoint,
+                defaults to all terms
+        """
+        self.terms = [term for term, _ in terms]
+        self.track = list(track) if track else list(self.terms)
+        # A term only matches as is if it is tracked, other terms only by their aliases
+        prioritized = [(term, term) for term in self.track if term in self.terms]
+        prioritized += [(alias, term) for term, aliases in terms for alias in aliases or []]
+        self.alias_to_term = {}
+        self.priority = {}
+        for alias, term in prioritized:
+            alias = alias.lower()
+            if alias not in self.alias_to_term:
+                self.alias_to_term[alias] = term
+                self.priority[alias] = len(self.priority)
+        # A lookahead matches at every position, so overlapping aliases are all found.
+        # At each position the longest alias is reported, the shorter ones it starts
+        # with match there too
+        aliases_by_length = sorted(self.alias_to_term, key=len, reverse=True)
+        self.pattern = re.compile(
+            '(?=(' + '|'.join(re.escape(alias) for alias in aliases_by_length) + '))')
+        self.prefixes = {
+            alias: [other for other in self.alias_to_term if alias.startswith(other)]
+            for alias in self.alias_to_term
+        }
+
+    @classmethod
+    def from_dict(cls, dictionary: dict) -> 'TermMatcher':
+        """
+        Create a TermMatcher from the 'stream' section of a config, e.g.
+            {'track': ['andrewyang'],
+             'track_terms': [{'term': 'andrewyang', 'aliases': ['yang gang']}]}
+        """
+        stream = dictionary['stream']
+        terms = [(item['term'], item.get('aliases', [])) for item in stream['track_terms']]
+        return cls(terms, track=stream.get('track'))
+
+    def match(self, text):
+        """Return every term matched in text, in priority order"""
+        if not text:
+            return []
+        matched = set()
+        for m in self.pattern.finditer(text.lower()):
+            matched.update(self.prefixes.get(m.group(1), ()))
+        terms = []
+        for alias in sorted(matched, key=self.priority.get):
+            term = self.alias_to_term.get(alias)
+            if term is not None and term not in terms:
+                terms.append(term)
+        return terms
+
+    def get_track_term(self, text):
+        """Return the highest priority term matched in text, or NO_TERM"""
+        matched = self.match(text)
+        return matched[0] if matched else NO_TERM
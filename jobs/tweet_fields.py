@@ -0,0 +1,82 @@
+import json
+from datetime import datetime
+
+try:
+    # orjson decodes stream lines several times faster than json, optional
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+def _dump_json_or_none(value):
+    return json.dumps(value) if value else None
+
+
+def _parse_twitter_time(value):
+    """'Mon Jul 08 12:43:19 +0000 2019' to an aware datetime for the timestamptz column"""
+    return datetime.strptime(value, '%a %b %d %H:%M:%S %z %Y') if value else None
+
+
+# NOTE: This needs to be updated every time there is a db migration
+# (column, path in the tweet object, optional converter)
+TWEET_FIELDS = [
+    ('created_at', ('created_at',), _parse_twitter_time),  # 'Mon Jul 08 12:43:19 +0000 2019'
+    ('tweet_id', ('id_str',), None),  # "1148411390236844032"
+    ('tweet_text', ('text',), None),
+    ('tweet_lang', ('lang',), None),  # 'en'
+    ('user_name', ('user', 'name'), None),  # "user john"
+    ('user_screen_name', ('user', 'screen_name'), None),
+    ('user_location', ('user', 'location'), None),  # "New York"
+    ('user_followers', ('user', 'followers_count'), None),  # 234
+    ('place', ('place',), _dump_json_or_none),
+    # NOTE: geo is deprecated, use coordinates [long, lat]
+    ('coordinates', ('coordinates',), _dump_json_or_none),
+    # If tweet is a reply, this is the original tweet id replied to
+    ('in_reply_to_status_id_str', ('in_reply_to_status_id_str',), None),
+    # If tweet is a reply, this is the original tweet author's user id
+    ('in_reply_to_user_id_str', ('in_reply_to_user_id_str',), None),
+    # If tweet is a quote, this is the original tweet id
+    ('quoted_status_id_str', ('quoted_status_id_str',), None),
+    # If tweet is a retweet, this is the original tweet id
+    ('retweeted_status_id_str', ('retweeted_status', 'id_str'), None),
+]
+
+# Row tuple layout: columns computed by the stream first, then the extracted fields
+TWEET_COLUMNS = ['inserted_at', 'track_term'] + [col for col, _, _ in TWEET_FIELDS]
+INSERTED_AT = TWEET_COLUMNS.index('inserted_at')
+TRACK_TERM = TWEET_COLUMNS.index('track_term')
+TWEET_TEXT = TWEET_COLUMNS.index('tweet_text')
+USER_LOCATION = TWEET_COLUMNS.index('user_location')
+IN_REPLY_TO_STATUS_ID = TWEET_COLUMNS.index('in_reply_to_status_id_str')
+RETWEETED_STATUS_ID = TWEET_COLUMNS.index('retweeted_status_id_str')
+
+# Derived columns appended to each row by the enrichment stage
+ENRICHED_COLUMNS = ['user_state', 'tweet_tokens', 'is_retweet', 'is_reply']
+INGEST_COLUMNS = TWEET_COLUMNS + ENRICHED_COLUMNS
+
+
+class FieldExtractor:
+    """
+    Pull a fixed set of (possibly nested) fields out of a decoded tweet into a
+    tuple. The field paths are compiled once into a single function, so each
+    tweet costs one call instead of a chain of .get('user', {}) lookups.
+    """
+    def __init__(self, fields=TWEET_FIELDS):
+        self.columns = [col for col, _, _ in fields]
+        namespace = {'_empty': {}}
+        exprs = []
+        for i, (_, path, converter) in enumerate(fields):
+            expr = 'tweet'
+            for key in path[:-1]:
+                expr = f"({expr}.get({key!r}) or _empty)"
+            expr = f"{expr}.get({path[-1]!r})"
+            if converter:
+                namespace[f"_convert{i}"] = converter
+                expr = f"_convert{i}({expr})"
+            exprs.append(expr)
+        source = f"lambda tweet: ({', '.join(exprs)},)"
+        self.extract = eval(compile(source, '<tweet-fields>', 'eval'), namespace)
+
+    def __call__(self, tweet):
+        return self.extract(tweet)
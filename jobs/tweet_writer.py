@@ -0,0 +1,191 @@
+import io
+import time
+
+from models import Tweet
+from partitions import create_partitions, is_missing_partition_error, partition_date
+
+
+class TweetBatchWriter:
+    """
+    Buffer tweet rows in memory and write them to the db in bulk. A flush is
+    triggered when the buffer reaches batch_size rows or when the oldest
+    buffered row is older than max_latency seconds, whichever comes first.
+    On Postgres, rows whose tweet_id was already written in the last
+    dedup_window_seconds are skipped instead of failing the batch.
+    """
+    def __init__(self, engine, columns=None, batch_size=500, max_latency=2.0, use_copy=True,
+                 dedup_window_seconds=86400):
+        """
+        Arguments:
+            engine {sqlalchemy.engine.Engine} -- Engine for the tweets db
+
+        Keyword Arguments:
+            columns {list} -- Column names, in the order of the values of each
+                row tuple, defaults to all columns of the table but id
+            batch_size {int} -- Max number of buffered rows before a flush
+            max_latency {float} -- Max seconds a row can wait in the buffer
+            use_copy {bool} -- Use Postgres COPY instead of a multi-row insert
+                when the engine is Postgres
+            dedup_window_seconds {float} -- How far back the db is checked for
+                an already written tweet_id, bounds the partitions it touches
+        """
+        self.engine = engine
+        self.table = Tweet.__table__
+        self.columns = columns or [col.name for col in self.table.columns if col.name != 'id']
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.is_postgres = engine.dialect.name == 'postgresql'
+        self.use_copy = use_copy
+        self.dedup_window_ms = int(dedup_window_seconds * 1000)
+        self.key_column = 'tweet_id'
+        self.key_index = self.columns.index(self.key_column)
+        self.inserted_at_index = self.columns.index('inserted_at')
+        # Extra work to run in the same transaction as the insert, each hook
+        # is called as hook(connection, rows) after the rows are written
+        self.flush_hooks = []
+        # Called as hook(rows) once the transaction is committed
+        self.after_write_hooks = []
+        self.buffer = []
+        self.first_buffered_at = None
+        # Per-flush stats for tuning batch_size and max_latency
+        self.flush_count = 0
+        self.rows_written = 0
+        self.rows_conflicted = 0
+        self.last_flush_rows = 0
+        self.last_flush_seconds = 0.0
+
+    def add(self, row):
+        """Buffer one row (a tuple in self.columns order), flush if needed"""
+        self.append(row)
+        if self.is_flush_due():
+            self.flush()
+
+    def append(self, row):
+        """Buffer one row without flushing"""
+        if not self.buffer:
+            self.first_buffered_at = time.monotonic()
+        self.buffer.append(row)
+
+    def is_flush_due(self):
+        if not self.buffer:
+            return False
+        if len(self.buffer) >= self.batch_size:
+            return True
+        return time.monotonic() - self.first_buffered_at >= self.max_latency
+
+    def seconds_until_due(self):
+        """Seconds until the max latency deadline of the buffer, None if empty"""
+        if not self.buffer:
+            return None
+        return max(0.0, self.first_buffered_at + self.max_latency - time.monotonic())
+
+    def take(self):
+        """Remove and return all buffered rows"""
+        rows, self.buffer = self.buffer, []
+        self.first_buffered_at = None
+        return rows
+
+    def flush(self):
+        """Write all buffered rows in one transaction, return the row count"""
+        return self.write(self.take())
+
+    def write(self, rows):
+        """Write rows in one transaction together with the flush hooks"""
+        if not rows:
+            return 0
+        try:
+            return self._write(rows)
+        except Exception as e:
+            if not self.is_postgres or not is_missing_partition_error(e):
+                raise
+            # The partition maintenance job did not run for a while, or these are
+            # spilled rows of a day whose partition was dropped since: create the
+            # partitions and write again, closed days get archived again later
+            created = create_partitions(
+                self.engine, [partition_date(row[self.inserted_at_index]) for row in rows])
+            print(f"Created missing crypto_tweets partitions {created}, writing again")
+            return self._write(rows)
+
+    def _write(self, rows):
+        t0 = time.perf_counter()
+        with self.engine.begin() as conn:
+            if self.is_postgres:
+                inserted_keys = self._write_postgres(conn, rows)
+                if len(inserted_keys) < len(rows):
+                    # Hooks (e.g. daily counts) only see rows that were new
+                    self.rows_conflicted += len(rows) - len(inserted_keys)
+                    rows = [row for row in rows if row[self.key_index] in inserted_keys]
+            else:
+                self._insert_rows(conn, rows)
+            for hook in self.flush_hooks:
+                hook(conn, rows)
+        elapsed = time.perf_counter() - t0
+        for hook in self.after_write_hooks:
+            hook(rows)
+
+        self.flush_count += 1
+        self.rows_written += len(rows)
+        self.last_flush_rows = len(rows)
+        self.last_flush_seconds = elapsed
+        print(f"Flushed {len(rows)} tweets in {elapsed * 1000:.1f}ms "
+              f"({len(rows) / elapsed if elapsed else 0:.0f} rows/s), "
+              f"total {self.rows_written} in {self.flush_count} flushes, "
+              f"{self.rows_conflicted} duplicates skipped by the db")
+        return len(rows)
+
+    def _insert_rows(self, conn, rows):
+        """Multi-row Core insert, for dev dbs, duplicates are only caught by the ingester"""
+        conn.execute(self.table.insert(), [dict(zip(self.columns, row)) for row in rows])
+
+    def _write_postgres(self, conn, rows):
+        """
+        Load rows into a temp staging table, with COPY ... FROM STDIN as CSV
+        or a multi-row insert, then move over the ones whose tweet_id is not
+        already in crypto_tweets. crypto_tweets is partitioned by inserted_at,
+        so tweet_id can not have a unique index, the anti-join is bounded by
+        the dedup window to only probe the recent partitions' tweet_id index.
+        Return the set of keys that were inserted.
+        """
+        columns = ', '.join(self.columns)
+        staging = f"{self.table.name}_staging"
+        window_start = min(row[self.inserted_at_index] for row in rows) - self.dedup_window_ms
+        cursor = conn.connection.cursor()
+        try:
+            # Lives as long as the pooled connection, emptied at every commit
+            cursor.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS {staging} ON COMMIT DELETE ROWS AS "
+                f"SELECT {columns} FROM {self.table.name} WITH NO DATA")
+            if self.use_copy:
+                buf = io.StringIO()
+                for row in rows:
+                    buf.write(','.join(_csv_field(value) for value in row))
+                    buf.write('\n')
+                buf.seek(0)
+                cursor.copy_expert(
+                    f"COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)", buf)
+            else:
+                placeholders = ', '.join(['%s'] * len(self.columns))
+                cursor.executemany(
+                    f"INSERT INTO {staging} ({columns}) VALUES ({placeholders})", rows)
+            cursor.execute(
+                f"INSERT INTO {self.table.name} ({columns}) "
+                f"SELECT {columns} FROM {staging} s "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {self.table.name} t "
+                f"WHERE t.{self.key_column} = s.{self.key_column} "
+                f"AND t.inserted_at >= {int(window_start)}) "
+                f"RETURNING {self.key_column}")
+            return {key for key, in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+
+def _csv_field(value):
+    """
+    COPY csv reads an unquoted empty field as NULL, so quote every string
+    to keep empty strings apart from None
+    """
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    return str(value)
@@ -1,4 +1,7 @@
 import json
+import os
+from functools import lru_cache
+
 import us
 
 
@@ -16,18 +19,30 @@ def map_raw_to_states(counts_raw_list, top_n=15):
     return state_hist_sorted, state_raw_map
 
 
+@lru_cache(maxsize=1)
+def _get_states_name_to_abbr():
+    return us.states.mapping('name', 'abbr')
+
+
+@lru_cache(maxsize=1)
+def _get_uscity_dict():
+    # Parsed once per process, get_state_abbr runs for every ingested tweet
+    cities_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'locdata', 'cities.json')
+    with open(cities_path, 'r') as f:
+        cities_json = json.load(f)
+    return {item['city']: item for item in cities_json}
+
+
 def get_state_abbr(loc):
     if not loc:
         return
-    us_states_dict = us.states.mapping('name', 'abbr')
+    us_states_dict = _get_states_name_to_abbr()
     # If explicit state name or abbr exists, return
     for name, abbr in us_states_dict.items():
         if abbr in loc or name in loc:
             return abbr
     # If only city name exists, map city to state abbr
-    with open('./locdata/cities.json', 'r') as f:
-        cities_json = json.load(f)
-    uscity_dict = {item['city']: item for item in cities_json}
+    uscity_dict = _get_uscity_dict()
     for city, city_data in uscity_dict.items():
         if loc.lower().strip() in city.lower().split(' '):
             state_name = city_data['state']
@@ -1,7 +1,9 @@
 import os
-from sqlalchemy import Column, Integer, String, BigInteger
+from sqlalchemy import (
+    Column, Integer, String, BigInteger, Boolean, DateTime, Numeric, Index, UniqueConstraint
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker
 
 
@@ -10,11 +12,20 @@ Base = declarative_base()
 
 class Tweet(Base):
     __tablename__ = 'crypto_tweets'
+    # In Postgres this table is range partitioned by day on inserted_at, see
+    # partitions.py and migration f19c3a72b8e5. create_all makes a plain table,
+    # which is fine for dev and replay dbs.
+    __table_args__ = (
+        # Probed by the ingester's anti-join against recently written tweets
+        Index('ix_crypto_tweets_tweet_id', 'tweet_id'),
+        # Every read is a time window for one track term
+        Index('ix_crypto_tweets_track_term_inserted_at', 'track_term', 'inserted_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     # Time properties
-    created_at = Column(String)  # created_at: 'Mon Jul 08 12:43:19 +0000 2019'
-    inserted_at = Column(BigInteger)
+    created_at = Column(DateTime(timezone=True))  # parsed from 'Mon Jul 08 12:43:19 +0000 2019'
+    inserted_at = Column(BigInteger)  # epoch milliseconds
 
     # Tweet properties
     tweet_id = Column(String)  # id_str: "1148411390236844032"
@@ -38,6 +49,12 @@ class Tweet(Base):
     place = Column(String)
     coordinates = Column(String)
 
+    # Derived at ingest time
+    user_state = Column(String)  # US state abbr resolved from user_location: "NY"
+    tweet_tokens = Column(String)  # space-joined wordcloud tokens, NULL for retweets
+    is_retweet = Column(Boolean)
+    is_reply = Column(Boolean)
+
     # __init__() is taken care of by Base
     def __repr__(self):
         return (f"<Tweet("
@@ -56,12 +73,23 @@ class Tweet(Base):
                 f"quoted_status_id_str={self.quoted_status_id_str}, "
                 f"place={self.place}, "
                 f"coordinates={self.coordinates}, "
+                f"user_state={self.user_state}, "
+                f"is_retweet={self.is_retweet}, "
+                f"is_reply={self.is_reply}, "
                 f"inserted_at={self.inserted_at}"
                 ")>")
 
 
+# Latest tweets of a term: ORDER BY id DESC LIMIT n reads the first n index entries
+Index('ix_crypto_tweets_track_term_id', Tweet.track_term, Tweet.id.desc())
+
+
 class TweetDailyCount(Base):
     __tablename__ = 'tweet_daily_count'
+    # Conflict target for the ingester's batched count upserts
+    __table_args__ = (
+        UniqueConstraint('created_date', 'track_term', name='uq_tweet_daily_count_date_term'),
+    )
 
     id = Column(Integer, primary_key=True)
     created_date = Column(String)  # '20190712' us eastern time
@@ -77,14 +105,57 @@ class TweetDailyCount(Base):
                 ")>")
 
 
+class TweetMinuteCount(Base):
+    __tablename__ = 'tweet_minute_count'
+    # Conflict target for the ingester's upserts, and the index charts read by
+    __table_args__ = (
+        UniqueConstraint('track_term', 'bucket_start', name='uq_tweet_minute_count_term_bucket'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    track_term = Column(String)
+    bucket_start = Column(BigInteger)  # epoch milliseconds, start of the minute
+    tweet_count = Column(Integer)
+
+    def __repr__(self):
+        return (f"<TweetMinuteCount("
+                f"track_term={self.track_term}, "
+                f"bucket_start={self.bucket_start}, "
+                f"tweet_count={self.tweet_count}"
+                ")>")
+
+
+class TweetHourCount(Base):
+    __tablename__ = 'tweet_hour_count'
+    __table_args__ = (
+        UniqueConstraint('track_term', 'bucket_start', name='uq_tweet_hour_count_term_bucket'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    track_term = Column(String)
+    bucket_start = Column(BigInteger)  # epoch milliseconds, start of the hour
+    tweet_count = Column(Integer)
+
+    def __repr__(self):
+        return (f"<TweetHourCount("
+                f"track_term={self.track_term}, "
+                f"bucket_start={self.bucket_start}, "
+                f"tweet_count={self.tweet_count}"
+                ")>")
+
+
 class Price(Base):
     __tablename__ = 'crypto_prices'
+    # Raw samples are only kept for a few days, see prices.py
+    __table_args__ = (
+        Index('ix_crypto_prices_coin_type_inserted_at', 'coin_type', 'inserted_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     # Example api response {'BTC': {'USD': 10418.83}, 'ADA': {'USD': 0.05811}}
-    inserted_at = Column(String)  # current timestamp in millisecond
+    inserted_at = Column(BigInteger)  # current timestamp in millisecond
     coin_type = Column(String)  # BTC or ADA
-    price_usd = Column(String)  # price in usd
+    price_usd = Column(Numeric(20, 8))  # price in usd
 
     def __repr__(self):
         return (f"<Price("
@@ -94,11 +165,41 @@ class Price(Base):
                 ")>")
 
 
+class PriceBar(Base):
+    __tablename__ = 'crypto_price_bars'
+    # Conflict target for compaction, and the index range reads scan
+    __table_args__ = (
+        UniqueConstraint('coin_type', 'resolution', 'bucket_start',
+                         name='uq_crypto_price_bars_coin_resolution_bucket'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    coin_type = Column(String)  # BTC or ADA
+    resolution = Column(String)  # '5m', '1h' or '1d'
+    bucket_start = Column(BigInteger)  # epoch milliseconds, start of the bar
+    open = Column(Numeric(20, 8))
+    high = Column(Numeric(20, 8))
+    low = Column(Numeric(20, 8))
+    close = Column(Numeric(20, 8))
+    sample_count = Column(Integer)  # raw price samples in the bar
+
+    def __repr__(self):
+        return (f"<PriceBar("
+                f"coin_type={self.coin_type}, "
+                f"resolution={self.resolution}, "
+                f"bucket_start={self.bucket_start}, "
+                f"open={self.open}, "
+                f"high={self.high}, "
+                f"low={self.low}, "
+                f"close={self.close}"
+                ")>")
+
+
 class Database:
-    def __init__(self, env='dev'):
-        """DB setup"""
+    def __init__(self, env='dev', db_url=None):
+        """DB setup, an explicit db_url (e.g. a local replay db) overrides env"""
         # Initialize the database :: Connection & Metadata retrieval
-        self.db_url = self._set_db_url_by_env(env)
+        self.db_url = db_url or self._set_db_url_by_env(env)
         self.engine = create_engine(self.db_url, echo=False)
 
     def create_db_session(self):
@@ -109,6 +210,26 @@ class Database:
         # SqlAlchemy :: Starts a session
         return Session()
 
+    def fetch_latest_tweets(self, track_term, columns=('tweet_text',), n=5):
+        """
+        Latest n tweets of track_term, newest first, as plain tuples of only the
+        given columns. No ORM objects and no wide columns such as place.
+
+        Arguments:
+            track_term {str} -- Track term of the tweets
+
+        Keyword Arguments:
+            columns {tuple} -- crypto_tweets column names to fetch
+            n {int} -- Number of tweets
+        """
+        table = Tweet.__table__
+        stmt = (select([table.c[col] for col in columns])
+                .where(table.c.track_term == track_term)
+                .order_by(table.c.id.desc())
+                .limit(n))
+        with self.engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(stmt)]
+
     def _set_db_url_by_env(self, env='dev'):
         db_url = None
         dev_url = 'sqlite:///' + os.path.join(
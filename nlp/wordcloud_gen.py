@@ -2,6 +2,7 @@ import logging
 import random
 import time
 from collections import Counter
+from functools import lru_cache
 
 import wordcloud
 import preprocessor as p
@@ -29,17 +30,28 @@ def _clean_tweet_specs(text):
     return cleaned_tweets
 
 
+@lru_cache(maxsize=1)
+def _get_nlp():
+    # Loading the model takes seconds, do it once per process
+    return spacy.load('en_core_web_sm')
+
+
 def _get_stopwords(custom_stopwords, stopwords=None):
     if not stopwords:
-        nlp = spacy.load('en_core_web_sm')
+        _get_nlp()
         stopwords = spacy.lang.en.stop_words.STOP_WORDS | set(wordcloud.STOPWORDS)
     for custom in custom_stopwords:
         stopwords.add(custom)
     return stopwords
 
 
+@lru_cache(maxsize=1)
+def _get_default_stopwords():
+    return frozenset(_get_stopwords(CUSTOM_STOPWORDS, stopwords=None))
+
+
 def _tokenize(text):
-    nlp = spacy.load('en_core_web_sm')
+    nlp = _get_nlp()
     doc = nlp.tokenizer(text)
     token_strs = [str(token) for token in doc]
     return token_strs
@@ -54,6 +66,45 @@ def _remove_stopwords(tokens, stopwords):
     return ' '.join(txt_no_stop)
 
 
+def tokenize_tweet(text):
+    """
+    Normalized wordcloud tokens of one tweet: cleaned of urls, emojis, mentions
+    and hashtags, lowercased, without stopwords and punctuation. Computed once at
+    ingest time and stored in crypto_tweets.tweet_tokens.
+    """
+    if not text:
+        return []
+    stops = _get_default_stopwords()
+    tokens = _tokenize(_clean_tweet_specs(text))
+    return [token.lower() for token in tokens
+            if token.lower() not in stops and any(ch.isalnum() for ch in token)]
+
+
+def generate_wordcloud_from_tokens(token_rows):
+    """
+    Generate the word cloud from pre-tokenized tweets
+
+    Arguments:
+        token_rows {list} -- Rows whose first column is a space-joined token string
+    """
+    logging.info(f"Wordcloud: counting tokens for {len(token_rows)} tweets.")
+    t0 = time.perf_counter()
+    frequencies = Counter()
+    for row in token_rows:
+        if row[0]:
+            frequencies.update(row[0].split(' '))
+
+    wc = wordcloud.WordCloud(
+            background_color="white",
+            max_words=900,
+            width=900,
+            height=450
+        ).generate_from_frequencies(frequencies)
+    t1 = time.perf_counter() - t0
+    logging.info(f"Wordcloud: done processing, took {t1} seconds.")
+    return wc
+
+
 def generate_wordcloud(tweets):
     logging.info(f"Wordcloud: processing starts for {len(tweets)} tweets.")
     t0 = time.perf_counter()
@@ -0,0 +1,145 @@
+"""
+Change events from the ingester to the web tier
+
+After each batch is committed, the ingester publishes one compact JSON event
+per track term on a Redis channel:
+
+    {"type": "count", "track_term": "andrewyang", "count": 12345}
+    {"type": "tweets", "track_term": "andrewyang", "texts": ["...", "..."]}
+
+Web processes subscribe once per process and push them to the SSE streams,
+instead of polling the database. The last event of each type and track term
+is also retained, so a new subscriber can start from it. Without REDIS_URL, an in-process bus stands
+in, so a replay or a dev server runs the same code path.
+"""
+import json
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from settings import REDIS_URL, CACHE_NAMESPACE
+
+
+CHANGES_CHANNEL = f"{CACHE_NAMESPACE}:changes"
+
+
+class LocalChangeBus:
+    """In-process stand-in, events are handed to the subscribers right away"""
+    def __init__(self):
+        self.callbacks = []
+        self.last_events = {}
+        self.published = 0
+
+    def publish(self, event):
+        self.published += 1
+        self.last_events[_retained_field(event['type'], event['track_term'])] = event
+        for callback in self.callbacks:
+            callback(event)
+
+    def retained(self, event_type, track_term):
+        return self.last_events.get(_retained_field(event_type, track_term))
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+
+# pylint: disable=logging-fstring-interpolation
+class RedisChangeBus:
+    def __init__(self, client, channel=CHANGES_CHANNEL, retry_seconds=1):
+        """
+        Arguments:
+            client {redis.Redis} -- Redis client
+
+        Keyword Arguments:
+            channel {str} -- Pub/sub channel of the events
+            retry_seconds {float} -- Wait before resubscribing after a connection error
+        """
+        self.client = client
+        self.channel = channel
+        self.retained_key = f"{channel}:retained"
+        self.retry_seconds = retry_seconds
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.thread = None
+        # Counters
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+
+    def publish(self, event):
+        """Publish event, a dict, an unreachable Redis only costs the event"""
+        message = json.dumps(event)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.hset(self.retained_key, _retained_field(event['type'], event['track_term']), message)
+            pipe.publish(self.channel, message)
+            pipe.execute()
+            self.published += 1
+        except RedisError as e:
+            logging.error(f"Publishing a change event failed: {e}")
+            self.errors += 1
+
+    def retained(self, event_type, track_term):
+        """Last event published of event_type for track_term, None if there is none"""
+        try:
+            message = self.client.hget(self.retained_key, _retained_field(event_type, track_term))
+        except RedisError as e:
+            logging.error(f"Reading a retained change event failed: {e}")
+            self.errors += 1
+            return None
+        return json.loads(message) if message is not None else None
+
+    def subscribe(self, callback):
+        """Call callback with every event, from one listener thread per process"""
+        with self.lock:
+            self.callbacks.append(callback)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._listen, name='change-events', daemon=True)
+                self.thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    self.received += 1
+                    self._dispatch(json.loads(message['data']))
+            except RedisError as e:
+                logging.error(f"Change event subscription lost: {e}")
+                self.errors += 1
+                time.sleep(self.retry_seconds)
+
+    def _dispatch(self, event):
+        for callback in self.callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                logging.error(f"Handling a change event failed: {e}")
+                self.errors += 1
+
+
+def _retained_field(event_type, track_term):
+    return f"{event_type}:{track_term}"
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_change_bus():
+    """The process' change bus, on Redis if REDIS_URL is set"""
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            if REDIS_URL:
+                from redisclient import r
+                _bus = RedisChangeBus(r)
+            else:
+                _bus = LocalChangeBus()
+        return _bus
@@ -0,0 +1,118 @@
+"""
+Daily range partitions of crypto_tweets on inserted_at (epoch ms)
+
+Each partition holds one US eastern day, the same day boundaries as
+tweet_daily_count, named crypto_tweets_pYYYYMMDD. Partitions are created
+ahead of time and detached or dropped once older than the retention.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from pytz import timezone
+from sqlalchemy.sql import text
+
+from queries import convert_date_to_tsinterval
+
+
+PARTITIONED_TABLE = 'crypto_tweets'
+
+
+# pylint: disable=logging-fstring-interpolation
+def partition_name(created_date, table=PARTITIONED_TABLE):
+    """Partition of an eastern date, e.g. 20191022 -> crypto_tweets_p20191022"""
+    return f"{table}_p{created_date}"
+
+
+def is_partitioned(conn, table=PARTITIONED_TABLE):
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :table)"
+    ), table=table).scalar()
+
+
+def list_partition_dates(conn, table=PARTITIONED_TABLE):
+    """Eastern dates ('YYYYMMDD') of the attached daily partitions, oldest first"""
+    rows = conn.execute(text(
+        "SELECT child.relname FROM pg_inherits i "
+        "JOIN pg_class parent ON parent.oid = i.inhparent "
+        "JOIN pg_class child ON child.oid = i.inhrelid "
+        "WHERE parent.relname = :table"
+    ), table=table).fetchall()
+    prefix = partition_name('', table=table)
+    return sorted(name[len(prefix):] for name, in rows if name.startswith(prefix))
+
+
+def ensure_partitions(engine, days_ahead=7, days_behind=0, table=PARTITIONED_TABLE):
+    """Create the daily partitions from days_behind ago to days_ahead from today, if missing"""
+    today = datetime.now(timezone('US/Eastern')).date()
+    return create_partitions(
+        engine, [(today + timedelta(days=offset)).strftime('%Y%m%d')
+                 for offset in range(-days_behind, days_ahead + 1)], table=table)
+
+
+def create_partitions(engine, created_dates, table=PARTITIONED_TABLE):
+    """Create the daily partitions of eastern dates ('YYYYMMDD'), if missing"""
+    with engine.begin() as conn:
+        if not is_partitioned(conn, table=table):
+            return []
+        existing = set(list_partition_dates(conn, table=table))
+        created = []
+        for created_date in sorted(set(created_dates)):
+            if created_date in existing:
+                continue
+            start_ms, end_ms = convert_date_to_tsinterval(created_date)
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {partition_name(created_date, table=table)} "
+                f"PARTITION OF {table} FOR VALUES FROM ({start_ms}) TO ({end_ms})"
+            ))
+            created.append(created_date)
+    if created:
+        logging.info(f"Created {table} partitions: {created}")
+    return created
+
+
+def partition_date(inserted_at):
+    """Eastern date ('YYYYMMDD') of the partition holding an inserted_at (epoch ms)"""
+    return datetime.fromtimestamp(inserted_at / 1000, tz=timezone('US/Eastern')).strftime('%Y%m%d')
+
+
+def is_missing_partition_error(error):
+    """True if an insert failed because no partition accepts one of its rows"""
+    return 'no partition of relation' in str(error)
+
+
+def drop_expired_partitions(engine, retention_days, detach_only=False, before_drop=None,
+                            table=PARTITIONED_TABLE):
+    """
+    Detach the partitions of days older than retention_days, and drop them
+    unless detach_only. before_drop(created_date) runs first for each one,
+    e.g. to archive it, a partition is kept attached if it raises.
+    """
+    with engine.connect() as conn:
+        if not is_partitioned(conn, table=table):
+            return []
+        partition_dates = list_partition_dates(conn, table=table)
+    oldest_kept = (datetime.now(timezone('US/Eastern')).date()
+                   - timedelta(days=retention_days)).strftime('%Y%m%d')
+    removed = []
+    for created_date in partition_dates:
+        if created_date >= oldest_kept:
+            break
+        name = partition_name(created_date, table=table)
+        if before_drop is not None:
+            try:
+                before_drop(created_date)
+            except Exception as e:
+                logging.error(f"Keeping partition {name}, before_drop failed: {e}")
+                continue
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            if not detach_only:
+                conn.execute(text(f"DROP TABLE {name}"))
+        removed.append(created_date)
+    if removed:
+        action = 'Detached' if detach_only else 'Dropped'
+        logging.info(f"{action} {table} partitions older than {retention_days} days: {removed}")
+    return removed
@@ -0,0 +1,202 @@
+"""
+Crypto price time series
+
+CryptoPriceApi writes one raw sample per coin per minute to crypto_prices.
+compact_prices() downsamples closed buckets into OHLC bars in
+crypto_price_bars at 5 minute, hourly and daily resolution, each level built
+from the one below it, and prune_prices() removes raw samples and 5 minute
+bars past their retention once they are compacted. Buckets are fixed epoch
+intervals, so daily bars are UTC days.
+
+fetch_price_range() serves a time window from the finest level that keeps it
+under max_points rows and is still retained, so a year long chart reads a few
+hundred daily bars instead of half a million raw samples.
+"""
+import logging
+import time
+from itertools import groupby
+
+from sqlalchemy import select, func, literal
+
+from models import Price, PriceBar
+from settings import PRICE_RAW_RETENTION_DAYS, PRICE_5M_RETENTION_DAYS
+
+
+MINUTE_MS = 60 * 1000
+HOUR_MS = 60 * MINUTE_MS
+DAY_MS = 24 * HOUR_MS
+RAW_RESOLUTION = '1m'
+# Bar levels, finest first: (resolution, bucket ms)
+BAR_RESOLUTIONS = [('5m', 5 * MINUTE_MS), ('1h', HOUR_MS), ('1d', DAY_MS)]
+# Every readable level with its retention in days, None for kept forever
+PRICE_LEVELS = [
+    (RAW_RESOLUTION, MINUTE_MS, PRICE_RAW_RETENTION_DAYS),
+    ('5m', 5 * MINUTE_MS, PRICE_5M_RETENTION_DAYS),
+    ('1h', HOUR_MS, None),
+    ('1d', DAY_MS, None),
+]
+# Buckets aggregated per read and insert while compacting
+BUCKETS_PER_CHUNK = 288
+
+
+# pylint: disable=logging-fstring-interpolation
+def _now_ms():
+    return int(round(time.time() * 1000))
+
+
+def _select_level(level):
+    """
+    Select (coin_type, ts, open, high, low, close, sample_count) of a level,
+    raw samples look like one-sample bars. Returns the select with its
+    coin_type and ts columns to filter and order by.
+    """
+    if level == RAW_RESOLUTION:
+        table = Price.__table__
+        price = table.c.price_usd
+        return select([
+            table.c.coin_type, table.c.inserted_at, price.label('open'), price.label('high'),
+            price.label('low'), price.label('close'), literal(1).label('sample_count')
+        ]).where(price.isnot(None)), table.c.coin_type, table.c.inserted_at
+    table = PriceBar.__table__
+    return select([
+        table.c.coin_type, table.c.bucket_start, table.c.open, table.c.high,
+        table.c.low, table.c.close, table.c.sample_count
+    ]).where(table.c.resolution == level), table.c.coin_type, table.c.bucket_start
+
+
+def _aggregate(rows, resolution, bucket_ms):
+    """Fold rows ordered by (coin_type, ts) into one bar per (coin_type, bucket)"""
+    bars = []
+    for (coin_type, bucket_start), group in groupby(
+            rows, key=lambda row: (row[0], row[1] // bucket_ms * bucket_ms)):
+        group = list(group)
+        bars.append({
+            'coin_type': coin_type,
+            'resolution': resolution,
+            'bucket_start': bucket_start,
+            'open': group[0][2],
+            'high': max(row[3] for row in group),
+            'low': min(row[4] for row in group),
+            'close': group[-1][5],
+            'sample_count': sum(row[6] for row in group),
+        })
+    return bars
+
+
+def _compact_level(engine, resolution, bucket_ms, source, now_ms):
+    """Write the closed buckets of resolution after its latest bar, from the source level"""
+    bars = PriceBar.__table__
+    source_stmt, source_coin, source_ts = _select_level(source)
+    # Buckets starting before this one are closed
+    end = now_ms // bucket_ms * bucket_ms
+    with engine.connect() as conn:
+        last = conn.execute(select([func.max(bars.c.bucket_start)])
+                            .where(bars.c.resolution == resolution)).scalar()
+        if last is None:
+            first = conn.execute(
+                source_stmt.with_only_columns([func.min(source_ts)])).scalar()
+            if first is None:
+                return 0
+            start = first // bucket_ms * bucket_ms
+        else:
+            start = last + bucket_ms
+
+    written = 0
+    while start < end:
+        chunk_end = min(start + bucket_ms * BUCKETS_PER_CHUNK, end)
+        with engine.begin() as conn:
+            rows = conn.execute(
+                source_stmt.where(source_ts >= start).where(source_ts < chunk_end)
+                .order_by(source_coin, source_ts)).fetchall()
+            new_bars = _aggregate(rows, resolution, bucket_ms)
+            if new_bars:
+                conn.execute(bars.insert(), new_bars)
+        written += len(new_bars)
+        start = chunk_end
+    return written
+
+
+def compact_prices(engine, now_ms=None):
+    """
+    Downsample closed buckets into 5 minute, hourly then daily bars, each level
+    from the one below. Only buckets after the latest bar of a level are written,
+    so a run is cheap and an interrupted one resumes where it stopped.
+
+    Returns:
+        dict -- Bars written per resolution
+    """
+    now_ms = now_ms or _now_ms()
+    written = {}
+    source = RAW_RESOLUTION
+    for resolution, bucket_ms in BAR_RESOLUTIONS:
+        written[resolution] = _compact_level(engine, resolution, bucket_ms, source, now_ms)
+        source = resolution
+    logging.info(f"Compacted price bars: {written}")
+    return written
+
+
+def prune_prices(engine, raw_retention_days=PRICE_RAW_RETENTION_DAYS,
+                 bar_5m_retention_days=PRICE_5M_RETENTION_DAYS, now_ms=None):
+    """Delete raw samples and 5 minute bars past retention, never before they are compacted"""
+    now_ms = now_ms or _now_ms()
+    prices = Price.__table__
+    bars = PriceBar.__table__
+    deleted = {}
+    with engine.begin() as conn:
+        for level, retention_days, compacted_into, bucket_ms in [
+                (RAW_RESOLUTION, raw_retention_days, '5m', 5 * MINUTE_MS),
+                ('5m', bar_5m_retention_days, '1h', HOUR_MS)]:
+            last = conn.execute(select([func.max(bars.c.bucket_start)])
+                                .where(bars.c.resolution == compacted_into)).scalar()
+            if last is None:
+                deleted[level] = 0
+                continue
+            cutoff = min(now_ms - retention_days * DAY_MS, last + bucket_ms)
+            if level == RAW_RESOLUTION:
+                stmt = prices.delete().where(prices.c.inserted_at < cutoff)
+            else:
+                stmt = bars.delete().where(
+                    (bars.c.resolution == level) & (bars.c.bucket_start < cutoff))
+            deleted[level] = conn.execute(stmt).rowcount
+    logging.info(f"Pruned price rows: {deleted}")
+    return deleted
+
+
+def choose_price_level(start_ms, end_ms, max_points=500, now_ms=None):
+    """Finest (resolution, bucket ms) with at most max_points buckets in the window, still retained"""
+    now_ms = now_ms or _now_ms()
+    for resolution, bucket_ms, retention_days in PRICE_LEVELS:
+        if (end_ms - start_ms) / bucket_ms > max_points:
+            continue
+        if retention_days is not None and start_ms < now_ms - retention_days * DAY_MS:
+            continue
+        return resolution, bucket_ms
+    return PRICE_LEVELS[-1][:2]
+
+
+def fetch_price_range(engine, coin_type, start_ms, end_ms, max_points=500, now_ms=None):
+    """
+    Price series of coin_type in [start_ms, end_ms) at the resolution picked by
+    choose_price_level. Bars only cover closed and compacted buckets.
+
+    Arguments:
+        engine {Engine} -- Database engine
+        coin_type {str} -- BTC or ADA
+        start_ms {int} -- Window start, epoch milliseconds
+        end_ms {int} -- Window end, epoch milliseconds
+
+    Keyword Arguments:
+        max_points {int} -- Max rows to read
+        now_ms {int} -- Current time to check retention against, defaults to now
+
+    Returns:
+        tuple -- (resolution, [(ts, open, high, low, close), ...] oldest first)
+    """
+    resolution, _ = choose_price_level(start_ms, end_ms, max_points=max_points, now_ms=now_ms)
+    stmt, coin, ts = _select_level(resolution)
+    stmt = (stmt.where(coin == coin_type)
+            .where(ts >= int(start_ms)).where(ts < int(end_ms))
+            .order_by(ts))
+    with engine.connect() as conn:
+        rows = conn.execute(stmt).fetchall()
+    return resolution, [tuple(row[1:6]) for row in rows]
@@ -1,53 +1,227 @@
-"""Query helpers"""
+"""
+Query helpers
+
+Every query is a SQLAlchemy Core statement with bound parameters, wrapped in
+a named PreparedQuery. Builders return a BoundQuery, the statement and this
+call's values. The SQL text never changes between calls, so on Postgres each
+connection PREPAREs a query once and EXECUTEs it from then on, and the server
+can reuse its plan instead of planning a new literal every refresh bucket.
+Other dialects execute the statement as is. Cache keys are built from the
+endpoint and its parameters (cache.py), never from SQL text.
+
+All time windows filter on the native BIGINT inserted_at (epoch ms) next to
+track_term, so they are served by the (track_term, inserted_at) index. Epoch
+bounds are bound as BigInteger: a float would make Postgres compare the
+column as numeric and skip the index. Check a plan with BoundQuery.explain(),
+or all of them with explain_queries.py.
+
+Count charts do not touch crypto_tweets: they read the per-minute, per-hour
+and per-day rollup tables the ingester upserts with every batch, so their
+cost is one row per bucket regardless of tweet volume.
+
+Execution time of every query, and its planning time sampled with EXPLAIN at
+most every QUERY_PLAN_SAMPLE_SECONDS, are kept per process, see query_stats().
+"""
+import logging
+import re
+import time as timer
+from collections import namedtuple
 from datetime import datetime, timedelta, time
 from pytz import timezone
+from sqlalchemy import BigInteger, Integer, String, and_, bindparam, func, literal_column, select
+from sqlalchemy.dialects import postgresql
+
 from constants import YANG_TERM
+from models import Tweet, TweetDailyCount, TweetMinuteCount, TweetHourCount
+from settings import QUERY_PLAN_SAMPLE_SECONDS
+
+
+tweets = Tweet.__table__
+daily_counts = TweetDailyCount.__table__
+PLANNING_TIME = re.compile(r'Planning [Tt]ime: ([0-9.]+) ms')
+
+
+# pylint: disable=logging-fstring-interpolation
+class PreparedQuery:
+    """A named Core statement, prepared once per Postgres connection"""
+    def __init__(self, name, statement):
+        """
+        Arguments:
+            name {str} -- Name of the prepared statement, a SQL identifier
+            statement {Select} -- Core statement, values as bindparam()
+        """
+        self.name = name
+        self.statement = statement
+        self._postgres = None
+        # Counters
+        self.calls = 0
+        self.seconds = 0.0
+        self.planning_ms = None
+        self.planned_at = None
+
+    def execute(self, conn, params):
+        """Rows as tuples in select order, conn is a Connection, e.g. Session.connection()"""
+        t0 = timer.perf_counter()
+        if conn.dialect.name == 'postgresql':
+            rows = self._execute_prepared(conn, params)
+            self._maybe_sample_plan(conn, params)
+        else:
+            rows = [tuple(row) for row in conn.execute(self.statement, params)]
+        self.calls += 1
+        self.seconds += timer.perf_counter() - t0
+        return rows
+
+    def explain(self, conn, params, options='SUMMARY'):
+        """Plan lines of the prepared query, e.g. options='ANALYZE, BUFFERS' to also run it"""
+        return self._cursor_execute(conn, params, f"EXPLAIN ({options}) EXECUTE {self.name}")
+
+    def literal_sql(self, params):
+        """Postgres SQL with the values inlined, as the builders used to render it"""
+        return str(self.statement.params(params).compile(
+            dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'mean_ms': round(self.seconds / self.calls * 1000, 3) if self.calls else None,
+            'planning_ms': self.planning_ms,
+        }
+
+    def _execute_prepared(self, conn, params):
+        return self._cursor_execute(conn, params, f"EXECUTE {self.name}")
+
+    def _cursor_execute(self, conn, params, command):
+        sql, names, defaults = self._postgres_sql()
+        values = {**defaults, **params}
+        # Prepared statements live as long as the db connection, so do the names
+        dbapi_conn = conn.connection
+        prepared = dbapi_conn.info.setdefault('prepared_queries', set())
+        cursor = dbapi_conn.cursor()
+        try:
+            if self.name not in prepared:
+                cursor.execute(f"PREPARE {self.name} AS {sql}")
+                prepared.add(self.name)
+            if names:
+                command += f" ({', '.join(['%s'] * len(names))})"
+            cursor.execute(command, [values[name] for name in names])
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _postgres_sql(self):
+        """Compiled statement with $n placeholders, its parameter names in order, and defaults"""
+        if self._postgres is None:
+            compiled = self.statement.compile(dialect=postgresql.dialect())
+            names = []
 
+            def placeholder(match):
+                if match.group(1) not in names:
+                    names.append(match.group(1))
+                return f"${names.index(match.group(1)) + 1}"
+            sql = re.sub(r'%\((\w+)\)s', placeholder, compiled.string).replace('%%', '%')
+            self._postgres = (sql, names, dict(compiled.params))
+        return self._postgres
 
-def query_last_n(tablename, n=5, track_term=YANG_TERM):
-    """Query the last n tweets with track_term"""
-    return (f"SELECT * FROM {tablename} WHERE track_term = '{track_term}' "
-            f"ORDER BY id DESC LIMIT {str(n)};")
+    def _maybe_sample_plan(self, conn, params):
+        if not QUERY_PLAN_SAMPLE_SECONDS:
+            return
+        now = timer.monotonic()
+        if self.planned_at is not None and now - self.planned_at < QUERY_PLAN_SAMPLE_SECONDS:
+            return
+        self.planned_at = now
+        try:
+            for line, in self.explain(conn, params):
+                match = PLANNING_TIME.search(line)
+                if match:
+                    self.planning_ms = float(match.group(1))
+                    logging.info(f"Query {self.name}: planning took {self.planning_ms}ms")
+        except Exception as e:
+            logging.error(f"Sampling the plan of {self.name} failed: {e}")
+
+
+class BoundQuery(namedtuple('BoundQuery', ['prepared', 'params'])):
+    """A PreparedQuery with the values of one call"""
+    def execute(self, conn):
+        return self.prepared.execute(conn, self.params)
+
+    def explain(self, conn, options='SUMMARY'):
+        return self.prepared.explain(conn, self.params, options)
+
+    def __str__(self):
+        return self.prepared.literal_sql(self.params)
+
+
+_prepared = {}
+
+
+def _query(name, build):
+    """The PreparedQuery called name, its statement is built on first use"""
+    if name not in _prepared:
+        _prepared[name] = PreparedQuery(name, build())
+    return _prepared[name]
+
+
+def query_stats():
+    """Per query calls, mean execution time and last sampled planning time, this process only"""
+    return {name: query.stats() for name, query in _prepared.items()}
+
+
+def _epoch_ms_ago(delta, refresh_in_seconds):
+    """Epoch ms of now - delta, floored to refresh_in_seconds, so it only changes per bucket"""
+    dt_ago = datetime.now() - delta
+    return int(dt_ago.timestamp() // refresh_in_seconds * refresh_in_seconds * 1000)
+
+
+def query_last_n(n=5, track_term=YANG_TERM):
+    """Query the text of the last n tweets with track_term, like Database.fetch_latest_tweets"""
+    return BoundQuery(_query('q_last_n', lambda: (
+        select([tweets.c.tweet_text])
+        .where(tweets.c.track_term == bindparam('track_term', type_=String))
+        .order_by(tweets.c.id.desc())
+        .limit(bindparam('n', type_=Integer))
+    )), {'track_term': track_term, 'n': n})
 
 
 def query_tweet_count(track_term, created_date):
     """Query the tweet count for the current day (US eastern time)"""
-    return (f"SELECT tweet_count FROM tweet_daily_count WHERE track_term = '{track_term}' AND "
-            f"created_date = '{created_date}';")
+    return BoundQuery(_query('q_tweet_count', lambda: (
+        select([daily_counts.c.tweet_count])
+        .where(and_(daily_counts.c.track_term == bindparam('track_term', type_=String),
+                    daily_counts.c.created_date == bindparam('created_date', type_=String)))
+    )), {'track_term': track_term, 'created_date': created_date})
 
 
-def query_all_tweets(track_term=YANG_TERM):
+def query_all_tweets(track_term=YANG_TERM, colname='tweet_text'):
     """All tweets in the last 6hr at 6hr refresh, excluding retweets"""
-    dt_ago = datetime.now() - timedelta(hours=6)
-    refresh_in_seconds = 6 * 60 * 60
-    epochms_ago = dt_ago.timestamp() // refresh_in_seconds * refresh_in_seconds * 1000
-    return (f"SELECT tweet_text "
-            f"FROM crypto_tweets "
-            f"WHERE inserted_at::bigint >= {epochms_ago} AND track_term = '{track_term}' "
-            f"AND retweeted_status_id_str is NULL")
+    return BoundQuery(_query(f"q_all_tweets_{colname}", lambda: (
+        select([tweets.c[colname]])
+        .where(and_(tweets.c.inserted_at >= bindparam('since', type_=BigInteger),
+                    tweets.c.track_term == bindparam('track_term', type_=String),
+                    tweets.c.retweeted_status_id_str.is_(None)))
+    )), {'since': _epoch_ms_ago(timedelta(hours=6), 6 * 60 * 60), 'track_term': track_term})
 
 
 def query_retweet_count(colname='retweeted_status_id_str', track_term='andrewyang', top_n=10, n_hours=6):
-    """Query top n retweeted tweet ids for the last n_hours, refresh every 30min"""
-    dt_nhr_ago = datetime.now() - timedelta(hours=n_hours)
-    thirtymin_in_seconds = 30 * 60
-    epochms_nhr_ago = dt_nhr_ago.timestamp() // thirtymin_in_seconds * thirtymin_in_seconds * 1000
-    return (f"SELECT COUNT(*), {colname} "
-            f"FROM crypto_tweets "
-            f"WHERE inserted_at::bigint >= {epochms_nhr_ago} "
-            f"AND track_term = '{track_term}' "
-            f"AND {colname} is not NULL "
-            f"GROUP BY {colname} "
-            f"ORDER BY COUNT(*) DESC LIMIT {top_n}")
+    """Query top n retweeted tweet ids and their counts for the last n_hours, refresh every 30min"""
+    def build():
+        column = tweets.c[colname]
+        return (select([column, func.count().label('count')])
+                .where(and_(tweets.c.inserted_at >= bindparam('since', type_=BigInteger),
+                            tweets.c.track_term == bindparam('track_term', type_=String),
+                            column.isnot(None)))
+                .group_by(column)
+                .order_by(func.count().desc())
+                .limit(bindparam('top_n', type_=Integer)))
+    return BoundQuery(_query(f"q_retweet_count_{colname}", build), {
+        'since': _epoch_ms_ago(timedelta(hours=n_hours), 30 * 60),
+        'track_term': track_term, 'top_n': top_n})
 
 
 def query_count_nhr_at_xmin(n_hours, x_mins, track_term, count_colname, interval_colname):
-    dt_nhr_ago = datetime.now() - timedelta(hours=n_hours)
     xmin_in_seconds = 60 * x_mins
-    epochms_nhr_ago = dt_nhr_ago.timestamp() // xmin_in_seconds * xmin_in_seconds * 1000
     return _query_count_period_at_granularity(
         track_term,
-        period_start=epochms_nhr_ago,
+        period_start=_epoch_ms_ago(timedelta(hours=n_hours), xmin_in_seconds),
         granularity=xmin_in_seconds,
         count_colname=count_colname,
         interval_colname=interval_colname
@@ -57,43 +231,64 @@ def query_count_nhr_at_xmin(n_hours, x_mins, track_term, count_colname, interval
 def query_count_14d_at_1d(track_term, count_colname, interval_colname):
     n_days = 15
     dt_14d_ago = datetime.now() - timedelta(days=n_days)
-    dt_14d_ago_local = timezone('US/Eastern').localize(dt_14d_ago)
-    dt_14d_ago_localmidnight = dt_14d_ago_local.replace(hour=0, minute=0, second=0, microsecond=0)
-    epochms_14d_ago = dt_14d_ago_localmidnight.timestamp() * 1000
-    return (f"SELECT d.date AS {interval_colname}, count(ct.id) AS {count_colname} "
-            f"FROM (SELECT to_char(date_trunc('day', (current_date - offs)), 'YYYY-MM-DD') AS date "
-            f"FROM generate_series(0, {n_days}) AS offs) d LEFT OUTER JOIN "
-            f"crypto_tweets ct "
-            f"ON d.date = to_char(date_trunc('day', ct.created_at::timestamp "
-            f"with time zone at time zone 'US/Eastern'), 'YYYY-MM-DD') "
-            f"WHERE ct.inserted_at::bigint >= {epochms_14d_ago} AND ct.track_term = '{track_term}' "
-            f"GROUP BY d.date;")
+    created_date_14d_ago = timezone('US/Eastern').localize(dt_14d_ago).strftime("%Y%m%d")
+    # One tweet_daily_count row per eastern day, kept up to date by the ingester
+    return BoundQuery(_query(f"q_count_14d_at_1d_{interval_colname}_{count_colname}", lambda: (
+        select([
+            func.to_char(func.to_date(daily_counts.c.created_date, literal_column("'YYYYMMDD'")),
+                         literal_column("'YYYY-MM-DD'")).label(interval_colname),
+            daily_counts.c.tweet_count.label(count_colname)])
+        .where(and_(daily_counts.c.track_term == bindparam('track_term', type_=String),
+                    daily_counts.c.created_date >= bindparam('since_date', type_=String)))
+    )), {'track_term': track_term, 'since_date': created_date_14d_ago})
 
 
 def query_count_group_by_location(track_term, colname='location', n_hours=72):
-    """Query top n retweeted tweet ids for the last n_hours, refresh every 30min"""
-    dt_nhr_ago = datetime.now() - timedelta(hours=n_hours)
-    hour_in_seconds = 60 * 60
-    epochms_nhr_ago = dt_nhr_ago.timestamp() // hour_in_seconds * hour_in_seconds * 1000
-    return (f"SELECT COUNT(*), user_location AS {colname} "
-            f"FROM crypto_tweets "
-            f"WHERE inserted_at::bigint >= {epochms_nhr_ago} "
-            f"AND track_term = '{track_term}' "
-            f"AND user_location is not NULL "
-            f"GROUP BY user_location "
-            f"ORDER BY COUNT(*) DESC")
+    """Query (location, count) per user_location for the last n_hours, refresh every hour"""
+    return BoundQuery(_query(f"q_count_by_location_{colname}", lambda: (
+        select([tweets.c.user_location.label(colname), func.count().label('count')])
+        .where(and_(tweets.c.inserted_at >= bindparam('since', type_=BigInteger),
+                    tweets.c.track_term == bindparam('track_term', type_=String),
+                    tweets.c.user_location.isnot(None)))
+        .group_by(tweets.c.user_location)
+        .order_by(func.count().desc())
+    )), {'since': _epoch_ms_ago(timedelta(hours=n_hours), 60 * 60), 'track_term': track_term})
+
+
+def query_count_group_by_state(track_term, colname='location', n_hours=72, top_n=15):
+    """Query (state, count) per US state (resolved at ingest time) for the last n_hours"""
+    return BoundQuery(_query(f"q_count_by_state_{colname}", lambda: (
+        select([tweets.c.user_state.label(colname), func.count().label('count')])
+        .where(and_(tweets.c.inserted_at >= bindparam('since', type_=BigInteger),
+                    tweets.c.track_term == bindparam('track_term', type_=String),
+                    tweets.c.user_state.isnot(None)))
+        .group_by(tweets.c.user_state)
+        .order_by(func.count().desc())
+        .limit(bindparam('top_n', type_=Integer))
+    )), {'since': _epoch_ms_ago(timedelta(hours=n_hours), 60 * 60),
+         'track_term': track_term, 'top_n': top_n})
 
 
 def _query_count_period_at_granularity(
         track_term, period_start, granularity, count_colname, interval_colname
 ):
-    granularity_ms = granularity * 1000
-    return (f"SELECT COUNT(*) {count_colname}, "
-            f"to_timestamp(floor((inserted_at::bigint / {granularity_ms} )) * {granularity}) "
-            f"AT TIME ZONE 'US/Eastern' as {interval_colname} "
-            f"FROM crypto_tweets "
-            f"WHERE inserted_at::bigint >= {period_start} AND track_term = '{track_term}' "
-            f"GROUP BY {interval_colname}")
+    """Sum the hour or minute rollup rows into granularity (seconds) buckets, as (interval, count)"""
+    rollup = TweetHourCount.__table__ if granularity % 3600 == 0 else TweetMinuteCount.__table__
+
+    def build():
+        interval = func.to_timestamp(
+            func.floor(rollup.c.bucket_start / bindparam('granularity_ms', type_=BigInteger))
+            * bindparam('granularity', type_=BigInteger)
+        ).op('AT TIME ZONE')(literal_column("'US/Eastern'"))
+        return (select([interval.label(interval_colname),
+                        func.sum(rollup.c.tweet_count).label(count_colname)])
+                .where(and_(rollup.c.bucket_start >= bindparam('since', type_=BigInteger),
+                            rollup.c.track_term == bindparam('track_term', type_=String)))
+                .group_by(literal_column(interval_colname)))
+    return BoundQuery(
+        _query(f"q_count_{rollup.name}_{interval_colname}_{count_colname}", build), {
+            'granularity_ms': granularity * 1000, 'granularity': granularity,
+            'since': period_start, 'track_term': track_term})
 
 
 """
@@ -11,7 +11,7 @@ from alembic import context
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
 
-from models import Tweet, TweetDailyCount, Price
+from models import Tweet, TweetDailyCount, TweetMinuteCount, TweetHourCount, Price, PriceBar
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -0,0 +1,48 @@
+"""tweet_minute_count and tweet_hour_count rollups
+
+Revision ID: 2d7e5c91a8b3
+Revises: f19c3a72b8e5
+Create Date: 2019-10-27 16:05:38.214907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d7e5c91a8b3'
+down_revision = 'f19c3a72b8e5'
+branch_labels = None
+depends_on = None
+
+ROLLUPS = [
+    ('tweet_minute_count', 60 * 1000),
+    ('tweet_hour_count', 60 * 60 * 1000),
+]
+
+
+def upgrade():
+    for table, bucket_ms in ROLLUPS:
+        op.create_table(
+            table,
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('track_term', sa.String(), nullable=True),
+            sa.Column('bucket_start', sa.BigInteger(), nullable=True),
+            sa.Column('tweet_count', sa.Integer(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('track_term', 'bucket_start',
+                                name=f"uq_{table}_term_bucket")
+        )
+        # Backfill from the tweets still in retention, the ingester keeps them up to
+        # date from here on. Upgrade with the ingester stopped so nothing is counted twice.
+        op.execute(
+            f"INSERT INTO {table} (track_term, bucket_start, tweet_count) "
+            f"SELECT track_term, inserted_at / {bucket_ms} * {bucket_ms}, COUNT(*) "
+            f"FROM crypto_tweets WHERE track_term IS NOT NULL "
+            f"GROUP BY 1, 2"
+        )
+
+
+def downgrade():
+    for table, _ in reversed(ROLLUPS):
+        op.drop_table(table)
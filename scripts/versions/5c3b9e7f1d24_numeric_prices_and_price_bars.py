@@ -0,0 +1,47 @@
+"""numeric crypto_prices, (coin_type, inserted_at) index and crypto_price_bars
+
+Revision ID: 5c3b9e7f1d24
+Revises: 8a4f0c6e2b19
+Create Date: 2019-10-30 19:12:56.508331
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c3b9e7f1d24'
+down_revision = '8a4f0c6e2b19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Empty strings were stored for missing prices
+    op.alter_column('crypto_prices', 'price_usd',
+                    type_=sa.Numeric(20, 8),
+                    postgresql_using="NULLIF(price_usd, '')::numeric(20, 8)")
+    op.create_index('ix_crypto_prices_coin_type_inserted_at', 'crypto_prices',
+                    ['coin_type', 'inserted_at'])
+    op.create_table(
+        'crypto_price_bars',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('coin_type', sa.String(), nullable=True),
+        sa.Column('resolution', sa.String(), nullable=True),
+        sa.Column('bucket_start', sa.BigInteger(), nullable=True),
+        sa.Column('open', sa.Numeric(20, 8), nullable=True),
+        sa.Column('high', sa.Numeric(20, 8), nullable=True),
+        sa.Column('low', sa.Numeric(20, 8), nullable=True),
+        sa.Column('close', sa.Numeric(20, 8), nullable=True),
+        sa.Column('sample_count', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('coin_type', 'resolution', 'bucket_start',
+                            name='uq_crypto_price_bars_coin_resolution_bucket')
+    )
+
+
+def downgrade():
+    op.drop_table('crypto_price_bars')
+    op.drop_index('ix_crypto_prices_coin_type_inserted_at', table_name='crypto_prices')
+    op.alter_column('crypto_prices', 'price_usd', type_=sa.String(),
+                    postgresql_using='price_usd::text')
@@ -0,0 +1,36 @@
+"""unique tweet_daily_count (created_date, track_term)
+
+Revision ID: 6f2c1d9e4a07
+Revises: 1bb1a7ae385d
+Create Date: 2019-10-14 21:12:40.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6f2c1d9e4a07'
+down_revision = '1bb1a7ae385d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Merge any duplicate (created_date, track_term) rows before adding the constraint
+    op.execute(
+        "UPDATE tweet_daily_count t SET tweet_count = d.total "
+        "FROM (SELECT created_date, track_term, SUM(tweet_count) AS total, MIN(id) AS keep_id "
+        "FROM tweet_daily_count GROUP BY created_date, track_term HAVING COUNT(*) > 1) d "
+        "WHERE t.id = d.keep_id"
+    )
+    op.execute(
+        "DELETE FROM tweet_daily_count t USING tweet_daily_count k "
+        "WHERE t.created_date = k.created_date AND t.track_term = k.track_term AND t.id > k.id"
+    )
+    op.create_unique_constraint(
+        'uq_tweet_daily_count_date_term', 'tweet_daily_count', ['created_date', 'track_term'])
+
+
+def downgrade():
+    op.drop_constraint('uq_tweet_daily_count_date_term', 'tweet_daily_count', type_='unique')
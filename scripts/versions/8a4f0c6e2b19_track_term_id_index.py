@@ -0,0 +1,26 @@
+"""crypto_tweets (track_term, id DESC) index for the latest tweets
+
+Revision ID: 8a4f0c6e2b19
+Revises: 2d7e5c91a8b3
+Create Date: 2019-10-28 20:31:09.742615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4f0c6e2b19'
+down_revision = '2d7e5c91a8b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Created on the partitioned parent, so every daily partition gets one
+    op.create_index('ix_crypto_tweets_track_term_id', 'crypto_tweets',
+                    ['track_term', sa.text('id DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_crypto_tweets_track_term_id', table_name='crypto_tweets')
@@ -0,0 +1,29 @@
+"""unique index on crypto_tweets.tweet_id
+
+Revision ID: a3e8b51c7d20
+Revises: 6f2c1d9e4a07
+Create Date: 2019-10-16 19:40:02.517731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3e8b51c7d20'
+down_revision = '6f2c1d9e4a07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Drop tweets inserted twice by stream reconnects, keep the first copy
+    op.execute(
+        "DELETE FROM crypto_tweets t USING crypto_tweets k "
+        "WHERE t.tweet_id = k.tweet_id AND t.id > k.id"
+    )
+    op.create_index('uq_crypto_tweets_tweet_id', 'crypto_tweets', ['tweet_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_crypto_tweets_tweet_id', table_name='crypto_tweets')
@@ -0,0 +1,39 @@
+"""add ingest-time derived columns to crypto_tweets
+
+Revision ID: c81f0e6b2d45
+Revises: a3e8b51c7d20
+Create Date: 2019-10-19 15:22:48.904112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f0e6b2d45'
+down_revision = 'a3e8b51c7d20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('crypto_tweets', sa.Column('user_state', sa.String(), nullable=True))
+    op.add_column('crypto_tweets', sa.Column('tweet_tokens', sa.String(), nullable=True))
+    op.add_column('crypto_tweets', sa.Column('is_retweet', sa.Boolean(), nullable=True))
+    op.add_column('crypto_tweets', sa.Column('is_reply', sa.Boolean(), nullable=True))
+    # The flags are cheap to backfill here. State and tokens need the Python location
+    # lookup and tokenizer: run jobs/backfill_enrichment.py right after this migration,
+    # in batches outside of its transaction, or the location chart and the wordcloud
+    # only show tweets written since the deploy
+    op.execute(
+        "UPDATE crypto_tweets SET "
+        "is_retweet = retweeted_status_id_str IS NOT NULL, "
+        "is_reply = in_reply_to_status_id_str IS NOT NULL"
+    )
+
+
+def downgrade():
+    op.drop_column('crypto_tweets', 'is_reply')
+    op.drop_column('crypto_tweets', 'is_retweet')
+    op.drop_column('crypto_tweets', 'tweet_tokens')
+    op.drop_column('crypto_tweets', 'user_state')
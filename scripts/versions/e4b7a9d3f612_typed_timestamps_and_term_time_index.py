@@ -0,0 +1,43 @@
+"""native timestamp columns and (track_term, inserted_at) index
+
+Revision ID: e4b7a9d3f612
+Revises: c81f0e6b2d45
+Create Date: 2019-10-22 10:05:31.228460
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7a9d3f612'
+down_revision = 'c81f0e6b2d45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Twitter's 'Mon Jul 08 12:43:19 +0000 2019' parses as timestamptz directly
+    op.alter_column('crypto_tweets', 'created_at',
+                    type_=postgresql.TIMESTAMP(timezone=True),
+                    postgresql_using='created_at::timestamptz')
+    op.alter_column('crypto_tweets', 'inserted_at',
+                    type_=sa.BigInteger(),
+                    postgresql_using='inserted_at::bigint')
+    op.alter_column('crypto_prices', 'inserted_at',
+                    type_=sa.BigInteger(),
+                    postgresql_using='inserted_at::bigint')
+    op.create_index('ix_crypto_tweets_track_term_inserted_at', 'crypto_tweets',
+                    ['track_term', 'inserted_at'])
+
+
+def downgrade():
+    op.drop_index('ix_crypto_tweets_track_term_inserted_at', table_name='crypto_tweets')
+    op.alter_column('crypto_prices', 'inserted_at', type_=sa.String(),
+                    postgresql_using='inserted_at::text')
+    op.alter_column('crypto_tweets', 'inserted_at', type_=sa.String(),
+                    postgresql_using='inserted_at::text')
+    op.alter_column('crypto_tweets', 'created_at', type_=sa.String(),
+                    postgresql_using="to_char(created_at AT TIME ZONE 'UTC', "
+                                     "'Dy Mon DD HH24:MI:SS +0000 YYYY')")
@@ -0,0 +1,75 @@
+"""partition crypto_tweets by day on inserted_at
+
+Revision ID: f19c3a72b8e5
+Revises: e4b7a9d3f612
+Create Date: 2019-10-25 22:47:13.660152
+
+"""
+from datetime import datetime, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+from pytz import timezone
+
+
+# revision identifiers, used by Alembic.
+revision = 'f19c3a72b8e5'
+down_revision = 'e4b7a9d3f612'
+branch_labels = None
+depends_on = None
+
+EASTERN = timezone('US/Eastern')
+
+
+def _eastern_day_bounds_ms(day):
+    start = EASTERN.localize(datetime.combine(day, datetime.min.time()))
+    end = EASTERN.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+
+def upgrade():
+    # Needs Postgres 11+ (partitioned indexes). A unique index on a partitioned
+    # table must include the partition key, so tweet_id gets a plain index and
+    # the ingester dedups with a time-bounded anti-join instead of ON CONFLICT.
+    op.execute("ALTER TABLE crypto_tweets RENAME TO crypto_tweets_unpartitioned")
+    op.execute("ALTER INDEX uq_crypto_tweets_tweet_id "
+               "RENAME TO uq_crypto_tweets_unpartitioned_tweet_id")
+    op.execute("ALTER INDEX ix_crypto_tweets_track_term_inserted_at "
+               "RENAME TO ix_crypto_tweets_unpartitioned_track_term_inserted_at")
+    op.execute("CREATE TABLE crypto_tweets "
+               "(LIKE crypto_tweets_unpartitioned INCLUDING DEFAULTS) "
+               "PARTITION BY RANGE (inserted_at)")
+    op.execute("ALTER TABLE crypto_tweets ADD PRIMARY KEY (id, inserted_at)")
+    op.create_index('ix_crypto_tweets_track_term_inserted_at', 'crypto_tweets',
+                    ['track_term', 'inserted_at'])
+    op.create_index('ix_crypto_tweets_tweet_id', 'crypto_tweets', ['tweet_id'])
+
+    # One partition per eastern day from the oldest row to a week from now
+    conn = op.get_bind()
+    oldest_ms = conn.execute(sa.text(
+        "SELECT MIN(inserted_at) FROM crypto_tweets_unpartitioned")).scalar()
+    today = datetime.now(EASTERN).date()
+    day = datetime.fromtimestamp(oldest_ms / 1000, tz=EASTERN).date() if oldest_ms else today
+    while day <= today + timedelta(days=7):
+        start_ms, end_ms = _eastern_day_bounds_ms(day)
+        op.execute(f"CREATE TABLE crypto_tweets_p{day.strftime('%Y%m%d')} "
+                   f"PARTITION OF crypto_tweets FOR VALUES FROM ({start_ms}) TO ({end_ms})")
+        day += timedelta(days=1)
+
+    op.execute("INSERT INTO crypto_tweets SELECT * FROM crypto_tweets_unpartitioned")
+    # The id sequence is shared through the copied default, keep it when dropping
+    op.execute("ALTER SEQUENCE crypto_tweets_id_seq OWNED BY crypto_tweets.id")
+    op.execute("DROP TABLE crypto_tweets_unpartitioned")
+
+
+def downgrade():
+    op.execute("CREATE TABLE crypto_tweets_unpartitioned "
+               "(LIKE crypto_tweets INCLUDING DEFAULTS)")
+    op.execute("INSERT INTO crypto_tweets_unpartitioned SELECT * FROM crypto_tweets")
+    op.execute("ALTER TABLE crypto_tweets_unpartitioned ADD PRIMARY KEY (id)")
+    op.execute("ALTER SEQUENCE crypto_tweets_id_seq OWNED BY crypto_tweets_unpartitioned.id")
+    op.execute("DROP TABLE crypto_tweets CASCADE")
+    op.execute("ALTER TABLE crypto_tweets_unpartitioned RENAME TO crypto_tweets")
+    op.create_index('ix_crypto_tweets_track_term_inserted_at', 'crypto_tweets',
+                    ['track_term', 'inserted_at'])
+    op.create_index('uq_crypto_tweets_tweet_id', 'crypto_tweets', ['tweet_id'], unique=True)
@@ -18,3 +18,71 @@ DB_NAME = os.environ.get('DB_NAME')
 DB_USER = os.environ.get('DB_USER')
 DB_PASSWORD = os.environ.get('DB_PASSWORD')
 REDIS_URL = os.environ.get('REDIS_URL')
+# Database url of the web app and scheduler, e.g. a local load test db, the prod db if empty
+DATABASE_URL = os.environ.get('DATABASE_URL')
+# Ingest tuning: flush buffered tweets at this many rows or after this many seconds
+TWEET_BATCH_SIZE = int(os.environ.get('TWEET_BATCH_SIZE', 500))
+TWEET_FLUSH_SECONDS = float(os.environ.get('TWEET_FLUSH_SECONDS', 2))
+# Max tweets queued between the stream reader and the db writer thread
+TWEET_QUEUE_SIZE = int(os.environ.get('TWEET_QUEUE_SIZE', 50000))
+# Tweet ids seen within this many seconds are dropped as reconnect duplicates
+TWEET_DEDUP_WINDOW_SECONDS = float(os.environ.get('TWEET_DEDUP_WINDOW_SECONDS', 1800))
+# Worker processes computing derived tweet columns, 0 to compute them in the writer thread
+TWEET_ENRICH_PROCESSES = int(os.environ.get('TWEET_ENRICH_PROCESSES', 2))
+# Tweets that could not be written while the db was down, replayed once it is back
+TWEET_SPILL_FILE = os.environ.get(
+    'TWEET_SPILL_FILE', join(dirname(__file__), 'tweet_spill.jsonl'))
+# Track terms and aliases for the tweet stream, see the 'stream' section
+STREAM_CONFIG_FILE = os.environ.get(
+    'STREAM_CONFIG_FILE', join(dirname(__file__), 'config_prod.yml'))
+# crypto_tweets daily partitions: created this many days ahead, removed after retention
+TWEET_PARTITION_DAYS_AHEAD = int(os.environ.get('TWEET_PARTITION_DAYS_AHEAD', 7))
+TWEET_RETENTION_DAYS = int(os.environ.get('TWEET_RETENTION_DAYS', 30))
+# Detach expired partitions instead of dropping them
+TWEET_PARTITION_DETACH_ONLY = os.environ.get(
+    'TWEET_PARTITION_DETACH_ONLY', '').lower() in ('1', 'true')
+# crypto_prices raw samples and 5 minute bars are kept this many days, hourly and daily bars forever
+PRICE_RAW_RETENTION_DAYS = int(os.environ.get('PRICE_RAW_RETENTION_DAYS', 7))
+PRICE_5M_RETENTION_DAYS = int(os.environ.get('PRICE_5M_RETENTION_DAYS', 90))
+# tweet_minute_count rows are kept this many days, charts read at most the last 72 hours
+TWEET_MINUTE_COUNT_RETENTION_DAYS = int(os.environ.get('TWEET_MINUTE_COUNT_RETENTION_DAYS', 7))
+# Closed days of crypto_tweets are exported here as columnar segments before their partition is dropped
+TWEET_ARCHIVE_DIR = os.environ.get('TWEET_ARCHIVE_DIR', join(dirname(__file__), 'tweet_archive'))
+# Redis cache: keys live under CACHE_NAMESPACE:vCACHE_VERSION, bump the version to drop every entry
+CACHE_NAMESPACE = os.environ.get('CACHE_NAMESPACE', 'yangsentiment')
+CACHE_VERSION = int(os.environ.get('CACHE_VERSION', 2))
+# Max cache entries in the namespace, the ones closest to expiry are evicted first
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 500))
+# A cache miss is computed by one worker at a time, others wait up to this long for its result
+CACHE_LOCK_SECONDS = float(os.environ.get('CACHE_LOCK_SECONDS', 30))
+# Per process cache in front of Redis: max entries, and seconds before an entry is revalidated
+CACHE_L1_ENTRIES = int(os.environ.get('CACHE_L1_ENTRIES', 256))
+CACHE_L1_SECONDS = float(os.environ.get('CACHE_L1_SECONDS', 10))
+# Web workers only serve what the scheduler precomputed, and never query the db inline
+CACHE_PRECOMPUTE = os.environ.get('CACHE_PRECOMPUTE', '').lower() in ('1', 'true')
+# SSE streams: seconds between two messages, and messages buffered per client before it is dropped
+SSE_TICK_SECONDS = float(os.environ.get('SSE_TICK_SECONDS', 5))
+SSE_CLIENT_QUEUE_SIZE = int(os.environ.get('SSE_CLIENT_QUEUE_SIZE', 10))
+# SSE streams are pushed from the ingester's change events, and the db is polled only
+# when none came for SSE_PUSH_POLL_SECONDS. Pushes within SSE_COALESCE_SECONDS are sent as one
+SSE_PUSH = os.environ.get('SSE_PUSH', 'true').lower() in ('1', 'true')
+SSE_PUSH_POLL_SECONDS = float(os.environ.get('SSE_PUSH_POLL_SECONDS', 30))
+SSE_COALESCE_SECONDS = float(os.environ.get('SSE_COALESCE_SECONDS', 1))
+# Latest tweets kept per track term for the /latest_tweets stream, and the most a client can ask for
+LATEST_TWEETS_RING_SIZE = int(os.environ.get('LATEST_TWEETS_RING_SIZE', 200))
+# Asyncio SSE server (sse_server.py): max open streams per process and per client address,
+# 0 for no per address cap, and max seconds between two writes to a stream
+SSE_SERVER_MAX_CONNECTIONS = int(os.environ.get('SSE_SERVER_MAX_CONNECTIONS', 20000))
+SSE_SERVER_MAX_CONNECTIONS_PER_IP = int(os.environ.get('SSE_SERVER_MAX_CONNECTIONS_PER_IP', 16))
+# Comma separated addresses or networks of the proxies in front of the SSE server, e.g.
+# 10.0.0.0/8 for the Heroku router: the client address is then read from X-Forwarded-For.
+# Behind a proxy that is not listed, all viewers share its address and one per address cap:
+# list it, or set SSE_SERVER_MAX_CONNECTIONS_PER_IP to 0
+SSE_SERVER_TRUSTED_PROXIES = [
+    proxy.strip() for proxy in os.environ.get('SSE_SERVER_TRUSTED_PROXIES', '').split(',')
+    if proxy.strip()]
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+# Origin of the SSE streams in the dashboard, e.g. the asyncio SSE server, same origin if empty
+SSE_BASE_URL = os.environ.get('SSE_BASE_URL', '')
+# Planning time of each query is sampled with EXPLAIN at most this often per process, 0 to disable
+QUERY_PLAN_SAMPLE_SECONDS = float(os.environ.get('QUERY_PLAN_SAMPLE_SECONDS', 300))
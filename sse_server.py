@@ -0,0 +1,337 @@
+"""
+Asyncio SSE server
+
+Serves /yangcount and /latest_tweets like application.py, for many more
+viewers per process. A connection is one coroutine, a small bounded queue and
+its socket: no greenlet, no thread and no database session. Each stream is
+produced once per process from the ingester's change events (notify.py) and
+the latest tweets ring (tweet_ring.py), the database is never queried.
+
+    python sse_server.py --port 7801
+
+Point the dashboard at it with SSE_BASE_URL, or route both paths to it at
+the load balancer. No worker is ever recycled, so viewers are only dropped on
+deploys, and EventSource resumes /latest_tweets with Last-Event-ID.
+
+Memory target: at most 16 KB per idle connection over the process baseline,
+so one process holds 20k viewers in about 320 MB more than it starts with.
+Measure it with the load test before raising SSE_SERVER_MAX_CONNECTIONS.
+
+Connections over SSE_SERVER_MAX_CONNECTIONS, or over
+SSE_SERVER_MAX_CONNECTIONS_PER_IP from one address, get a 503 with
+Retry-After, which EventSource retries. Behind a load balancer, list it in
+SSE_SERVER_TRUSTED_PROXIES so the client address is read from
+X-Forwarded-For, or every viewer counts against the balancer's address. A client more than
+SSE_CLIENT_QUEUE_SIZE messages behind is disconnected. A heartbeat comment
+every SSE_HEARTBEAT_SECONDS keeps idle connections open through proxies and
+finds clients that went away.
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import logging
+from collections import Counter
+
+from aiohttp import web
+
+from constants import YANG_TERM
+from notify import get_change_bus
+from tweet_ring import get_tweet_ring
+from settings import (
+    PORT, SSE_CLIENT_QUEUE_SIZE, SSE_COALESCE_SECONDS, SSE_PUSH_POLL_SECONDS,
+    SSE_HEARTBEAT_SECONDS, SSE_SERVER_MAX_CONNECTIONS, SSE_SERVER_MAX_CONNECTIONS_PER_IP,
+    SSE_SERVER_TRUSTED_PROXIES
+)
+
+
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    # Keep proxies from buffering the stream
+    'X-Accel-Buffering': 'no',
+    # The dashboard may be served from another origin, no credentials are involved
+    'Access-Control-Allow-Origin': '*',
+}
+HEARTBEAT = b":\n\n"
+
+
+class Channel:
+    """
+    A stream's messages fanned out to per-connection bounded queues. Everything
+    runs on the event loop, a connection whose queue is full is dropped.
+    """
+    def __init__(self, queue_size=SSE_CLIENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.last_message = None
+        self.dropped = 0
+
+    def subscribe(self):
+        """New connection queue, primed with the last message"""
+        q = asyncio.Queue(maxsize=self.queue_size)
+        if self.last_message is not None:
+            q.put_nowait(self.last_message)
+        self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        self.subscribers.discard(q)
+
+    def publish(self, message):
+        self.last_message = message
+        for q in list(self.subscribers):
+            try:
+                q.put_nowait(message)
+            except asyncio.QueueFull:
+                self.unsubscribe(q)
+                # Replace what it did not read with the end of stream marker
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait(None)
+                self.dropped += 1
+
+
+# pylint: disable=logging-fstring-interpolation
+class SSEServer:
+    def __init__(self, bus, ring, track_term=YANG_TERM,
+                 max_connections=SSE_SERVER_MAX_CONNECTIONS,
+                 max_connections_per_ip=SSE_SERVER_MAX_CONNECTIONS_PER_IP,
+                 trusted_proxies=SSE_SERVER_TRUSTED_PROXIES,
+                 heartbeat_seconds=SSE_HEARTBEAT_SECONDS,
+                 coalesce_seconds=SSE_COALESCE_SECONDS, poll_seconds=SSE_PUSH_POLL_SECONDS):
+        """
+        Arguments:
+            bus {LocalChangeBus or RedisChangeBus} -- Change events from the ingester
+            ring {LocalTweetRing or RedisTweetRing} -- Latest tweets per track term
+
+        Keyword Arguments:
+            track_term {str} -- Track term of both streams
+            max_connections {int} -- Max open streams in this process
+            max_connections_per_ip {int} -- Max open streams from one client address, 0 for no cap
+            trusted_proxies {list} -- Addresses or networks of the proxies whose
+                X-Forwarded-For gives the client address
+            heartbeat_seconds {float} -- Max seconds without writing to a connection
+            coalesce_seconds {float} -- Events within this many seconds are sent as one
+            poll_seconds {float} -- Redis is read this often too, in case events were lost
+        """
+        self.bus = bus
+        self.ring = ring
+        self.track_term = track_term
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.trusted_proxies = [
+            ipaddress.ip_network(proxy, strict=False) for proxy in trusted_proxies]
+        self.heartbeat_seconds = heartbeat_seconds
+        self.coalesce_seconds = coalesce_seconds
+        self.poll_seconds = poll_seconds
+        self.count = Channel()
+        # Messages are lists of (id, text), each connection skips what it already sent
+        self.tweets = Channel()
+        self.last_count = None
+        self.last_id = 0
+        self.due = set()
+        self.loop = None
+        self.poll_task = None
+        self.connections_per_ip = Counter()
+        # Counters
+        self.connections = 0
+        self.rejected = 0
+        self.events = 0
+
+    async def start(self, app):
+        self.loop = asyncio.get_event_loop()
+        await self._send_count()
+        newest = await self._run(self.ring.latest, self.track_term, 1)
+        self.last_id = newest[0][0] if newest else 0
+        self.bus.subscribe(
+            lambda event: self.loop.call_soon_threadsafe(self._on_change_event, event))
+        self.poll_task = asyncio.ensure_future(self._poll())
+
+    async def stop(self, app):
+        if self.poll_task is not None:
+            self.poll_task.cancel()
+
+    async def yangcount(self, request):
+        return await self._stream(request, self.count)
+
+    async def latest_tweets(self, request):
+        try:
+            n = int(request.query.get('n', 5))
+            last_event_id = request.headers.get('Last-Event-ID')
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            raise web.HTTPBadRequest(text="n and Last-Event-ID must be integers")
+        n = max(min(n, self.ring.size), 1)
+        return await self._stream(
+            request, self.tweets, lambda: self._tweets_backlog(n, last_event_id))
+
+    async def stats(self, request):
+        return web.json_response({
+            'connections': self.connections,
+            'rejected': self.rejected,
+            'events': self.events,
+            'count_dropped': self.count.dropped,
+            'tweets_dropped': self.tweets.dropped,
+        })
+
+    async def _stream(self, request, channel, read_backlog=None):
+        """
+        Stream a channel's messages. read_backlog returns the (id, text) entries to
+        send first and the id the client has up to, it is read once subscribed, so
+        nothing published in between is missed.
+        """
+        ip = self._client_address(request)
+        if (self.connections >= self.max_connections
+                or (self.max_connections_per_ip
+                    and self.connections_per_ip[ip] >= self.max_connections_per_ip)):
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '10'})
+        self.connections += 1
+        self.connections_per_ip[ip] += 1
+        q = channel.subscribe()
+        try:
+            response = web.StreamResponse(headers=SSE_HEADERS)
+            backlog, last_id = [], 0
+            if read_backlog is not None:
+                backlog, last_id = await self._run(read_backlog)
+            await response.prepare(request)
+            if backlog:
+                last_id = backlog[-1][0]
+                await response.write(_tweet_events(backlog))
+            while True:
+                try:
+                    message = await asyncio.wait_for(q.get(), self.heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    message = HEARTBEAT
+                if message is None:
+                    break
+                if isinstance(message, list):
+                    entries = [entry for entry in message if entry[0] > last_id]
+                    if not entries:
+                        continue
+                    last_id = entries[-1][0]
+                    message = _tweet_events(entries)
+                await response.write(message)
+            return response
+        except ConnectionResetError:
+            return response
+        finally:
+            channel.unsubscribe(q)
+            self.connections -= 1
+            self.connections_per_ip[ip] -= 1
+            if not self.connections_per_ip[ip]:
+                del self.connections_per_ip[ip]
+
+    def _client_address(self, request):
+        """
+        The peer's address, or behind trusted proxies the last X-Forwarded-For
+        address that is not one of them: anything before it is up to the client
+        """
+        address = request.remote
+        if not self._is_trusted_proxy(address):
+            return address
+        forwarded = ','.join(request.headers.getall('X-Forwarded-For', ()))
+        for hop in reversed(forwarded.split(',')):
+            hop = hop.strip()
+            if not hop:
+                continue
+            address = hop
+            if not self._is_trusted_proxy(hop):
+                break
+        return address
+
+    def _is_trusted_proxy(self, address):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.trusted_proxies)
+
+    def _tweets_backlog(self, n, last_event_id):
+        """
+        The latest n ring entries, or the ones after last_event_id if it is still
+        valid, and the id the client has up to.
+        """
+        newest = self.ring.latest(self.track_term, 1)
+        # An id past the newest one is from before the ring was reset
+        if last_event_id is not None and newest and newest[0][0] >= last_event_id:
+            return self.ring.since(self.track_term, last_event_id), last_event_id
+        return self.ring.latest(self.track_term, n), 0
+
+    def _on_change_event(self, event):
+        if event.get('track_term') != self.track_term:
+            return
+        self.events += 1
+        if event['type'] == 'count':
+            self._coalesce('count', self._send_count)
+        elif event['type'] == 'tweets':
+            self._coalesce('tweets', self._send_new_tweets)
+
+    def _coalesce(self, name, send):
+        """Run send once, coalesce_seconds after the first event of a burst"""
+        if name in self.due:
+            return
+        self.due.add(name)
+
+        def run():
+            self.due.discard(name)
+            asyncio.ensure_future(send())
+        self.loop.call_later(self.coalesce_seconds, run)
+
+    async def _send_count(self):
+        event = await self._run(self.bus.retained, 'count', self.track_term)
+        if event is not None and event['count'] != self.last_count:
+            self.last_count = event['count']
+            self.count.publish(f"data:{event['count']}\n\n".encode())
+
+    async def _send_new_tweets(self):
+        entries = await self._run(self.ring.since, self.track_term, self.last_id)
+        if entries:
+            self.last_id = entries[-1][0]
+            self.tweets.publish(entries)
+            return
+        newest = await self._run(self.ring.latest, self.track_term, 1)
+        if newest and newest[0][0] < self.last_id:
+            # The ring was reset
+            self.last_id = newest[0][0]
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                await self._send_count()
+                await self._send_new_tweets()
+            except Exception as e:
+                logging.error(f"SSE poll failed: {e}")
+
+    async def _run(self, func, *args):
+        """Blocking Redis reads run in the default thread pool, never on the loop"""
+        return await self.loop.run_in_executor(None, func, *args)
+
+
+def _tweet_events(entries):
+    """One SSE event per (id, text), the text JSON encoded to keep it on one data line"""
+    return ''.join(
+        f"id:{tweet_id}\ndata:{json.dumps(text)}\n\n" for tweet_id, text in entries).encode()
+
+
+def create_app():
+    server = SSEServer(get_change_bus(), get_tweet_ring())
+    app = web.Application()
+    app['sse'] = server
+    app.router.add_get('/yangcount', server.yangcount)
+    app.router.add_get('/latest_tweets', server.latest_tweets)
+    app.router.add_get('/sse_stats', server.stats)
+    app.on_startup.append(server.start)
+    app.on_cleanup.append(server.stop)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Asyncio server for the SSE streams')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(PORT or 7801))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -1,18 +1,19 @@
 
 function getTweetStream() {
-  let source = new EventSource("/latest_tweets");
+  // One event per new tweet, oldest first, the browser resumes with Last-Event-ID
+  let source = new EventSource(`${window.SSE_BASE_URL || ""}/latest_tweets`);
+  let tweet_list = [];
   source.onmessage = function (event) {
-    tweet_list = JSON.parse(event.data)
-    $('blockquote#tweet-1').text(tweet_list[4]);
-    $('blockquote#tweet-2').text(tweet_list[3]);
-    $('blockquote#tweet-3').text(tweet_list[2]);
-    $('blockquote#tweet-4').text(tweet_list[1]);
-    $('blockquote#tweet-5').text(tweet_list[0]);
+    tweet_list.push(JSON.parse(event.data));
+    tweet_list = tweet_list.slice(-5);
+    tweet_list.forEach(function (tweet_text, i) {
+      $(`blockquote#tweet-${i + 1}`).text(tweet_text);
+    });
   }
 }
 
 function getYangTweetCount() {
-  let source = new EventSource("/yangcount");
+  let source = new EventSource(`${window.SSE_BASE_URL || ""}/yangcount`);
   source.onmessage = function (event) {
     $('div.yang-count').text(event.data);
   }
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+# The jobs import each other and the root modules flatly, as when run from jobs/
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'jobs')]
+# redisclient builds its client at import, tests pass fakeredis clients explicitly
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/15')
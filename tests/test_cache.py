@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from cache import Cache, LocalCache
+
+
+REFRESH_SECONDS = 3600
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+def make_cache(client, l1_seconds=60):
+    return Cache(client, namespace='test', lock_seconds=2, poll_seconds=0.01,
+                 local=LocalCache(ttl_seconds=l1_seconds))
+
+
+def current_bucket():
+    return int(time.time() // REFRESH_SECONDS)
+
+
+def test_a_miss_is_computed_once_across_workers(client):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'payload'
+
+    # One Cache per worker, sharing Redis only
+    caches = [make_cache(client) for _ in range(8)]
+    results = []
+    threads = [
+        threading.Thread(target=lambda c=c: results.append(
+            c.get_or_compute('chart', compute, REFRESH_SECONDS)))
+        for c in caches
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [b'payload'] * 8
+    assert sum(c.coalesced for c in caches) == 7
+    assert sum(c.lock_timeouts for c in caches) == 0
+
+
+def test_a_waiter_takes_over_a_lock_released_without_an_entry(client):
+    cache = make_cache(client)
+    lock_key = cache.key('chart', None, current_bucket()) + ':lock'
+    # Another worker is computing
+    client.set(lock_key, 'other')
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(
+        cache.get_or_compute('chart', lambda: 'payload', REFRESH_SECONDS)))
+    waiter.start()
+    time.sleep(0.1)
+    # Its compute failed: the lock is released and nothing was written
+    client.delete(lock_key)
+    waiter.join()
+
+    assert results == [b'payload']
+    assert cache.lock_takeovers == 1
+    assert cache.lock_timeouts == 0
+    assert client.get(lock_key) is None
+
+
+def test_the_previous_bucket_is_served_stale_while_computing(client):
+    cache = make_cache(client)
+    bucket = current_bucket()
+    generated_at = (bucket - 1) * REFRESH_SECONDS + 1
+    cache.set(cache.key('chart', None, bucket - 1), 'old', REFRESH_SECONDS, generated_at)
+    client.set(cache.key('chart', None, bucket) + ':lock', 'other')
+
+    before = time.time()
+    entry = cache.get_entry('chart', lambda: 'new', REFRESH_SECONDS)
+
+    assert entry.value == b'old'
+    assert entry.generated_at == generated_at
+    # Not to be cached downstream until the bucket ends
+    assert before <= entry.expires_at <= time.time()
+    assert cache.stale_served == 1
+
+
+def test_a_fresh_local_entry_is_served_without_redis(client):
+    cache = make_cache(client)
+    cache.get_or_compute('chart', lambda: 'payload', REFRESH_SECONDS)
+    client.flushall()
+
+    assert cache.get_or_compute('chart', lambda: 'other', REFRESH_SECONDS) == b'payload'
+    assert cache.local.hits == 1
+    assert cache.hits == 0
+
+
+def test_a_local_entry_is_revalidated_by_version(client):
+    cache = make_cache(client, l1_seconds=0)
+    cache.get_or_compute('chart', lambda: 'payload', REFRESH_SECONDS)
+
+    # Same version in Redis: only its version is fetched, the payload is not
+    assert cache.get_or_compute('chart', lambda: 'other', REFRESH_SECONDS) == b'payload'
+    assert cache.local.revalidated == 1
+    assert cache.hits == 0
+
+    # Another worker wrote a new version: the payload is fetched again
+    key = cache.key('chart', None, current_bucket())
+    make_cache(client).set(key, 'newer', REFRESH_SECONDS, generated_at=time.time() + 1)
+    assert cache.get_or_compute('chart', lambda: 'other', REFRESH_SECONDS) == b'newer'
+    assert cache.local.revalidated == 1
+    assert cache.hits == 1
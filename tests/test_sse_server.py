@@ -0,0 +1,32 @@
+import pytest
+
+pytest.importorskip('aiohttp')
+from aiohttp.test_utils import make_mocked_request
+
+from notify import LocalChangeBus
+from sse_server import SSEServer
+from tweet_ring import LocalTweetRing
+
+
+def client_address(trusted_proxies, peer, forwarded=None):
+    server = SSEServer(LocalChangeBus(), LocalTweetRing(), trusted_proxies=trusted_proxies)
+    headers = {'X-Forwarded-For': forwarded} if forwarded else {}
+    request = make_mocked_request('GET', '/yangcount', headers=headers)
+    request = request.clone(remote=peer)
+    return server._client_address(request)
+
+
+def test_peer_address_without_trusted_proxies():
+    assert client_address([], '10.1.2.3', '1.2.3.4') == '10.1.2.3'
+
+
+def test_forwarded_address_from_a_trusted_proxy():
+    assert client_address(['10.0.0.0/8'], '10.1.2.3', '1.2.3.4') == '1.2.3.4'
+
+
+def test_addresses_prepended_by_the_client_are_ignored():
+    assert client_address(['10.0.0.0/8'], '10.1.2.3', '6.6.6.6, 1.2.3.4, 10.9.9.9') == '1.2.3.4'
+
+
+def test_trusted_proxy_without_forwarded_header():
+    assert client_address(['10.0.0.0/8'], '10.1.2.3') == '10.1.2.3'
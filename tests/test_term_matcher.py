@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from term_matcher import TermMatcher, NO_TERM
+from conftest import ROOT
+
+
+@pytest.fixture(scope='module')
+def matcher():
+    return TermMatcher.from_file(os.path.join(ROOT, 'config_prod.yml'))
+
+
+@pytest.mark.parametrize('text, term', [
+    ('Andrew Yang on the debate stage #YangGang', 'andrewyang'),
+    ('just bought more $ADA', 'cardano'),
+    ('#BTC to the moon', 'bitcoin'),
+    ('nothing to see here', NO_TERM),
+    ('', NO_TERM),
+    (None, NO_TERM),
+])
+def test_get_track_term(matcher, text, term):
+    assert matcher.get_track_term(text) == term
+
+
+def test_priority_follows_the_tracked_terms_then_the_aliases_in_config_order(matcher):
+    # Tracked terms first, as is
+    assert matcher.match('$ada and andrewyang') == ['andrewyang', 'cardano']
+    assert matcher.match('cardano and andrewyang') == ['cardano', 'andrewyang']
+    # Then the aliases: bitcoin's before cardano's before andrewyang's
+    assert matcher.match('yang gang $ada #btc') == ['bitcoin', 'cardano', 'andrewyang']
+
+
+def test_untracked_term_only_matches_by_its_aliases(matcher):
+    assert matcher.get_track_term('bitcoin') == NO_TERM
+    assert matcher.get_track_term('$btc') == 'bitcoin'
+
+
+def test_overlapping_aliases_are_all_matched(matcher):
+    assert matcher.match('$adandrewyang') == ['andrewyang', 'cardano']
+    assert matcher.get_track_term('$adandrewyang') == 'andrewyang'
+
+
+def test_alias_that_starts_a_longer_one_is_matched():
+    matcher = TermMatcher([('a', ['card']), ('b', ['cardano'])])
+    assert matcher.match('CARDANO') == ['a', 'b']
+
+
+@pytest.mark.parametrize('text', [
+    'we need univerſal basic income',
+    'freedom dİvidend',
+    'ǅ ﬁ ß İstanbul',
+])
+def test_case_fold_variants_never_raise(matcher, text):
+    assert matcher.get_track_term(text) in matcher.terms + [NO_TERM]
@@ -0,0 +1,98 @@
+import pytest
+from sqlalchemy import create_engine, select
+
+from dedup import RecentIdFilter
+from models import Tweet
+from tweet_writer import TweetBatchWriter
+
+
+COLUMNS = ['inserted_at', 'track_term', 'tweet_id', 'tweet_text']
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'tweets.sqlite'}")
+    Tweet.__table__.create(engine)
+    return engine
+
+
+def make_row(i):
+    return (1570000000000 + i, 'andrewyang', str(1180000000000000000 + i), f"tweet {i}")
+
+
+def written_ids(engine):
+    table = Tweet.__table__
+    with engine.connect() as conn:
+        return [tweet_id for tweet_id, in conn.execute(
+            select([table.c.tweet_id]).order_by(table.c.id))]
+
+
+def test_flush_when_the_batch_is_full(engine):
+    writer = TweetBatchWriter(engine, columns=COLUMNS, batch_size=3, max_latency=60)
+    for i in range(2):
+        writer.add(make_row(i))
+    assert written_ids(engine) == []
+
+    writer.add(make_row(2))
+    assert written_ids(engine) == [make_row(i)[2] for i in range(3)]
+    assert writer.buffer == []
+    assert (writer.flush_count, writer.rows_written) == (1, 3)
+
+
+def test_flush_once_the_oldest_row_is_due(engine):
+    writer = TweetBatchWriter(engine, columns=COLUMNS, batch_size=100, max_latency=0)
+    writer.add(make_row(0))
+    assert written_ids(engine) == [make_row(0)[2]]
+    assert writer.seconds_until_due() is None
+
+
+def test_hooks_see_the_written_rows(engine):
+    writer = TweetBatchWriter(engine, columns=COLUMNS, batch_size=100, max_latency=60)
+    in_transaction, after_commit = [], []
+    writer.flush_hooks.append(lambda conn, rows: in_transaction.append(
+        (conn.execute(select([Tweet.__table__.c.tweet_id])).fetchall(), rows)))
+    writer.after_write_hooks.append(after_commit.append)
+    rows = [make_row(i) for i in range(2)]
+    for row in rows:
+        writer.append(row)
+
+    assert writer.flush() == 2
+    # The flush hooks run after the insert, in the same transaction
+    assert in_transaction == [([(row[2],) for row in rows], rows)]
+    assert after_commit == [rows]
+
+
+def test_reconnect_duplicates_are_dropped_before_the_writer(engine):
+    # On SQLite the writer inserts as is, the ingester's filter drops duplicates
+    writer = TweetBatchWriter(engine, columns=COLUMNS, batch_size=100, max_latency=60)
+    recent_ids = RecentIdFilter()
+    # A reconnect replays the last two tweets
+    for i in [0, 1, 2, 1, 2, 3]:
+        row = make_row(i)
+        if not recent_ids.is_duplicate(row[2]):
+            writer.append(row)
+    writer.flush()
+
+    assert written_ids(engine) == [make_row(i)[2] for i in range(4)]
+    assert recent_ids.stats() == {'dedup_passed': 4, 'dedup_dropped': 2, 'dedup_ids_held': 4}
+
+
+def test_recent_ids_are_remembered_for_one_full_generation():
+    recent_ids = RecentIdFilter(capacity=2)
+    for tweet_id in ['a', 'b', 'c']:
+        assert not recent_ids.is_duplicate(tweet_id)
+    # 'a' and 'b' rotated into the previous generation, still caught
+    assert recent_ids.is_duplicate('a')
+    assert recent_ids.is_duplicate('c')
+
+    assert not recent_ids.is_duplicate('d')
+    assert not recent_ids.is_duplicate('e')
+    # Two rotations later 'a' is forgotten, memory stays bounded
+    assert not recent_ids.is_duplicate('a')
+    assert recent_ids.stats()['dedup_ids_held'] <= 2 * recent_ids.capacity
+
+
+def test_tweets_without_an_id_are_never_dropped():
+    recent_ids = RecentIdFilter()
+    assert not recent_ids.is_duplicate(None)
+    assert not recent_ids.is_duplicate(None)
@@ -0,0 +1,115 @@
+"""
+Ring buffer of the latest tweets per track term
+
+The ingester appends every committed tweet's text with an id from a per term
+counter, so ids only ever increase. Entries live in a sorted set scored by id
+and capped at size, so the latest n, or everything after a client's
+Last-Event-ID, is one Redis read and never a database query. Without
+REDIS_URL, an in-process ring stands in.
+"""
+import json
+import logging
+import threading
+from collections import deque
+
+from redis.exceptions import RedisError
+
+from settings import REDIS_URL, CACHE_NAMESPACE, LATEST_TWEETS_RING_SIZE
+
+
+class LocalTweetRing:
+    """In-process stand-in, for replays and dev servers without Redis"""
+    def __init__(self, size=LATEST_TWEETS_RING_SIZE):
+        self.size = size
+        self.entries = {}
+        self.last_ids = {}
+        self.lock = threading.Lock()
+
+    def append(self, track_term, texts):
+        """Append texts, oldest first, return the id of the last one"""
+        with self.lock:
+            entries = self.entries.setdefault(track_term, deque(maxlen=self.size))
+            last_id = self.last_ids.get(track_term, 0)
+            for text in texts:
+                last_id += 1
+                entries.append((last_id, text))
+            self.last_ids[track_term] = last_id
+        return last_id
+
+    def latest(self, track_term, n):
+        """Latest n (id, text), oldest first"""
+        with self.lock:
+            return list(self.entries.get(track_term, ()))[-n:] if n > 0 else []
+
+    def since(self, track_term, last_id):
+        """Every (id, text) after last_id still in the ring, oldest first"""
+        with self.lock:
+            return [entry for entry in self.entries.get(track_term, ()) if entry[0] > last_id]
+
+
+# pylint: disable=logging-fstring-interpolation
+class RedisTweetRing:
+    def __init__(self, client, namespace=CACHE_NAMESPACE, size=LATEST_TWEETS_RING_SIZE):
+        """
+        Arguments:
+            client {redis.Redis} -- Redis client
+
+        Keyword Arguments:
+            namespace {str} -- Prefix of the keys
+            size {int} -- Max entries kept per track term
+        """
+        self.client = client
+        self.prefix = f"{namespace}:latest_tweets"
+        self.size = size
+
+    def append(self, track_term, texts):
+        """Append texts, oldest first, return the id of the last one"""
+        if not texts:
+            return None
+        key = f"{self.prefix}:{track_term}"
+        last_id = self.client.incrby(f"{key}:seq", len(texts))
+        first_id = last_id - len(texts) + 1
+        pipe = self.client.pipeline(transaction=False)
+        # The id is part of the member, so the same text twice is two entries
+        pipe.zadd(key, {json.dumps([first_id + i, text]): first_id + i
+                        for i, text in enumerate(texts)})
+        pipe.zremrangebyrank(key, 0, -self.size - 1)
+        pipe.execute()
+        return last_id
+
+    def latest(self, track_term, n):
+        """Latest n (id, text), oldest first"""
+        if n <= 0:
+            return []
+        return self._read(track_term, lambda key: self.client.zrange(key, -n, -1))
+
+    def since(self, track_term, last_id):
+        """Every (id, text) after last_id still in the ring, oldest first"""
+        return self._read(
+            track_term, lambda key: self.client.zrangebyscore(key, f"({last_id}", '+inf'))
+
+    def _read(self, track_term, read):
+        key = f"{self.prefix}:{track_term}"
+        try:
+            members = read(key)
+        except RedisError as e:
+            logging.error(f"Reading the latest tweets failed for {key}: {e}")
+            return []
+        return [tuple(json.loads(member)) for member in members]
+
+
+_ring = None
+_ring_lock = threading.Lock()
+
+
+def get_tweet_ring():
+    """The process' tweet ring, on Redis if REDIS_URL is set"""
+    global _ring
+    with _ring_lock:
+        if _ring is None:
+            if REDIS_URL:
+                from redisclient import r
+                _ring = RedisTweetRing(r)
+            else:
+                _ring = LocalTweetRing()
+        return _ring